@@ -0,0 +1,137 @@
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+import numpy as np
+
+# 使用环境变量配置
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', '1') not in ('0', 'false', 'False')
+# 查询向量的余弦相似度达到该阈值时视为同一个问题
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95'))
+# 缓存条目的有效期（秒）
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', '3600'))
+# 每个知识库缓存的回答数量上限，超出后淘汰最久未使用的条目
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '256'))
+
+class _KnowledgeBaseCache:
+    """单个知识库的回答缓存：按最近使用顺序保存条目，并维护归一化查询向量矩阵用于一次性比较"""
+
+    def __init__(self):
+        self.entries = OrderedDict()  # 条目ID -> (归一化查询向量, 回答, 写入时间)
+        self.generation = 0
+        self._next_id = 0
+        self._matrix = None
+        self._matrix_ids = []
+
+    def _rebuild_matrix(self):
+        self._matrix_ids = list(self.entries)
+        self._matrix = np.stack([self.entries[i][0] for i in self._matrix_ids]) if self._matrix_ids else None
+
+    def expire(self, now: float):
+        expired = [i for i, (_, _, created) in self.entries.items() if now - created > ANSWER_CACHE_TTL]
+        for entry_id in expired:
+            del self.entries[entry_id]
+        if expired:
+            self._matrix = None
+
+    def find(self, vector: np.ndarray) -> Optional[Tuple[int, float]]:
+        if not self.entries:
+            return None
+        if self._matrix is None or len(self._matrix_ids) != len(self.entries):
+            self._rebuild_matrix()
+        similarities = self._matrix @ vector
+        best = int(np.argmax(similarities))
+        return self._matrix_ids[best], float(similarities[best])
+
+    def add(self, vector: np.ndarray, response: Dict[str, Any], now: float):
+        self.entries[self._next_id] = (vector, response, now)
+        self._next_id += 1
+        while len(self.entries) > max(ANSWER_CACHE_MAX_ENTRIES, 1):
+            self.entries.popitem(last=False)
+        self._matrix = None
+
+    def clear(self):
+        self.entries.clear()
+        self._matrix = None
+        self.generation += 1
+
+_caches = {}
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def _normalize(vector) -> Optional[np.ndarray]:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm > 0 else None
+
+def _get_cache(kb_id) -> _KnowledgeBaseCache:
+    if kb_id not in _caches:
+        _caches[kb_id] = _KnowledgeBaseCache()
+    return _caches[kb_id]
+
+def lookup_answer(kb_id, query_embedding) -> Tuple[Optional[Dict[str, Any]], int]:
+    """
+    查找与查询向量足够相似的已缓存回答
+
+    参数:
+        kb_id: 知识库ID
+        query_embedding: 查询的嵌入向量
+
+    返回:
+        tuple: (缓存的回答副本或None, 知识库缓存的当前版本号)；
+        版本号需要传给store_answer，用于丢弃在文档变更之前开始的查询结果
+    """
+    with _lock:
+        cache = _get_cache(kb_id)
+        generation = cache.generation
+        vector = _normalize(query_embedding) if ANSWER_CACHE_ENABLED else None
+        if vector is None:
+            return None, generation
+
+        cache.expire(time.time())
+        match = cache.find(vector)
+        if match is None or match[1] < ANSWER_CACHE_THRESHOLD:
+            _stats["misses"] += 1
+            return None, generation
+
+        entry_id, similarity = match
+        cache.entries.move_to_end(entry_id)
+        _stats["hits"] += 1
+        response = copy.deepcopy(cache.entries[entry_id][1])
+
+    print(f"命中回答缓存 (知识库 {kb_id}，相似度 {similarity:.3f})")
+    return response, generation
+
+def store_answer(kb_id, query_embedding, response: Dict[str, Any], generation: int):
+    """
+    缓存查询的回答
+
+    参数:
+        kb_id: 知识库ID
+        query_embedding: 查询的嵌入向量
+        response: 回答及来源
+        generation: 查询开始时lookup_answer返回的版本号；知识库内容在此之后变化时不写入
+    """
+    vector = _normalize(query_embedding) if ANSWER_CACHE_ENABLED else None
+    if vector is None:
+        return
+
+    with _lock:
+        cache = _get_cache(kb_id)
+        if cache.generation != generation:
+            return
+        cache.add(vector, copy.deepcopy(response), time.time())
+
+def invalidate_answer_cache(kb_id=None):
+    """知识库中的文档被添加或删除后清空该知识库的回答缓存"""
+    with _lock:
+        _get_cache(kb_id).clear()
+        _stats["invalidations"] += 1
+
+def get_answer_cache_stats() -> Dict[str, int]:
+    """返回进程启动以来的命中、未命中和失效次数，以及当前缓存的条目数"""
+    with _lock:
+        return dict(_stats, entries=sum(len(cache.entries) for cache in _caches.values()))
@@ -1,10 +1,20 @@
 import os
+import time
+import atexit
 import sqlite3
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS  # Import the CORS extension
-from embed import embed_document
-from query import perform_query
-from db_utils import init_database, get_db_connection, create_conversation, get_conversation, get_conversations, delete_conversation, save_conversation_message
+from ingestion import submit_ingestion, get_job_status
+from query import perform_query, stream_query
+from db_utils import init_database, fail_interrupted_ingestion_jobs, close_db_connections, get_db_connection, create_conversation, get_conversation, get_conversations, delete_conversation, save_conversation_message
+from db_utils import check_conversation_exists, check_knowledge_base_exists, decode_cursor, fetch_page, invalidate_document_names, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from get_vector_db import get_vector_db, get_collection_name, delete_document_vectors, drop_vector_collection
+from keyword_index import remove_document_keywords, remove_chunk_keywords, drop_keyword_index
+from answer_cache import invalidate_answer_cache, get_answer_cache_stats
+from embedding_cache import get_cache_stats as get_embedding_cache_stats
+from paraphrase_cache import get_cache_stats as get_paraphrase_cache_stats
+from chunking import validate_chunking_settings
+from metrics import span, start_trace, observe_request, render_metrics, render_cache_metrics
 import json
 
 
@@ -21,20 +31,76 @@ os.makedirs(DOCS_STORAGE, exist_ok=True)
 app = Flask(__name__)
 # Enable CORS for all routes
 CORS(app, resources={r"/*": {"origins": "*"}})
-# 初始化数据库
-init_database(DB_PATH)
+# PDF提取进程以spawn方式启动，会以__mp_main__的名称重新导入启动脚本；
+# 这些子进程不能把正在运行的导入任务标记为中断
+if __name__ != '__mp_main__':
+    # 初始化数据库
+    init_database(DB_PATH)
+    # 上次运行时未完成的导入任务已无法继续
+    fail_interrupted_ingestion_jobs(DB_PATH)
+    # 退出时关闭池中的连接，SQLite随最后一个连接执行检查点并删除WAL文件
+    atexit.register(close_db_connections)
+
+def _parse_page_params(limit, cursor, default_limit=DEFAULT_PAGE_SIZE):
+    """
+    校验分页参数limit和cursor，Flask和ASGI两种服务模式共用
+
+    参数:
+        limit: 查询字符串中的limit (字符串或None)
+        cursor: 查询字符串中的cursor (可选)
+        default_limit: 默认每页记录数；为None时，既没有limit也没有cursor的请求不分页
+
+    返回:
+        tuple: (每页记录数或None（不分页）, 解码后的游标或None, 错误响应或None)
+    """
+    if limit is None:
+        if default_limit is None and not cursor:
+            return None, None, None
+        limit = DEFAULT_PAGE_SIZE if default_limit is None else default_limit
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            return None, None, {"error": "limit must be a positive integer"}
+    if limit < 1:
+        return None, None, {"error": "limit must be a positive integer"}
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    if not cursor:
+        return limit, None, None
+    try:
+        return limit, decode_cursor(cursor), None
+    except ValueError:
+        return None, None, {"error": "invalid cursor"}
+
+def _get_page_params(default_limit=DEFAULT_PAGE_SIZE):
+    """
+    读取当前请求的分页参数limit和cursor
+
+    返回:
+        tuple: (每页记录数, 解码后的游标或None, 错误响应或None)
+    """
+    limit, after, error = _parse_page_params(request.args.get('limit'), request.args.get('cursor'), default_limit)
+    if error:
+        return None, None, (jsonify(error), 400)
+    return limit, after, None
 
 # ================ 知识库管理API ================
 
 @app.route('/knowledge-bases', methods=['GET'])
 def list_knowledge_bases():
-    """获取所有知识库列表"""
+    """获取知识库列表（按创建时间倒序，键集分页）"""
+    limit, after, error = _get_page_params()
+    if error:
+        return error
+    
     conn = get_db_connection(DB_PATH)
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM knowledge_bases ORDER BY created_at DESC")
-    knowledge_bases = [dict(row) for row in cursor.fetchall()]
+    knowledge_bases, next_cursor = fetch_page(
+        cursor, "SELECT * FROM knowledge_bases", [], limit, 'created_at', after=after
+    )
     conn.close()
-    return jsonify({"knowledge_bases": knowledge_bases})
+    return jsonify({"knowledge_bases": knowledge_bases, "next_cursor": next_cursor})
 
 @app.route('/knowledge-bases', methods=['POST'])
 def create_knowledge_base():
@@ -47,11 +113,16 @@ def create_knowledge_base():
     name = data.get('name')
     description = data.get('description', '')
     
+    # 可选的分块设置，未提供时使用默认值
+    chunking, chunking_error = validate_chunking_settings(data)
+    if chunking_error:
+        return jsonify({"error": chunking_error}), 400
+    
     conn = get_db_connection(DB_PATH)
     cursor = conn.cursor()
     cursor.execute(
-        "INSERT INTO knowledge_bases (name, description) VALUES (?, ?)",
-        (name, description)
+        "INSERT INTO knowledge_bases (name, description, chunk_strategy, chunk_size, chunk_overlap) VALUES (?, ?, ?, ?, ?)",
+        (name, description, chunking.get('chunk_strategy'), chunking.get('chunk_size'), chunking.get('chunk_overlap'))
     )
     kb_id = cursor.lastrowid
     conn.commit()
@@ -64,7 +135,11 @@ def create_knowledge_base():
 
 @app.route('/knowledge-bases/<int:kb_id>', methods=['GET'])
 def get_knowledge_base(kb_id):
-    """获取指定知识库及其包含的文档"""
+    """获取指定知识库及其包含的文档（文档按上传时间倒序，键集分页）"""
+    limit, after, error = _get_page_params()
+    if error:
+        return error
+    
     conn = get_db_connection(DB_PATH)
     cursor = conn.cursor()
     
@@ -76,15 +151,15 @@ def get_knowledge_base(kb_id):
         conn.close()
         return jsonify({"error": "knowledge base not found"}), 404
     
-    # 获取该知识库下的所有文档
-    cursor.execute(
-        "SELECT id, original_filename, upload_date, file_size FROM documents WHERE knowledge_base_id = ? ORDER BY upload_date DESC", 
-        (kb_id,)
+    # 获取该知识库下的一页文档
+    documents, next_cursor = fetch_page(
+        cursor, "SELECT id, original_filename, upload_date, file_size FROM documents", [kb_id], limit, 'upload_date',
+        where="knowledge_base_id = ?", after=after
     )
-    documents = [dict(row) for row in cursor.fetchall()]
     
     kb_dict = dict(kb)
     kb_dict['documents'] = documents
+    kb_dict['documents_next_cursor'] = next_cursor
     
     conn.close()
     return jsonify(kb_dict)
@@ -111,6 +186,14 @@ def update_knowledge_base(kb_id):
         updates.append("description = ?")
         params.append(description)
     
+    # 分块设置只影响之后上传的文档
+    chunking, chunking_error = validate_chunking_settings(data)
+    if chunking_error:
+        return jsonify({"error": chunking_error}), 400
+    for field, value in chunking.items():
+        updates.append(f"{field} = ?")
+        params.append(value)
+    
     if not updates:
         return jsonify({"error": "no valid update fields"}), 400
     
@@ -145,23 +228,33 @@ def delete_knowledge_base(kb_id):
         return jsonify({"error": "knowledge base not found"}), 404
     
     # 获取该知识库下的所有文档
-    cursor.execute("SELECT file_path FROM documents WHERE knowledge_base_id = ?", (kb_id,))
+    cursor.execute("SELECT DISTINCT file_path FROM documents WHERE knowledge_base_id = ?", (kb_id,))
     documents = cursor.fetchall()
     
-    # 删除文件系统中的文档文件
+    # 删除数据库中的文档记录
+    cursor.execute("DELETE FROM documents WHERE knowledge_base_id = ?", (kb_id,))
+    
+    # 删除文件系统中不再被其他知识库引用的文档文件
     for doc in documents:
         file_path = doc[0]
-        if os.path.exists(file_path):
+        cursor.execute("SELECT COUNT(*) FROM documents WHERE file_path = ?", (file_path,))
+        if cursor.fetchone()[0] == 0 and os.path.exists(file_path):
             os.remove(file_path)
     
-    # 删除数据库中的文档记录
-    cursor.execute("DELETE FROM documents WHERE knowledge_base_id = ?", (kb_id,))
-    
     # 删除知识库
     cursor.execute("DELETE FROM knowledge_bases WHERE id = ?", (kb_id,))
     
     conn.commit()
     conn.close()
+    invalidate_document_names()
+    
+    # 删除知识库的向量集合（同时释放进程内缓存的句柄）和回答缓存
+    try:
+        drop_vector_collection(kb_id)
+    except Exception as e:
+        print(f"删除向量集合出错: {str(e)}")
+    invalidate_answer_cache(kb_id)
+    drop_keyword_index(get_collection_name(kb_id))
     
     return jsonify({"message": "knowledge base deleted"})
 
@@ -169,28 +262,29 @@ def delete_knowledge_base(kb_id):
 
 @app.route('/documents', methods=['GET'])
 def list_documents():
-    """获取文档列表，可按知识库筛选"""
+    """获取文档列表（按上传时间倒序，键集分页），可按知识库筛选"""
     kb_id = request.args.get('knowledge_base_id')
+    limit, after, error = _get_page_params()
+    if error:
+        return error
     
-    conn = get_db_connection(DB_PATH)
-    cursor = conn.cursor()
-    
+    where = None
+    params = []
     if kb_id:
         try:
-            kb_id = int(kb_id)
-            cursor.execute(
-                "SELECT id, original_filename, upload_date, file_size, knowledge_base_id FROM documents WHERE knowledge_base_id = ? ORDER BY upload_date DESC", 
-                (kb_id,)
-            )
+            params.append(int(kb_id))
+            where = "knowledge_base_id = ?"
         except ValueError:
-            conn.close()
             return jsonify({"error": "invalid knowledge base id"}), 400
-    else:
-        cursor.execute("SELECT id, original_filename, upload_date, file_size, knowledge_base_id FROM documents ORDER BY upload_date DESC")
     
-    documents = [dict(row) for row in cursor.fetchall()]
+    conn = get_db_connection(DB_PATH)
+    cursor = conn.cursor()
+    documents, next_cursor = fetch_page(
+        cursor, "SELECT id, original_filename, upload_date, file_size, knowledge_base_id FROM documents", params,
+        limit, 'upload_date', where=where, after=after
+    )
     conn.close()
-    return jsonify({"documents": documents})
+    return jsonify({"documents": documents, "next_cursor": next_cursor})
 
 @app.route('/documents/<int:doc_id>', methods=['GET'])
 def get_document(doc_id):
@@ -230,24 +324,48 @@ def delete_document(doc_id):
     """删除文档"""
     conn = get_db_connection(DB_PATH)
     cursor = conn.cursor()
-    cursor.execute("SELECT file_path FROM documents WHERE id = ?", (doc_id,))
+    cursor.execute("SELECT file_path, knowledge_base_id, stored_filename FROM documents WHERE id = ?", (doc_id,))
     result = cursor.fetchone()
     
     if not result:
         conn.close()
         return jsonify({"error": "document not found"}), 404
     
-    file_path = result[0]
+    file_path, kb_id, stored_filename = result
     
     # 删除数据库记录
     cursor.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
     conn.commit()
+    invalidate_document_names()
+    
+    # 内容相同的文档共用同一个文件，只有没有其他文档引用时才删除
+    cursor.execute("SELECT COUNT(*) FROM documents WHERE file_path = ?", (file_path,))
+    still_referenced = cursor.fetchone()[0] > 0
     conn.close()
     
     # 删除文件
-    if os.path.exists(file_path):
+    if not still_referenced and os.path.exists(file_path):
         os.remove(file_path)
     
+    # 从向量集合中删除该文档的块，避免孤立向量拖慢检索
+    legacy_ids = []
+    try:
+        legacy_ids = delete_document_vectors(kb_id, doc_id, stored_filename)
+    except Exception as e:
+        print(f"删除文档向量出错: {str(e)}")
+    
+    # 从关键词索引中移除该文档的块（旧版块没有document_id，按块ID移除）
+    try:
+        db = get_vector_db(kb_id)
+        remove_document_keywords(db, doc_id)
+        if legacy_ids:
+            remove_chunk_keywords(db, legacy_ids)
+    except Exception as e:
+        print(f"更新关键词索引出错: {str(e)}")
+    
+    # 知识库内容已变化，之前缓存的回答可能引用该文档
+    invalidate_answer_cache(kb_id)
+    
     return jsonify({"message": "document deleted"})
 
 # ================ 嵌入和查询API ================
@@ -270,80 +388,179 @@ def route_embed():
     except ValueError:
         return jsonify({"error": "invalid knowledge base id"}), 400
     
-    success, doc_id, message = embed_document(file, kb_id)
-
-    if success:
-        # Check if the file was saved but content extraction failed
-        if "content extraction failed" in message:
-            return jsonify({
-                "warning": "File saved but content cannot be searched",
-                "message": "The file was saved to the knowledge base but could not be processed for search. It may be corrupted or password-protected.",
-                "document_id": doc_id,
-                "technical_details": message
-            }), 201  # 201 Created - since we did create a record, just with limitations
-        else:
-            return jsonify({
-                "message": "success with embedding",
-                "document_id": doc_id
-            }), 200
-    else:
-        return jsonify({
-            "error": message
-        }), 400
+    return _queue_ingestion(file, kb_id)
+
+def _queue_ingestion(file, kb_id):
+    """提交后台导入任务并立即返回任务ID"""
+    result, status_code = submit_ingestion(file, kb_id)
+    return jsonify(result), status_code
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_ingestion_job_status(job_id):
+    """查询文档导入任务的状态"""
+    job = get_job_status(job_id)
+
+    if not job:
+        return jsonify({"error": "job not found"}), 404
+
+    # 文件已保存但内容无法提取时给出提示
+    if job['status'] == 'done' and job.get('message') and "content extraction failed" in job['message']:
+        job['warning'] = "File saved but content cannot be searched"
+
+    return jsonify(job)
+
+def _parse_query_request(data):
+    """
+    校验/query请求体，Flask和ASGI两种服务模式共用
+
+    返回:
+        tuple: (参数字典, 错误响应或None, HTTP状态码)
+    """
+    if not data:
+        return None, {"error": "please provide a request body"}, 400
+        
+    user_query = data.get('query')
+    kb_id = data.get('knowledge_base_id')
+    conversation_id = data.get('conversation_id')
+    
+    if not user_query:
+        return None, {"error": "please provide a query"}, 400
+    
+    if kb_id is not None:
+        try:
+            kb_id = int(kb_id)
+        except ValueError:
+            return None, {"error": "invalid knowledge base id"}, 400
+    
+    if conversation_id is not None:
+        try:
+            conversation_id = int(conversation_id)
+        except ValueError:
+            return None, {"error": "invalid conversation id"}, 400
+    
+    # 查询改写可以按请求关闭，或限制其耗时（秒）
+    paraphrase = data.get('paraphrase', True)
+    if not isinstance(paraphrase, bool):
+        return None, {"error": "paraphrase must be a boolean"}, 400
+    paraphrase_timeout = data.get('paraphrase_timeout')
+    if paraphrase_timeout is not None:
+        try:
+            paraphrase_timeout = float(paraphrase_timeout)
+        except (TypeError, ValueError):
+            return None, {"error": "paraphrase_timeout must be a number of seconds"}, 400
+        if paraphrase_timeout < 0:
+            return None, {"error": "paraphrase_timeout must not be negative"}, 400
+    
+    return {
+        "query": user_query,
+        "kb_id": kb_id,
+        "conversation_id": conversation_id,
+        "paraphrase": paraphrase,
+        "paraphrase_timeout": paraphrase_timeout,
+        # 可选地在响应中返回各阶段耗时（秒）
+        "timings": bool(data.get('timings')),
+        "stream": bool(data.get('stream'))
+    }, None, 200
+
+def _check_query_knowledge_base(kb_id):
+    """
+    检查查询的知识库是否存在且包含文档
+
+    返回:
+        tuple: 失败时返回 (错误响应, HTTP状态码)，否则返回None
+    """
+    if kb_id is None:
+        return None
+    with span('kb_validation'):
+        conn = get_db_connection(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM knowledge_bases WHERE id = ?", (kb_id,))
+        kb_exists = cursor.fetchone() is not None
+        
+        # 检查知识库是否包含文档
+        cursor.execute("SELECT COUNT(*) FROM documents WHERE knowledge_base_id = ?", (kb_id,))
+        doc_count = cursor.fetchone()[0]
+        conn.close()
+    
+    if not kb_exists:
+        return {"error": "knowledge base not found", "detail": f"Knowledge base ID {kb_id} does not exist"}, 404
+    
+    if doc_count == 0:
+        return {
+            "error": "knowledge base is empty", 
+            "detail": f"Knowledge base ID {kb_id} has no documents. Please upload documents first."
+        }, 400
+    return None
+
+def _check_query_conversation(conversation_id):
+    """
+    检查查询关联的对话是否存在
+
+    返回:
+        tuple: 失败时返回 (错误响应, HTTP状态码)，否则返回None
+    """
+    if conversation_id is None:
+        return None
+    with span('conversation_lookup'):
+        conversation_exists = check_conversation_exists(DB_PATH, conversation_id)
+    if not conversation_exists:
+        return {"error": "conversation not found", "detail": f"Conversation ID {conversation_id} does not exist"}, 404
+    return None
+
+def _save_query_history(conversation_id, user_query, response):
+    """把问题和回答保存到对话历史，并在响应中标记会话ID或警告"""
+    if not conversation_id:
+        return
+    try:
+        with span('conversation_save'):
+            # 保存用户问题到对话历史
+            save_conversation_message(DB_PATH, conversation_id, 'user', user_query)
+            
+            # 保存AI回答到对话历史
+            sources_json = json.dumps(response.get('sources', [])) if response.get('sources') else None
+            save_conversation_message(DB_PATH, conversation_id, 'assistant', response.get('answer', ''), sources_json)
+        
+        # 添加会话ID到响应
+        response['conversation_id'] = conversation_id
+        
+    except Exception as e:
+        print(f"保存对话历史出错: {str(e)}")
+        # 添加警告但继续返回查询结果
+        response['warning'] = "Failed to save conversation history"
+
+def _finish_query(response, trace, start, include_timings):
+    """记录请求耗时，并按需在响应中附加各阶段耗时"""
+    duration = time.perf_counter() - start
+    observe_request('query', duration)
+    if include_timings:
+        response['timings'] = dict(trace, total=round(duration, 6))
 
 @app.route('/query', methods=['POST'])
 def route_query():
     """查询文档内容并返回带有源信息的回答"""
+    start = time.perf_counter()
+    trace = start_trace()
     try:
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({"error": "please provide a request body"}), 400
-            
-        user_query = data.get('query')
-        kb_id = data.get('knowledge_base_id')
-        conversation_id = data.get('conversation_id')
-        
-        if not user_query:
-            return jsonify({"error": "please provide a query"}), 400
+        params, error, status = _parse_query_request(request.get_json())
+        if error:
+            return jsonify(error), status
         
-        # 验证知识库ID (如果提供)
-        if kb_id is not None:
-            try:
-                kb_id = int(kb_id)
-                conn = get_db_connection(DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM knowledge_bases WHERE id = ?", (kb_id,))
-                kb_exists = cursor.fetchone() is not None
-                
-                # 检查知识库是否包含文档
-                cursor.execute("SELECT COUNT(*) FROM documents WHERE knowledge_base_id = ?", (kb_id,))
-                doc_count = cursor.fetchone()[0]
-                conn.close()
-                
-                if not kb_exists:
-                    return jsonify({"error": "knowledge base not found", "detail": f"Knowledge base ID {kb_id} does not exist"}), 404
-                
-                if doc_count == 0:
-                    return jsonify({
-                        "error": "knowledge base is empty", 
-                        "detail": f"Knowledge base ID {kb_id} has no documents. Please upload documents first."
-                    }), 400
-            except ValueError:
-                return jsonify({"error": "invalid knowledge base id"}), 400
+        # 验证知识库ID和对话ID (如果提供)
+        failure = _check_query_knowledge_base(params["kb_id"]) or _check_query_conversation(params["conversation_id"])
+        if failure:
+            return jsonify(failure[0]), failure[1]
         
-        # 验证对话ID (如果提供)
-        if conversation_id is not None:
-            try:
-                conversation_id = int(conversation_id)
-                conversation = get_conversation(DB_PATH, conversation_id)
-                if not conversation:
-                    return jsonify({"error": "conversation not found", "detail": f"Conversation ID {conversation_id} does not exist"}), 404
-            except ValueError:
-                return jsonify({"error": "invalid conversation id"}), 400
+        # 流式模式：以NDJSON逐行返回来源和回答片段
+        if params["stream"]:
+            return Response(
+                stream_with_context(_stream_query_events(params["query"], params["kb_id"], params["conversation_id"],
+                                                         params["paraphrase"], params["paraphrase_timeout"],
+                                                         params["timings"], trace, start)),
+                mimetype='application/x-ndjson'
+            )
         
         # 执行查询获取回答
-        response = perform_query(user_query, kb_id)
+        response = perform_query(params["query"], params["kb_id"], params["paraphrase"], params["paraphrase_timeout"])
         
         # 检查是否查询失败
         if response and "error" in response:
@@ -351,22 +568,8 @@ def route_query():
             return jsonify(response), 400
             
         # 处理对话历史
-        if conversation_id:
-            try:
-                # 保存用户问题到对话历史
-                save_conversation_message(DB_PATH, conversation_id, 'user', user_query)
-                
-                # 保存AI回答到对话历史
-                sources_json = json.dumps(response.get('sources', [])) if response.get('sources') else None
-                save_conversation_message(DB_PATH, conversation_id, 'assistant', response.get('answer', ''), sources_json)
-                
-                # 添加会话ID到响应
-                response['conversation_id'] = conversation_id
-                
-            except Exception as e:
-                print(f"保存对话历史出错: {str(e)}")
-                # 添加警告但继续返回查询结果
-                response['warning'] = "Failed to save conversation history"
+        _save_query_history(params["conversation_id"], params["query"], response)
+        _finish_query(response, trace, start, params["timings"])
         
         # 确保响应可以正确序列化为JSON
         return jsonify(response), 200
@@ -376,6 +579,28 @@ def route_query():
         traceback.print_exc()
         return jsonify({"error": f"error with query", "detail": str(e)}), 500
 
+def _stream_query_events(user_query, kb_id, conversation_id, paraphrase=True, paraphrase_timeout=None,
+                         include_timings=False, trace=None, start=None):
+    """将stream_query产生的事件序列化为NDJSON，并在生成结束后保存对话历史"""
+    # 生成器在视图函数返回后才执行，继续记录到同一个请求的阶段耗时中
+    trace = start_trace(trace)
+    start = time.perf_counter() if start is None else start
+    for event in stream_query(user_query, kb_id, paraphrase, paraphrase_timeout):
+        if event.get("type") == "done":
+            _save_query_history(conversation_id, user_query, event)
+            _finish_query(event, trace, start, include_timings)
+        yield json.dumps(event, ensure_ascii=False) + "\n"
+
+@app.route('/metrics', methods=['GET'])
+def route_metrics():
+    """以Prometheus文本格式导出各阶段耗时直方图和缓存统计"""
+    caches = {
+        "answer": get_answer_cache_stats(),
+        "embedding": get_embedding_cache_stats(),
+        "paraphrase": get_paraphrase_cache_stats()
+    }
+    return Response(render_metrics() + render_cache_metrics(caches), mimetype='text/plain; version=0.0.4')
+
 # 添加一个新的路由，简化文档上传
 @app.route('/upload/<int:kb_id>', methods=['POST'])
 def upload_document_simple(kb_id):
@@ -402,52 +627,35 @@ def upload_document_simple(kb_id):
         }), 404
     
     print(f"正在处理文件上传: {file.filename} 到知识库 {kb_id}")
-    success, doc_id, message = embed_document(file, kb_id)
-
-    if success:
-        # Check if the file was saved but content extraction failed
-        if "content extraction failed" in message:
-            return jsonify({
-                "warning": "File saved but content cannot be searched",
-                "message": "The file was saved to the knowledge base but could not be processed for search. It may be corrupted or password-protected.",
-                "document_id": doc_id,
-                "technical_details": message
-            }), 201  # 201 Created - since we did create a record, just with limitations
-        else:
-            return jsonify({
-                "message": "success with embedding",
-                "document_id": doc_id
-            }), 200
-    else:
-        return jsonify({
-            "error": message
-        }), 400
+    return _queue_ingestion(file, kb_id)
 
 # ================ 对话历史API ================
+# 以下函数只处理参数校验和数据库操作，返回 (响应内容, HTTP状态码)，Flask和ASGI两种服务模式共用
 
-@app.route('/conversations', methods=['GET'])
-def list_conversations():
-    """获取对话历史列表，可按知识库筛选"""
-    kb_id = request.args.get('knowledge_base_id')
-    limit = request.args.get('limit', 20, type=int)
-    offset = request.args.get('offset', 0, type=int)
+def _list_conversations(args):
+    """获取对话历史列表（按更新时间倒序），可按知识库筛选；支持cursor键集分页，offset仍然可用"""
+    limit, after, error = _parse_page_params(args.get('limit'), args.get('cursor'), 20)
+    if error:
+        return error, 400
     
+    kb_id = args.get('knowledge_base_id')
+    try:
+        offset = int(args.get('offset', 0))
+    except ValueError:
+        offset = 0
     try:
         if kb_id:
             kb_id = int(kb_id)
     except ValueError:
-        return jsonify({"error": "invalid knowledge base id"}), 400
+        return {"error": "invalid knowledge base id"}, 400
     
-    conversations = get_conversations(DB_PATH, kb_id, limit, offset)
-    return jsonify({"conversations": conversations})
+    conversations, next_cursor = get_conversations(DB_PATH, kb_id, limit, offset, after)
+    return {"conversations": conversations, "next_cursor": next_cursor}, 200
 
-@app.route('/conversations', methods=['POST'])
-def create_new_conversation():
+def _create_conversation(data):
     """创建新的对话"""
-    data = request.get_json()
-    
     if not data or 'title' not in data:
-        return jsonify({"error": "title is required"}), 400
+        return {"error": "title is required"}, 400
     
     title = data.get('title')
     kb_id = data.get('knowledge_base_id')
@@ -456,51 +664,42 @@ def create_new_conversation():
         # 如果提供了知识库ID，验证其存在性
         if kb_id:
             kb_id = int(kb_id)
-            conn = get_db_connection(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM knowledge_bases WHERE id = ?", (kb_id,))
-            kb = cursor.fetchone()
-            conn.close()
-            
-            if not kb:
-                return jsonify({"error": "knowledge base not found"}), 404
+            if not check_knowledge_base_exists(DB_PATH, kb_id):
+                return {"error": "knowledge base not found"}, 404
     except ValueError:
-        return jsonify({"error": "invalid knowledge base id"}), 400
+        return {"error": "invalid knowledge base id"}, 400
     
     conversation_id = create_conversation(DB_PATH, title, kb_id)
     
-    return jsonify({
+    return {
         "message": "conversation created",
         "conversation_id": conversation_id
-    }), 201
+    }, 201
 
-@app.route('/conversations/<int:conversation_id>', methods=['GET'])
-def get_conversation_detail(conversation_id):
-    """获取单个对话的详细信息及其消息历史"""
-    conversation = get_conversation(DB_PATH, conversation_id)
+def _get_conversation_detail(conversation_id, args):
+    """获取单个对话的详细信息及其消息历史（消息按时间升序；提供limit或cursor时键集分页，否则返回全部消息）"""
+    limit, after, error = _parse_page_params(args.get('limit'), args.get('cursor'), None)
+    if error:
+        return error, 400
+    
+    conversation = get_conversation(DB_PATH, conversation_id, limit, after)
     
     if not conversation:
-        return jsonify({"error": "conversation not found"}), 404
+        return {"error": "conversation not found"}, 404
     
-    return jsonify(conversation)
+    return conversation, 200
 
-@app.route('/conversations/<int:conversation_id>', methods=['DELETE'])
-def delete_conversation_by_id(conversation_id):
+def _delete_conversation(conversation_id):
     """删除对话历史"""
-    success = delete_conversation(DB_PATH, conversation_id)
+    if not delete_conversation(DB_PATH, conversation_id):
+        return {"error": "conversation not found or could not be deleted"}, 404
     
-    if not success:
-        return jsonify({"error": "conversation not found or could not be deleted"}), 404
-    
-    return jsonify({"message": "conversation deleted"})
+    return {"message": "conversation deleted"}, 200
 
-@app.route('/conversations/<int:conversation_id>/messages', methods=['POST'])
-def add_conversation_message(conversation_id):
+def _add_conversation_message(conversation_id, data):
     """向对话中添加新消息"""
-    data = request.get_json()
-    
     if not data or 'content' not in data or 'message_type' not in data:
-        return jsonify({"error": "content and message_type are required"}), 400
+        return {"error": "content and message_type are required"}, 400
     
     content = data.get('content')
     message_type = data.get('message_type')
@@ -508,12 +707,11 @@ def add_conversation_message(conversation_id):
     
     # 验证消息类型
     if message_type not in ['user', 'assistant']:
-        return jsonify({"error": "message_type must be 'user' or 'assistant'"}), 400
+        return {"error": "message_type must be 'user' or 'assistant'"}, 400
     
     # 验证会话是否存在
-    conversation = get_conversation(DB_PATH, conversation_id)
-    if not conversation:
-        return jsonify({"error": "conversation not found"}), 404
+    if not check_conversation_exists(DB_PATH, conversation_id):
+        return {"error": "conversation not found"}, 404
     
     # 如果提供了sources且不是字符串，转换为JSON字符串
     if sources and not isinstance(sources, str):
@@ -522,10 +720,40 @@ def add_conversation_message(conversation_id):
     # 保存消息
     message_id = save_conversation_message(DB_PATH, conversation_id, message_type, content, sources)
     
-    return jsonify({
+    return {
         "message": "message added",
         "message_id": message_id
-    }), 201
+    }, 201
+
+@app.route('/conversations', methods=['GET'])
+def list_conversations():
+    """获取对话历史列表"""
+    body, status = _list_conversations(request.args)
+    return jsonify(body), status
+
+@app.route('/conversations', methods=['POST'])
+def create_new_conversation():
+    """创建新的对话"""
+    body, status = _create_conversation(request.get_json(silent=True))
+    return jsonify(body), status
+
+@app.route('/conversations/<int:conversation_id>', methods=['GET'])
+def get_conversation_detail(conversation_id):
+    """获取单个对话的详细信息及其消息历史"""
+    body, status = _get_conversation_detail(conversation_id, request.args)
+    return jsonify(body), status
+
+@app.route('/conversations/<int:conversation_id>', methods=['DELETE'])
+def delete_conversation_by_id(conversation_id):
+    """删除对话历史"""
+    body, status = _delete_conversation(conversation_id)
+    return jsonify(body), status
+
+@app.route('/conversations/<int:conversation_id>/messages', methods=['POST'])
+def add_conversation_message(conversation_id):
+    """向对话中添加新消息"""
+    body, status = _add_conversation_message(conversation_id, request.get_json(silent=True))
+    return jsonify(body), status
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=8080, debug=True)
\ No newline at end of file
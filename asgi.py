@@ -0,0 +1,148 @@
+"""
+ASGI服务入口：查询和对话接口以异步方式处理，其余接口交给原有的Flask应用
+
+运行方式:
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+"""
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from a2wsgi import WSGIMiddleware
+
+from app import app as flask_app
+from app import _parse_query_request, _check_query_knowledge_base, _check_query_conversation, _save_query_history, _finish_query
+from app import _list_conversations, _create_conversation, _get_conversation_detail, _delete_conversation, _add_conversation_message
+from query import aperform_query, astream_query
+from get_vector_db import get_embedding_function
+from ollama_client import close_async_session
+from metrics import span, start_trace
+
+# 由异步应用处理的路径前缀，其余请求转发给Flask
+ASYNC_PATHS = ('/query', '/conversations')
+
+async def _read_json(request: Request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+def _embed_query(user_query):
+    """预先计算查询向量；失败时返回None，由_prepare_query重新计算并报告错误"""
+    try:
+        with span('query_embedding'):
+            return get_embedding_function().embed_query(user_query)
+    except Exception as e:
+        print(f"预先嵌入查询时出错: {str(e)}")
+        return None
+
+async def route_query(request: Request):
+    """查询文档内容并返回带有源信息的回答（异步版本，参数和响应与Flask接口相同）"""
+    start = time.perf_counter()
+    trace = start_trace()
+    try:
+        params, error, status = _parse_query_request(await _read_json(request))
+        if error:
+            return JSONResponse(error, status)
+        user_query = params["query"]
+
+        # 知识库校验、对话查询和查询嵌入互不依赖，在线程池中同时执行
+        kb_failure, conversation_failure, query_embedding = await asyncio.gather(
+            asyncio.to_thread(_check_query_knowledge_base, params["kb_id"]),
+            asyncio.to_thread(_check_query_conversation, params["conversation_id"]),
+            asyncio.to_thread(_embed_query, user_query)
+        )
+        failure = kb_failure or conversation_failure
+        if failure:
+            return JSONResponse(failure[0], failure[1])
+
+        args = (user_query, params["kb_id"], params["paraphrase"], params["paraphrase_timeout"], query_embedding)
+
+        # 流式模式：以NDJSON逐行返回来源和回答片段
+        if params["stream"]:
+            return StreamingResponse(_stream_query_events(args, params["conversation_id"], params["timings"], trace, start),
+                                     media_type='application/x-ndjson')
+
+        response = await aperform_query(*args)
+        if response and "error" in response:
+            return JSONResponse(response, 400)
+
+        await asyncio.to_thread(_save_query_history, params["conversation_id"], user_query, response)
+        _finish_query(response, trace, start, params["timings"])
+        return JSONResponse(response)
+    except Exception as e:
+        print(f"查询处理错误: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return JSONResponse({"error": f"error with query", "detail": str(e)}, 500)
+
+async def _stream_query_events(args, conversation_id, include_timings, trace, start):
+    """将astream_query产生的事件序列化为NDJSON，并在生成结束后保存对话历史"""
+    start_trace(trace)
+    async for event in astream_query(*args):
+        if event.get("type") == "done":
+            await asyncio.to_thread(_save_query_history, conversation_id, args[0], event)
+            _finish_query(event, trace, start, include_timings)
+        yield json.dumps(event, ensure_ascii=False) + "\n"
+
+# ================ 对话历史API ================
+# 参数校验和数据库操作与Flask共用，在线程池中执行
+
+async def list_conversations(request: Request):
+    """获取对话历史列表"""
+    return JSONResponse(*await asyncio.to_thread(_list_conversations, request.query_params))
+
+async def create_new_conversation(request: Request):
+    """创建新的对话"""
+    data = await _read_json(request)
+    return JSONResponse(*await asyncio.to_thread(_create_conversation, data))
+
+async def get_conversation_detail(request: Request):
+    """获取单个对话的详细信息及其消息历史"""
+    return JSONResponse(*await asyncio.to_thread(_get_conversation_detail, request.path_params['conversation_id'],
+                                                 request.query_params))
+
+async def delete_conversation_by_id(request: Request):
+    """删除对话历史"""
+    return JSONResponse(*await asyncio.to_thread(_delete_conversation, request.path_params['conversation_id']))
+
+async def add_conversation_message(request: Request):
+    """向对话中添加新消息"""
+    data = await _read_json(request)
+    return JSONResponse(*await asyncio.to_thread(_add_conversation_message, request.path_params['conversation_id'], data))
+
+@asynccontextmanager
+async def lifespan(_app):
+    yield
+    # 关闭共享的Ollama连接
+    await close_async_session()
+
+async_app = Starlette(
+    routes=[
+        Route('/query', route_query, methods=['POST']),
+        Route('/conversations', list_conversations, methods=['GET']),
+        Route('/conversations', create_new_conversation, methods=['POST']),
+        Route('/conversations/{conversation_id:int}', get_conversation_detail, methods=['GET']),
+        Route('/conversations/{conversation_id:int}', delete_conversation_by_id, methods=['DELETE']),
+        Route('/conversations/{conversation_id:int}/messages', add_conversation_message, methods=['POST']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan
+)
+wsgi_app = WSGIMiddleware(flask_app)
+
+async def app(scope, receive, send):
+    """按路径分发请求：查询和对话接口由异步应用处理，其余接口由Flask处理"""
+    path = scope.get("path", "")
+    if scope["type"] == "http" and not any(path == prefix or path.startswith(prefix + '/') for prefix in ASYNC_PATHS):
+        await wsgi_app(scope, receive, send)
+    else:
+        # 生命周期事件交给异步应用，以便关闭共享的Ollama连接
+        await async_app(scope, receive, send)
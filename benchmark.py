@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+后端离线基准测试
+
+在当前进程中启动mock_ollama.py，并在子进程中启动app.py，使用独立的数据库、向量库和文档目录；
+然后在每种语料规模和并发数下测量/embed、/query和会话接口的吞吐量与延迟分位数。
+结果写入JSON文件，便于比较不同提交的运行结果（见 --compare）。
+
+示例:
+    python benchmark.py --corpus-sizes 1,4 --concurrency 1,4 --queries 20
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import mock_ollama
+
+REPO_DIR = Path(__file__).resolve().parent
+DEFAULT_DOCS_DIR = REPO_DIR / "data" / "docs"
+DEFAULT_OUTPUT_DIR = REPO_DIR / "benchmark_results"
+
+QUESTIONS = [
+    "What is the main contribution of this document?",
+    "Which methods are used for 3D scene reconstruction?",
+    "How is the approach evaluated?",
+    "What datasets are mentioned?",
+    "What are the limitations of the proposed method?",
+    "Summarize the results section.",
+    "What is the timeline of the project?",
+    "Which related work is discussed?",
+]
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(sorted_values, fraction):
+    """计算分位数，在相邻两个排名之间线性插值"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+def summarize(name, corpus_size, concurrency, latencies, errors, wall_seconds):
+    values = sorted(latencies)
+    completed = len(values)
+    return {
+        "endpoint": name,
+        "corpus_size": corpus_size,
+        "concurrency": concurrency,
+        "requests": completed + errors,
+        "errors": errors,
+        "wall_seconds": round(wall_seconds, 4),
+        "throughput_rps": round(completed / wall_seconds, 3) if wall_seconds > 0 else None,
+        "mean_ms": round(sum(values) / completed * 1000, 2) if completed else None,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2) if completed else None,
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2) if completed else None,
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2) if completed else None,
+    }
+
+def run_load(fn, count, concurrency):
+    """以给定并发数对range(count)中的每个i调用fn(i)；fn返回 {名称: 秒数} 字典，失败时抛出异常"""
+    samples = {}
+    errors = {}
+
+    def timed(i):
+        try:
+            return fn(i), None
+        except Exception as e:
+            return None, e
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for result, error in executor.map(timed, range(count)):
+            if error is not None:
+                name = getattr(error, "endpoint", "unknown")
+                errors[name] = errors.get(name, 0) + 1
+                print(f"  请求失败: {error}")
+                continue
+            for name, seconds in result.items():
+                samples.setdefault(name, []).append(seconds)
+    return samples, errors, time.perf_counter() - start
+
+class RequestFailed(Exception):
+    def __init__(self, endpoint, message):
+        super().__init__(f"{endpoint}: {message}")
+        self.endpoint = endpoint
+
+def timed_request(session, endpoint, method, url, expected=(200,), **kwargs):
+    start = time.perf_counter()
+    response = session.request(method, url, timeout=600, **kwargs)
+    seconds = time.perf_counter() - start
+    if response.status_code not in expected:
+        raise RequestFailed(endpoint, f"HTTP {response.status_code} {response.text[:200]}")
+    return response, seconds
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=max(args.concurrency) * 2))
+        self.workdir = Path(tempfile.mkdtemp(prefix="rag-benchmark-"))
+        self.mock = None
+        self.server = None
+        self.base_url = None
+        self.documents = sorted(Path(args.docs_dir).glob("*.pdf"))
+        if not self.documents:
+            sys.exit(f"{args.docs_dir} 中没有PDF文件")
+
+    # ---------------- 服务启动与停止 ----------------
+
+    def start(self):
+        self.mock = mock_ollama.start_server(config=mock_ollama.config_from_args(self.args))
+        ollama_url = f"http://127.0.0.1:{self.mock.server_address[1]}"
+
+        port = free_port()
+        self.base_url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ)
+        env.update({
+            "DB_PATH": str(self.workdir / "documents.db"),
+            "CHROMA_PATH": str(self.workdir / "chroma"),
+            "DOCS_STORAGE": str(self.workdir / "documents"),
+            "TEMP_FOLDER": str(self.workdir / "_temp"),
+            "OLLAMA_BASE_URL": ollama_url,
+            "LLM_MODEL": "mock-llm",
+            "TEXT_EMBEDDING_MODEL": "mock-embed",
+            "ANSWER_CACHE_ENABLED": "1" if self.args.answer_cache else "0",
+            "EMBEDDING_CACHE_ENABLED": "1" if self.args.embedding_cache else "0",
+            "PARAPHRASE_CACHE_ENABLED": "1" if self.args.paraphrase_cache else "0",
+            "PYTHONUNBUFFERED": "1",
+        })
+        self.server_log = open(self.workdir / "server.log", "w")
+        if self.args.server == "asgi":
+            command = [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port)]
+        else:
+            launcher = f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True, use_reloader=False)"
+            command = [sys.executable, "-c", launcher]
+        self.server = subprocess.Popen(
+            command,
+            cwd=REPO_DIR, env=env, stdout=self.server_log, stderr=subprocess.STDOUT
+        )
+
+        deadline = time.time() + self.args.startup_timeout
+        while time.time() < deadline:
+            if self.server.poll() is not None:
+                sys.exit(f"app.py在启动过程中退出，详见 {self.workdir / 'server.log'}")
+            try:
+                self.session.get(f"{self.base_url}/knowledge-bases", timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        sys.exit(f"app.py未在 {self.args.startup_timeout} 秒内启动")
+
+    def stop(self):
+        if self.server:
+            self.server.terminate()
+            try:
+                self.server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.server.kill()
+            self.server_log.close()
+        if self.mock:
+            self.mock.shutdown()
+        if self.args.keep_workdir:
+            print(f"已保留工作目录 {self.workdir}")
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    # ---------------- 测试场景 ----------------
+
+    def create_knowledge_base(self, name):
+        response, _ = timed_request(
+            self.session, "knowledge_base_create", "POST", f"{self.base_url}/knowledge-bases",
+            expected=(201,), json={"name": name}
+        )
+        return response.json()["knowledge_base_id"]
+
+    def corpus_file(self, kb_id, index):
+        """
+        返回知识库第index个语料文档的文件名和内容
+
+        在末尾追加一行PDF注释，使每次上传的内容都不相同，
+        避免被当作重复文件跳过，保证每次上传都经过文本提取
+        """
+        source = self.documents[index % len(self.documents)]
+        content = source.read_bytes() + f"\n%benchmark-{kb_id}-{index}\n".encode("ascii")
+        return f"{source.stem}-{index}.pdf", content
+
+    def embed(self, kb_id, index):
+        filename, content = self.corpus_file(kb_id, index)
+        response, submit_seconds = timed_request(
+            self.session, "embed", "POST", f"{self.base_url}/embed", expected=(200, 202),
+            files={"file": (filename, content, "application/pdf")},
+            data={"knowledge_base_id": str(kb_id)}
+        )
+        job_id = response.json().get("job_id")
+        if not job_id:
+            return {"embed_submit": submit_seconds}
+
+        start = time.perf_counter() - submit_seconds
+        while True:
+            job, _ = timed_request(self.session, "embed_job", "GET", f"{self.base_url}/jobs/{job_id}")
+            status = job.json()["status"]
+            if status == "done":
+                return {"embed_submit": submit_seconds, "embed_job": time.perf_counter() - start}
+            if status == "failed":
+                raise RequestFailed("embed_job", job.json().get("message"))
+            time.sleep(self.args.poll_interval)
+
+    def query(self, kb_id, index):
+        question = QUESTIONS[index % len(QUESTIONS)]
+        _, seconds = timed_request(
+            self.session, "query", "POST", f"{self.base_url}/query",
+            json={"query": question, "knowledge_base_id": kb_id, "paraphrase": self.args.paraphrase}
+        )
+        return {"query": seconds}
+
+    def conversation(self, kb_id, index):
+        timings = {}
+        response, timings["conversation_create"] = timed_request(
+            self.session, "conversation_create", "POST", f"{self.base_url}/conversations",
+            expected=(201,), json={"title": f"benchmark {index}", "knowledge_base_id": kb_id}
+        )
+        conversation_id = response.json()["conversation_id"]
+        message_seconds = 0.0
+        for message_type in ("user", "assistant"):
+            _, seconds = timed_request(
+                self.session, "conversation_message", "POST",
+                f"{self.base_url}/conversations/{conversation_id}/messages",
+                expected=(201,), json={"message_type": message_type, "content": QUESTIONS[index % len(QUESTIONS)]}
+            )
+            message_seconds += seconds
+        timings["conversation_message"] = message_seconds / 2
+        _, timings["conversation_list"] = timed_request(
+            self.session, "conversation_list", "GET", f"{self.base_url}/conversations",
+            params={"knowledge_base_id": kb_id}
+        )
+        _, timings["conversation_get"] = timed_request(
+            self.session, "conversation_get", "GET", f"{self.base_url}/conversations/{conversation_id}"
+        )
+        return timings
+
+    def run(self):
+        results = []
+        for corpus_size in self.args.corpus_sizes:
+            for concurrency in self.args.concurrency:
+                print(f"corpus_size={corpus_size} concurrency={concurrency}")
+                kb_id = self.create_knowledge_base(f"benchmark-{corpus_size}-{concurrency}")
+
+                scenarios = (
+                    (lambda i: self.embed(kb_id, i), corpus_size),
+                    (lambda i: self.query(kb_id, i), self.args.queries),
+                    (lambda i: self.conversation(kb_id, i), self.args.conversations),
+                )
+                for fn, count in scenarios:
+                    samples, errors, wall_seconds = run_load(fn, count, concurrency)
+                    for name in sorted(set(samples) | set(errors)):
+                        summary = summarize(name, corpus_size, concurrency, samples.get(name, []),
+                                            errors.get(name, 0), wall_seconds)
+                        results.append(summary)
+                        print(f"  {name:22s} n={summary['requests']:4d} err={summary['errors']:3d} "
+                              f"rps={summary['throughput_rps']} p50={summary['p50_ms']}ms "
+                              f"p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms")
+        return results
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit or None, dirty
+    except OSError:
+        return None, None
+
+def compare(current, baseline_path):
+    """打印相对于之前结果文件的p50/p95变化"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r["endpoint"], r["corpus_size"], r["concurrency"]): r for r in baseline["results"]}
+
+    print(f"\n与 {baseline_path} ({(baseline.get('commit') or 'unknown')[:10]}) 比较")
+    for result in current["results"]:
+        key = (result["endpoint"], result["corpus_size"], result["concurrency"])
+        before = previous.get(key)
+        if not before:
+            continue
+        changes = []
+        for field in ("p50_ms", "p95_ms", "throughput_rps"):
+            if before.get(field) and result.get(field) is not None:
+                changes.append(f"{field} {before[field]} -> {result[field]} ({(result[field] / before[field] - 1) * 100:+.1f}%)")
+        print(f"  {key[0]:22s} corpus={key[1]} conc={key[2]}: " + ", ".join(changes))
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="使用模拟的Ollama服务对后端进行基准测试")
+    parser.add_argument("--docs-dir", default=str(DEFAULT_DOCS_DIR), help="PDF语料所在目录")
+    parser.add_argument("--corpus-sizes", type=parse_int_list, default=[1, 4], help="每个知识库的文档数量，逗号分隔")
+    parser.add_argument("--concurrency", type=parse_int_list, default=[1, 4], help="并发客户端数量，逗号分隔")
+    parser.add_argument("--queries", type=int, default=20, help="每轮的查询次数")
+    parser.add_argument("--conversations", type=int, default=20, help="每轮的会话往返次数")
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask",
+                        help="使用Flask多线程服务器运行app.py，或使用uvicorn运行asgi.py")
+    parser.add_argument("--paraphrase", action=argparse.BooleanOptionalAction, default=True, help="是否生成查询改写")
+    parser.add_argument("--answer-cache", action="store_true", help="启用答案缓存")
+    parser.add_argument("--embedding-cache", action="store_true", help="启用嵌入缓存")
+    parser.add_argument("--paraphrase-cache", action="store_true", help="启用查询改写缓存")
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="轮询入库任务的间隔（秒）")
+    parser.add_argument("--startup-timeout", type=float, default=120, help="等待app.py启动的最长时间（秒）")
+    parser.add_argument("--output", help="结果文件（默认: benchmark_results/<提交>-<时间>.json）")
+    parser.add_argument("--compare", help="用于比较的之前的结果文件")
+    parser.add_argument("--keep-workdir", action="store_true", help="保留临时数据库和服务日志")
+    mock_ollama.add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    commit, dirty = git_revision()
+    benchmark = Benchmark(args)
+    try:
+        benchmark.start()
+        results = benchmark.run()
+    finally:
+        benchmark.stop()
+
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+
+    output = Path(args.output) if args.output else DEFAULT_OUTPUT_DIR / (
+        f"{(commit or 'unknown')[:10]}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n结果已写入 {output}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    main()
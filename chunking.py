@@ -0,0 +1,177 @@
+import os
+import re
+from typing import List, Dict, Any, Tuple, Optional
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+# 支持的分块策略：
+#   character - 按字符数递归分割
+#   token     - 按估算的token数递归分割
+#   sentence  - 按句子边界组合成块
+#   page      - 每页一个块，超长页面再按字符数分割
+CHUNK_STRATEGIES = ('character', 'token', 'sentence', 'page')
+
+# 使用环境变量配置默认值；token策略的大小单位为token，其余为字符
+DEFAULT_CHUNK_STRATEGY = os.getenv('CHUNK_STRATEGY', 'character')
+DEFAULT_CHUNK_SIZES = {
+    'character': int(os.getenv('CHUNK_SIZE', '1500')),
+    'token': int(os.getenv('TOKEN_CHUNK_SIZE', '350')),
+    'sentence': int(os.getenv('CHUNK_SIZE', '1500')),
+    'page': int(os.getenv('PAGE_CHUNK_MAX_SIZE', '6000'))
+}
+DEFAULT_CHUNK_OVERLAPS = {
+    'character': int(os.getenv('CHUNK_OVERLAP', '150')),
+    'token': int(os.getenv('TOKEN_CHUNK_OVERLAP', '40')),
+    'sentence': int(os.getenv('CHUNK_OVERLAP', '150')),
+    'page': 0
+}
+
+# 中日韩字符每个约算一个token，其余按单词和标点计数
+_TOKEN_PATTERN = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯]|\w+|[^\w\s]')
+# 句子结束符（中英文），以及段落分隔
+_SENTENCE_PATTERN = re.compile(r'[^。！？!?.\n]+(?:[。！？!?]+|\.(?=\s|$)|\n+|$)')
+
+def count_tokens(text: str) -> int:
+    """估算文本的token数量（不依赖具体模型的分词器）"""
+    return len(_TOKEN_PATTERN.findall(text or ''))
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """截取文本开头不超过max_tokens个估算token的部分"""
+    if max_tokens <= 0:
+        return ''
+    for index, match in enumerate(_TOKEN_PATTERN.finditer(text or '')):
+        if index == max_tokens:
+            return text[:match.start()].rstrip()
+    return text or ''
+
+def get_chunking_settings(chunk_strategy=None, chunk_size=None, chunk_overlap=None) -> Dict[str, Any]:
+    """
+    返回完整的分块设置，未设置的项使用该策略的默认值
+
+    参数:
+        chunk_strategy: 分块策略
+        chunk_size: 块大小
+        chunk_overlap: 块之间的重叠
+
+    返回:
+        Dict[str, Any]: {"strategy", "chunk_size", "chunk_overlap"}
+    """
+    strategy = chunk_strategy if chunk_strategy in CHUNK_STRATEGIES else DEFAULT_CHUNK_STRATEGY
+    if strategy not in CHUNK_STRATEGIES:
+        strategy = 'character'
+    size = chunk_size or DEFAULT_CHUNK_SIZES[strategy]
+    overlap = chunk_overlap if chunk_overlap is not None else DEFAULT_CHUNK_OVERLAPS[strategy]
+    return {
+        "strategy": strategy,
+        "chunk_size": size,
+        "chunk_overlap": min(overlap, size // 2)
+    }
+
+def validate_chunking_settings(data: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    从请求数据中读取分块设置并校验
+
+    参数:
+        data: 请求JSON，可包含chunk_strategy、chunk_size、chunk_overlap
+
+    返回:
+        tuple: (需要保存的字段, 错误信息)；没有错误时错误信息为None
+    """
+    values = {}
+
+    if 'chunk_strategy' in data:
+        strategy = data.get('chunk_strategy')
+        if strategy is not None and strategy not in CHUNK_STRATEGIES:
+            return {}, f"chunk_strategy must be one of: {', '.join(CHUNK_STRATEGIES)}"
+        values['chunk_strategy'] = strategy
+
+    for field, minimum in (('chunk_size', 1), ('chunk_overlap', 0)):
+        if field in data:
+            value = data.get(field)
+            if value is not None:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    return {}, f"{field} must be an integer"
+                if value < minimum:
+                    return {}, f"{field} must be at least {minimum}"
+            values[field] = value
+
+    size = values.get('chunk_size')
+    overlap = values.get('chunk_overlap')
+    if size is not None and overlap is not None and overlap >= size:
+        return {}, "chunk_overlap must be smaller than chunk_size"
+
+    return values, None
+
+def split_sentences(text: str) -> List[str]:
+    """按中英文句子结束符和换行把文本拆分为句子"""
+    return [sentence.strip() for sentence in _SENTENCE_PATTERN.findall(text) if sentence.strip()]
+
+def _pack_sentences(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """把句子依次放入块中，块之间重叠末尾的若干句子"""
+    fallback = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    chunks = []
+    current = []
+    current_size = 0
+
+    for sentence in split_sentences(text):
+        # 单个句子超过块大小时按字符切开
+        pieces = fallback.split_text(sentence) if len(sentence) > chunk_size else [sentence]
+        for piece in pieces:
+            if current and current_size + len(piece) + 1 > chunk_size:
+                chunks.append(" ".join(current))
+                # 保留末尾不超过chunk_overlap的句子作为下一块的开头
+                overlap = []
+                overlap_size = 0
+                for previous in reversed(current):
+                    if overlap_size + len(previous) + 1 > chunk_overlap:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_size += len(previous) + 1
+                current = overlap
+                current_size = overlap_size
+            current.append(piece)
+            current_size += len(piece) + 1
+
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def get_text_splitter(settings: Dict[str, Any]):
+    """为character、token和page策略创建文本分割器"""
+    if settings["strategy"] == 'token':
+        return RecursiveCharacterTextSplitter(
+            chunk_size=settings["chunk_size"],
+            chunk_overlap=settings["chunk_overlap"],
+            length_function=count_tokens
+        )
+    return RecursiveCharacterTextSplitter(
+        chunk_size=settings["chunk_size"],
+        chunk_overlap=settings["chunk_overlap"]
+    )
+
+def split_page(page: Document, settings: Dict[str, Any], splitter=None) -> List[Document]:
+    """
+    按分块设置分割一个页面
+
+    参数:
+        page: 页面文档
+        settings: get_chunking_settings返回的分块设置
+        splitter: 可复用的文本分割器 (可选)
+
+    返回:
+        List[Document]: 文本块，继承页面的元数据
+    """
+    strategy = settings["strategy"]
+
+    if strategy == 'sentence':
+        texts = _pack_sentences(page.page_content, settings["chunk_size"], settings["chunk_overlap"])
+        return [Document(page_content=text, metadata=dict(page.metadata)) for text in texts]
+
+    if strategy == 'page' and len(page.page_content) <= settings["chunk_size"]:
+        return [Document(page_content=page.page_content, metadata=dict(page.metadata))]
+
+    splitter = splitter or get_text_splitter(settings)
+    return splitter.split_documents([page])
@@ -0,0 +1,135 @@
+import os
+from typing import List, Dict, Any, Optional
+
+from langchain_core.documents import Document
+
+from chunking import count_tokens, truncate_to_tokens, split_sentences
+from keyword_index import tokenize
+
+# 使用环境变量配置
+# 发送给语言模型的上下文token预算（估算值，不含问题和提示模板）
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '2000'))
+# 按模型覆盖预算，格式为 "model=tokens,model=tokens"，例如 "deepseek-r1:14b=6000,mistral=3000"
+CONTEXT_TOKEN_BUDGETS = os.getenv('CONTEXT_TOKEN_BUDGETS', '')
+# 单个块在上下文中最多占用的token数，超出时只保留与查询最相关的句子
+CONTEXT_CHUNK_TOKEN_LIMIT = int(os.getenv('CONTEXT_CHUNK_TOKEN_LIMIT', '500'))
+# 上下文中最多包含的块数量
+CONTEXT_MAX_CHUNKS = int(os.getenv('CONTEXT_MAX_CHUNKS', '8'))
+# 与已选块的词项Jaccard相似度达到该阈值时视为近似重复
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv('CONTEXT_DEDUP_THRESHOLD', '0.8'))
+
+def _parse_budgets(value: str) -> Dict[str, int]:
+    budgets = {}
+    for item in value.split(','):
+        model, _, tokens = item.partition('=')
+        try:
+            budgets[model.strip()] = int(tokens)
+        except ValueError:
+            continue
+    return budgets
+
+_model_budgets = _parse_budgets(CONTEXT_TOKEN_BUDGETS)
+
+def get_context_budget(model_name: Optional[str] = None) -> int:
+    """返回模型的上下文token预算，未单独配置的模型使用CONTEXT_TOKEN_BUDGET"""
+    return _model_budgets.get(model_name or '', CONTEXT_TOKEN_BUDGET)
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def trim_to_relevant_sentences(text: str, query_terms: set, max_tokens: int) -> str:
+    """
+    只保留块中与查询最相关的句子，使其不超过max_tokens
+
+    句子按包含的查询词数量排序后依次选入，得分相同的靠前句子优先；
+    输出时恢复原文顺序。没有句子能放入时截取开头部分。
+
+    参数:
+        text: 块文本
+        query_terms: 查询词集合
+        max_tokens: token上限
+
+    返回:
+        str: 裁剪后的文本
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    sentences = split_sentences(text)
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (-len(query_terms & set(tokenize(sentences[i]))), i)
+    )
+
+    selected = []
+    used = 0
+    for i in ranked:
+        tokens = count_tokens(sentences[i])
+        if used + tokens <= max_tokens:
+            selected.append(i)
+            used += tokens
+
+    if not selected:
+        return truncate_to_tokens(text, max_tokens)
+    return " ".join(sentences[i] for i in sorted(selected))
+
+def build_context(query: str, docs: List[Document], model_name: Optional[str] = None,
+                  token_budget: Optional[int] = None) -> Dict[str, Any]:
+    """
+    按token预算把重排后的文档打包为提示上下文
+
+    依次处理文档：跳过与已选文档近似重复的块，过长的块裁剪为与查询最相关的句子，
+    预算用完或达到CONTEXT_MAX_CHUNKS时停止。
+
+    参数:
+        query: 用户查询
+        docs: 按相关度排序的文档
+        model_name: 语言模型名称，用于选择预算
+        token_budget: 覆盖预算 (可选)
+
+    返回:
+        Dict[str, Any]: {
+            "context": 上下文文本,
+            "documents": 放入上下文的原始文档,
+            "token_count": 上下文的估算token数,
+            "token_budget": 使用的预算,
+            "duplicates": 被跳过的近似重复块数量
+        }
+    """
+    budget = get_context_budget(model_name) if token_budget is None else token_budget
+    query_terms = set(tokenize(query))
+    parts = []
+    used_docs = []
+    selected_terms = []
+    duplicates = 0
+    token_count = 0
+
+    for doc in docs:
+        remaining = budget - token_count
+        if remaining <= 0 or len(used_docs) >= max(CONTEXT_MAX_CHUNKS, 1):
+            break
+
+        terms = set(tokenize(doc.page_content))
+        if any(_jaccard(terms, previous) >= CONTEXT_DEDUP_THRESHOLD for previous in selected_terms):
+            duplicates += 1
+            continue
+
+        text = trim_to_relevant_sentences(doc.page_content, query_terms, min(CONTEXT_CHUNK_TOKEN_LIMIT, remaining))
+        tokens = count_tokens(text)
+        if not tokens:
+            continue
+
+        parts.append(text)
+        used_docs.append(doc)
+        selected_terms.append(terms)
+        token_count += tokens
+
+    return {
+        "context": "\n\n".join(parts),
+        "documents": used_docs,
+        "token_count": token_count,
+        "token_budget": budget,
+        "duplicates": duplicates
+    }
@@ -1,14 +1,184 @@
+import os
+import json
+import queue
+import base64
 import sqlite3
+import threading
 
-def get_db_connection(db_path):
-    """创建数据库连接并设置row_factory为sqlite3.Row"""
-    conn = sqlite3.connect(db_path)
+# 使用环境变量配置
+# 每个数据库文件保留的空闲连接数量
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+# 数据库被其他连接锁定时的最长等待时间（毫秒）
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+# 每个连接的页缓存大小（KB）
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '20000'))
+# 每个连接缓存的预编译语句数量
+SQLITE_CACHED_STATEMENTS = int(os.getenv('SQLITE_CACHED_STATEMENTS', '256'))
+
+# 列表接口的默认和最大分页大小
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '1000'))
+
+# 数据库路径 -> 空闲连接队列
+_pools = {}
+_pools_lock = threading.Lock()
+
+# (数据库路径, 存储文件名) -> 原始文件名（不存在时为None），文档表写入时清空
+_document_names = {}
+_document_names_lock = threading.Lock()
+# SQLite单条语句的参数数量有限，按批次查询
+_NAME_LOOKUP_BATCH_SIZE = 500
+
+def _open_connection(db_path):
+    """打开一个新连接并设置WAL模式和连接级PRAGMA"""
+    # 连接会在线程之间复用，但同一时间只被一个线程使用
+    conn = sqlite3.connect(
+        db_path,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=SQLITE_CACHED_STATEMENTS
+    )
     conn.row_factory = sqlite3.Row
+    # WAL模式下读写互不阻塞，设置会持久保存在数据库文件中
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL模式下NORMAL已能保证数据库一致性，只在检查点时同步磁盘
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT_MS)}")
+    conn.execute(f"PRAGMA cache_size={-int(SQLITE_CACHE_SIZE_KB)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
+def _get_pool(db_path):
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _pools[db_path] = queue.LifoQueue(maxsize=max(DB_POOL_SIZE, 1))
+        return pool
+
+class PooledConnection:
+    """
+    连接池中的连接：接口与sqlite3.Connection相同，close()时回滚未提交的更改并把连接放回池中
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self.__dict__.get('_conn') is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # 与sqlite3.Connection一致：成功时提交，出错时回滚，不关闭连接
+        return self._conn.__exit__(exc_type, exc_value, traceback)
+
+    def close(self):
+        conn, self._conn = self.__dict__.get('_conn'), None
+        if conn is None:
+            return
+        try:
+            conn.rollback()
+            self._pool.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.close()
+
+    def __del__(self):
+        # 调用方忘记close()时也归还连接
+        try:
+            self.close()
+        except Exception:
+            pass
+
+def get_db_connection(db_path):
+    """
+    从连接池获取数据库连接，row_factory为sqlite3.Row
+
+    连接使用WAL模式、synchronous=NORMAL、busy_timeout和调优后的页缓存；
+    调用close()会把连接放回池中供之后的请求复用。
+    """
+    pool = _get_pool(db_path)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_connection(db_path)
+    return PooledConnection(pool, conn)
+
+def close_db_connections():
+    """关闭所有池中的空闲连接（例如进程退出前）"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+def encode_cursor(row, sort_column):
+    """把一页最后一行的排序列和id编码为不透明的分页游标"""
+    payload = json.dumps([row[sort_column], row['id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    解码分页游标
+
+    返回:
+        tuple: (排序列的值, id)
+
+    异常:
+        ValueError: 游标无效
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if not isinstance(row_id, int):
+            raise ValueError
+        return sort_value, row_id
+    except Exception:
+        raise ValueError("invalid cursor")
+
+def fetch_page(cursor, query, params, limit, sort_column, where=None, descending=True, after=None):
+    """
+    按(sort_column, id)执行键集分页查询
+
+    参数:
+        cursor: 数据库游标
+        query: 不含WHERE和ORDER BY的SELECT语句
+        params: 查询参数
+        limit: 每页记录数
+        sort_column: 排序列，与id一起确定唯一顺序
+        where: 额外的筛选条件 (可选)
+        descending: 是否降序
+        after: decode_cursor返回的上一页位置 (可选)
+
+    返回:
+        tuple: (当前页的记录列表, 下一页的游标或None)
+    """
+    conditions = [where] if where else []
+    params = list(params)
+    if after is not None:
+        conditions.append(f"({sort_column}, id) {'<' if descending else '>'} (?, ?)")
+        params.extend(after)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    direction = "DESC" if descending else "ASC"
+    query += f" ORDER BY {sort_column} {direction}, id {direction} LIMIT ?"
+    # 多读取一行判断是否还有下一页
+    params.append(limit + 1)
+
+    cursor.execute(query, params)
+    rows = [dict(row) for row in cursor.fetchall()]
+    next_cursor = encode_cursor(rows[limit - 1], sort_column) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
 def init_database(db_path):
     """初始化数据库，创建必要的表和添加默认知识库"""
-    conn = sqlite3.connect(db_path)
+    conn = get_db_connection(db_path)
     cursor = conn.cursor()
     
     # 创建知识库表
@@ -17,10 +187,23 @@ def init_database(db_path):
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT NOT NULL,
         description TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        chunk_strategy TEXT,
+        chunk_size INTEGER,
+        chunk_overlap INTEGER
     )
     ''')
     
+    # 添加知识库表中可能缺少的分块设置列
+    cursor.execute("PRAGMA table_info(knowledge_bases)")
+    kb_columns = [info[1] for info in cursor.fetchall()]
+    if 'chunk_strategy' not in kb_columns:
+        cursor.execute("ALTER TABLE knowledge_bases ADD COLUMN chunk_strategy TEXT")
+    if 'chunk_size' not in kb_columns:
+        cursor.execute("ALTER TABLE knowledge_bases ADD COLUMN chunk_size INTEGER")
+    if 'chunk_overlap' not in kb_columns:
+        cursor.execute("ALTER TABLE knowledge_bases ADD COLUMN chunk_overlap INTEGER")
+    
     # 检查文档表中是否存在knowledge_base_id列和extraction_failed列
     cursor.execute("PRAGMA table_info(documents)")
     columns = [info[1] for info in cursor.fetchall()]
@@ -44,6 +227,7 @@ def init_database(db_path):
             metadata TEXT,
             knowledge_base_id INTEGER,
             extraction_failed BOOLEAN DEFAULT 0,
+            content_hash TEXT,
             FOREIGN KEY (knowledge_base_id) REFERENCES knowledge_bases(id)
         )
         ''')
@@ -58,6 +242,77 @@ def init_database(db_path):
         if 'extraction_failed' not in columns:
             # 添加extraction_failed列
             cursor.execute("ALTER TABLE documents ADD COLUMN extraction_failed BOOLEAN DEFAULT 0")
+        
+        if 'content_hash' not in columns:
+            # 添加content_hash列，用于识别重复上传的文件
+            cursor.execute("ALTER TABLE documents ADD COLUMN content_hash TEXT")
+    
+    # 按内容摘要查找重复文件
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents(content_hash)")
+    # 按知识库列出文档（按上传时间排序）
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_kb_upload_date ON documents(knowledge_base_id, upload_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_upload_date ON documents(upload_date)")
+    # 按存储文件名解析旧块的原始文件名
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_stored_filename ON documents(stored_filename)")
+    
+    # 创建对话表和对话消息表
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        knowledge_base_id INTEGER,
+        FOREIGN KEY (knowledge_base_id) REFERENCES knowledge_bases(id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS conversation_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id INTEGER NOT NULL,
+        message_type TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        sources TEXT,
+        FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+    )
+    ''')
+    
+    # 对话列表按更新时间排序，可按知识库筛选；每个对话的消息按时间读取
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations(updated_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_kb_updated_at ON conversations(knowledge_base_id, updated_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation_created_at ON conversation_messages(conversation_id, created_at)")
+    
+    # 创建文档导入任务表
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingestion_jobs (
+        id TEXT PRIMARY KEY,
+        knowledge_base_id INTEGER,
+        original_filename TEXT,
+        stored_filename TEXT,
+        status TEXT NOT NULL,
+        message TEXT,
+        document_id INTEGER,
+        chunk_count INTEGER,
+        chunks_per_second REAL,
+        content_hash TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (knowledge_base_id) REFERENCES knowledge_bases(id)
+    )
+    ''')
+    
+    # 添加导入任务表中可能缺少的列
+    cursor.execute("PRAGMA table_info(ingestion_jobs)")
+    job_columns = [info[1] for info in cursor.fetchall()]
+    if 'chunk_count' not in job_columns:
+        cursor.execute("ALTER TABLE ingestion_jobs ADD COLUMN chunk_count INTEGER")
+    if 'chunks_per_second' not in job_columns:
+        cursor.execute("ALTER TABLE ingestion_jobs ADD COLUMN chunks_per_second REAL")
+    if 'content_hash' not in job_columns:
+        cursor.execute("ALTER TABLE ingestion_jobs ADD COLUMN content_hash TEXT")
+    # 提交上传时按内容摘要查找同一知识库中未完成的任务
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ingestion_jobs_kb_hash ON ingestion_jobs(knowledge_base_id, content_hash)")
     
     # 如果没有知识库，添加默认知识库
     cursor.execute("SELECT COUNT(*) FROM knowledge_bases")
@@ -68,28 +323,134 @@ def init_database(db_path):
     conn.commit()
     conn.close()
 
-def save_document_metadata(db_path, original_filename, stored_filename, file_path, file_size, kb_id=1, extraction_failed=False):
+def save_document_metadata(db_path, original_filename, stored_filename, file_path, file_size, kb_id=1, extraction_failed=False, content_hash=None):
     """保存文档元数据到数据库"""
-    conn = sqlite3.connect(db_path)
+    conn = get_db_connection(db_path)
     cursor = conn.cursor()
     cursor.execute(
-        "INSERT INTO documents (original_filename, stored_filename, file_path, file_size, knowledge_base_id, extraction_failed) VALUES (?, ?, ?, ?, ?, ?)",
-        (original_filename, stored_filename, file_path, file_size, kb_id, 1 if extraction_failed else 0)
+        "INSERT INTO documents (original_filename, stored_filename, file_path, file_size, knowledge_base_id, extraction_failed, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (original_filename, stored_filename, file_path, file_size, kb_id, 1 if extraction_failed else 0, content_hash)
     )
     doc_id = cursor.lastrowid
     conn.commit()
     conn.close()
+    invalidate_document_names()
     return doc_id
 
+def update_document_extraction_status(db_path, doc_id, extraction_failed):
+    """更新文档的内容提取状态"""
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE documents SET extraction_failed = ? WHERE id = ?",
+        (1 if extraction_failed else 0, doc_id)
+    )
+    conn.commit()
+    conn.close()
+
+def delete_document_record(db_path, doc_id):
+    """删除文档元数据记录"""
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+    conn.commit()
+    conn.close()
+    invalidate_document_names()
+
+def invalidate_document_names():
+    """清空存储文件名到原始文件名的进程内映射（文档被添加或删除后调用）"""
+    with _document_names_lock:
+        _document_names.clear()
+
+def get_original_filenames(db_path, stored_filenames):
+    """
+    批量查询存储文件名对应的原始文件名
+
+    结果保存在进程内映射中，之后的查询不再访问数据库；
+    未命中的文件名用一条IN (...)查询批量读取。
+
+    参数:
+        db_path: 数据库路径
+        stored_filenames: 存储文件名列表
+
+    返回:
+        dict: 存储文件名 -> 原始文件名，不包含数据库中不存在的文件名
+    """
+    names = set(name for name in stored_filenames if name)
+    with _document_names_lock:
+        found = {name: _document_names[(db_path, name)] for name in names if (db_path, name) in _document_names}
+    missing = [name for name in names if name not in found]
+
+    if missing:
+        conn = get_db_connection(db_path)
+        try:
+            for i in range(0, len(missing), _NAME_LOOKUP_BATCH_SIZE):
+                batch = missing[i:i + _NAME_LOOKUP_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                rows = conn.execute(
+                    f"SELECT stored_filename, original_filename FROM documents WHERE stored_filename IN ({placeholders})",
+                    batch
+                ).fetchall()
+                found.update({name: None for name in batch})
+                found.update({stored: original for stored, original in rows})
+        finally:
+            conn.close()
+        with _document_names_lock:
+            _document_names.update({(db_path, name): found[name] for name in missing})
+
+    return {name: original for name, original in found.items() if original}
+
+def find_documents_by_hash(db_path, content_hash):
+    """
+    查找内容摘要相同的文档
+    
+    参数:
+        db_path: 数据库路径
+        content_hash: 文件内容的SHA-256摘要
+        
+    返回:
+        list: 文档记录列表，按上传顺序排列
+    """
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT id, knowledge_base_id, stored_filename, file_path, extraction_failed FROM documents WHERE content_hash = ? ORDER BY id ASC",
+        (content_hash,)
+    )
+    documents = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    return documents
+
 def check_knowledge_base_exists(db_path, kb_id):
     """检查知识库是否存在"""
-    conn = sqlite3.connect(db_path)
+    conn = get_db_connection(db_path)
     cursor = conn.cursor()
     cursor.execute("SELECT id FROM knowledge_bases WHERE id = ?", (kb_id,))
     exists = cursor.fetchone() is not None
     conn.close()
     return exists
 
+def get_knowledge_base_chunking(db_path, kb_id):
+    """
+    获取知识库的分块设置
+    
+    参数:
+        db_path: 数据库路径
+        kb_id: 知识库ID
+        
+    返回:
+        dict: 包含chunk_strategy、chunk_size、chunk_overlap的字典（未设置的项为None），知识库不存在时返回None
+    """
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT chunk_strategy, chunk_size, chunk_overlap FROM knowledge_bases WHERE id = ?",
+        (kb_id,)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
 def save_conversation_message(db_path, conversation_id, message_type, content, sources=None):
     """
     保存对话消息到数据库
@@ -149,16 +510,27 @@ def create_conversation(db_path, title, kb_id=None):
     conn.close()
     return conversation_id
 
-def get_conversation(db_path, conversation_id):
+def check_conversation_exists(db_path, conversation_id):
+    """检查对话是否存在"""
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM conversations WHERE id = ?", (conversation_id,))
+    exists = cursor.fetchone() is not None
+    conn.close()
+    return exists
+
+def get_conversation(db_path, conversation_id, limit=None, after=None):
     """
-    获取单个对话的详细信息和所有消息
+    获取单个对话的详细信息和消息（按时间升序）
     
     参数:
         db_path: 数据库路径
         conversation_id: 对话ID
+        limit: 返回的最大消息数 (可选)，未提供时返回所有消息
+        after: decode_cursor返回的上一页位置 (可选)
         
     返回:
-        dict: 包含对话详情和消息列表的字典
+        dict: 包含对话详情、消息列表和messages_next_cursor（没有更多消息时为None）的字典
     """
     conn = get_db_connection(db_path)
     cursor = conn.cursor()
@@ -174,62 +546,97 @@ def get_conversation(db_path, conversation_id):
         conn.close()
         return None
     
-    # 获取该对话的所有消息
-    cursor.execute(
-        "SELECT * FROM conversation_messages WHERE conversation_id = ? ORDER BY created_at ASC",
-        (conversation_id,)
-    )
-    messages = [dict(row) for row in cursor.fetchall()]
+    # 获取该对话的消息
+    if limit is None:
+        cursor.execute(
+            "SELECT * FROM conversation_messages WHERE conversation_id = ? ORDER BY created_at ASC, id ASC",
+            (conversation_id,)
+        )
+        messages = [dict(row) for row in cursor.fetchall()]
+        next_cursor = None
+    else:
+        messages, next_cursor = fetch_page(
+            cursor, "SELECT * FROM conversation_messages", [conversation_id], limit, 'created_at',
+            where="conversation_id = ?", descending=False, after=after
+        )
     
     # 转换为字典
     conversation_dict = dict(conversation)
     conversation_dict['messages'] = messages
+    conversation_dict['messages_next_cursor'] = next_cursor
     
     conn.close()
     return conversation_dict
 
-def get_conversations(db_path, kb_id=None, limit=20, offset=0):
+# 对话列表中随每个对话返回的最后一条消息的字段
+_LAST_MESSAGE_COLUMNS = ('id', 'conversation_id', 'message_type', 'content', 'created_at', 'sources')
+
+def get_conversations(db_path, kb_id=None, limit=20, offset=0, after=None):
     """
     获取对话列表，可按知识库筛选
     
+    每个对话的最后一条消息在同一条查询中通过关联子查询取得，
+    借助conversation_messages(conversation_id, created_at)索引，每个对话只读取一行。
+    
     参数:
         db_path: 数据库路径
         kb_id: 知识库ID (可选)
         limit: 返回的最大记录数
-        offset: 分页起始位置
+        offset: 分页起始位置（旧接口，提供after时忽略）
+        after: decode_cursor返回的上一页位置 (可选)
         
     返回:
-        list: 对话列表
+        tuple: (对话列表, 下一页的游标或None)
     """
     conn = get_db_connection(db_path)
     cursor = conn.cursor()
     
     # 构建查询SQL
-    query = "SELECT * FROM conversations"
+    page_query = "SELECT * FROM conversations"
+    conditions = []
     params = []
     
     if kb_id:
-        query += " WHERE knowledge_base_id = ?"
+        conditions.append("knowledge_base_id = ?")
         params.append(kb_id)
     
-    query += " ORDER BY updated_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
+    # 键集分页：从上一页最后一个对话之后继续，不需要跳过前面的记录
+    if after is not None:
+        conditions.append("(updated_at, id) < (?, ?)")
+        params.extend(after)
+        offset = 0
     
-    cursor.execute(query, params)
-    conversations = [dict(row) for row in cursor.fetchall()]
+    if conditions:
+        page_query += " WHERE " + " AND ".join(conditions)
     
-    # 获取每个对话的最后一条消息
-    for conv in conversations:
-        cursor.execute(
-            "SELECT * FROM conversation_messages WHERE conversation_id = ? ORDER BY created_at DESC LIMIT 1",
-            (conv['id'],)
+    # 多读取一行判断是否还有下一页
+    page_query += " ORDER BY updated_at DESC, id DESC LIMIT ? OFFSET ?"
+    params.extend([limit + 1, offset])
+    
+    message_columns = ", ".join(f"m.{column} AS last_message_{column}" for column in _LAST_MESSAGE_COLUMNS)
+    cursor.execute(f"""
+        SELECT c.*, {message_columns}
+        FROM ({page_query}) c
+        LEFT JOIN conversation_messages m ON m.id = (
+            SELECT id FROM conversation_messages
+            WHERE conversation_id = c.id
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
         )
-        last_message = cursor.fetchone()
-        if last_message:
-            conv['last_message'] = dict(last_message)
+        ORDER BY c.updated_at DESC, c.id DESC
+    """, params)
+    
+    conversations = []
+    for row in cursor.fetchall():
+        conv = dict(row)
+        last_message = {column: conv.pop(f"last_message_{column}") for column in _LAST_MESSAGE_COLUMNS}
+        if last_message['id'] is not None:
+            conv['last_message'] = last_message
+        conversations.append(conv)
     
     conn.close()
-    return conversations
+    next_cursor = encode_cursor(conversations[limit - 1], 'updated_at') if len(conversations) > limit else None
+    return conversations[:limit], next_cursor
 
 def delete_conversation(db_path, conversation_id):
     """
@@ -264,4 +671,122 @@ def delete_conversation(db_path, conversation_id):
     except Exception as e:
         print(f"删除对话时出错: {str(e)}")
         conn.close()
-        return False 
\ No newline at end of file
+        return False
+
+def create_ingestion_job(db_path, job_id, kb_id, original_filename, stored_filename, content_hash=None):
+    """
+    创建文档导入任务记录，初始状态为queued
+    
+    提供content_hash时，在同一个写事务中检查同一知识库是否已有相同内容的文档
+    或未完成的任务，已有时不创建任务。这样同一文件在第一个任务完成前再次上传，
+    也不会产生两个文档和两份向量。
+    
+    参数:
+        db_path: 数据库路径
+        job_id: 任务ID
+        kb_id: 知识库ID
+        original_filename: 原始文件名
+        stored_filename: 存储文件名
+        content_hash: 文件内容的SHA-256摘要 (可选)
+        
+    返回:
+        dict: 已有的文档 {"document_id": ...} 或任务 {"job_id": ..., "status": ...}；创建了新任务时返回None
+    """
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    try:
+        # 立即获取写锁，检查和插入之间不会有其他进程写入相同的任务
+        cursor.execute("BEGIN IMMEDIATE")
+        if content_hash:
+            cursor.execute(
+                "SELECT id FROM documents WHERE knowledge_base_id = ? AND content_hash = ? ORDER BY id LIMIT 1",
+                (kb_id, content_hash)
+            )
+            document = cursor.fetchone()
+            if document:
+                conn.rollback()
+                return {"document_id": document['id']}
+            
+            cursor.execute(
+                """SELECT id, status FROM ingestion_jobs WHERE knowledge_base_id = ? AND content_hash = ?
+                   AND status IN ('queued', 'extracting', 'embedding') ORDER BY created_at LIMIT 1""",
+                (kb_id, content_hash)
+            )
+            job = cursor.fetchone()
+            if job:
+                conn.rollback()
+                return {"job_id": job['id'], "status": job['status']}
+        
+        cursor.execute(
+            "INSERT INTO ingestion_jobs (id, knowledge_base_id, original_filename, stored_filename, status, content_hash) VALUES (?, ?, ?, ?, 'queued', ?)",
+            (job_id, kb_id, original_filename, stored_filename, content_hash)
+        )
+        conn.commit()
+        return None
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def update_ingestion_job(db_path, job_id, status, message=None, document_id=None, chunk_count=None, chunks_per_second=None):
+    """
+    更新文档导入任务的状态
+    
+    参数:
+        db_path: 数据库路径
+        job_id: 任务ID
+        status: 新状态 ('queued', 'extracting', 'embedding', 'done', 'failed')
+        message: 状态说明 (可选)
+        document_id: 生成的文档ID (可选)
+        chunk_count: 写入向量数据库的块数量 (可选)
+        chunks_per_second: 嵌入吞吐量，块/秒 (可选)
+    """
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        """UPDATE ingestion_jobs SET status = ?, message = COALESCE(?, message), document_id = COALESCE(?, document_id),
+           chunk_count = COALESCE(?, chunk_count), chunks_per_second = COALESCE(?, chunks_per_second),
+           updated_at = CURRENT_TIMESTAMP WHERE id = ?""",
+        (status, message, document_id, chunk_count, chunks_per_second, job_id)
+    )
+    conn.commit()
+    conn.close()
+
+def get_ingestion_job(db_path, job_id):
+    """
+    获取文档导入任务详情
+    
+    参数:
+        db_path: 数据库路径
+        job_id: 任务ID
+        
+    返回:
+        dict: 任务详情，不存在时返回None
+    """
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM ingestion_jobs WHERE id = ?", (job_id,))
+    job = cursor.fetchone()
+    conn.close()
+    return dict(job) if job else None
+
+def fail_interrupted_ingestion_jobs(db_path):
+    """
+    将上次进程退出时仍未完成的导入任务标记为失败
+    
+    参数:
+        db_path: 数据库路径
+        
+    返回:
+        int: 被标记的任务数量
+    """
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE ingestion_jobs SET status = 'failed', message = 'Interrupted by server restart', updated_at = CURRENT_TIMESTAMP WHERE status IN ('queued', 'extracting', 'embedding')"
+    )
+    count = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return count
@@ -1,17 +1,25 @@
 import os
+import time
 import shutil
+import hashlib
 from datetime import datetime
 from werkzeug.utils import secure_filename
-from langchain_community.document_loaders import UnstructuredPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from get_vector_db import get_vector_db
-from db_utils import save_document_metadata, check_knowledge_base_exists
-import pdf2image
+from get_vector_db import get_vector_db, delete_document_vectors
+from embedding import upsert_chunks
+from answer_cache import invalidate_answer_cache
+from keyword_index import ensure_keyword_index, index_chunks, remove_document_keywords
+from pdf_extraction import iter_pages
+from metrics import observe_stage, observe_request
+from chunking import get_chunking_settings, get_text_splitter, split_page
+from db_utils import (save_document_metadata, check_knowledge_base_exists, find_documents_by_hash,
+                      update_document_extraction_status, delete_document_record, get_knowledge_base_chunking)
 
 # 定义常量
 TEMP_FOLDER = os.getenv('TEMP_FOLDER', './_temp')
 DOCS_STORAGE = os.getenv('DOCS_STORAGE', './documents')
 DB_PATH = os.getenv('DB_PATH', './documents.db')
+# 上传文件写入磁盘时每次读取的字节数
+UPLOAD_BLOCK_SIZE = 1024 * 1024
 
 # 确保目录存在
 os.makedirs(DOCS_STORAGE, exist_ok=True)
@@ -21,152 +29,93 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'pdf'}
 
 def save_file(file):
-    """保存上传的文件到临时文件夹并返回文件路径"""
+    """保存上传的文件到临时文件夹，写入的同时计算内容摘要"""
     ct = datetime.now()
     ts = ct.timestamp()
     filename = str(ts) + "_" + secure_filename(file.filename)
     file_path = os.path.join(TEMP_FOLDER, filename)
-    file.save(file_path)
-    return file_path, filename
+    
+    digest = hashlib.sha256()
+    with open(file_path, 'wb') as out:
+        while True:
+            block = file.stream.read(UPLOAD_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            out.write(block)
+    
+    return file_path, filename, digest.hexdigest()
+
+def get_chunking_for_kb(kb_id):
+    """返回知识库的完整分块设置（未配置的项使用默认值）"""
+    stored = get_knowledge_base_chunking(DB_PATH, kb_id) or {}
+    return get_chunking_settings(
+        stored.get('chunk_strategy'),
+        stored.get('chunk_size'),
+        stored.get('chunk_overlap')
+    )
+
+def iter_chunks(file_path, chunking=None):
+    """
+    以生成器方式逐页提取PDF并分割为文本块
+
+    每次只在内存中保留当前页面及其文本块，适合处理很大的扫描件。
+    没有提取到任何内容时在结束时抛出ValueError。
+    等待页面提取和分割页面的耗时分别记录为extraction和splitting阶段。
 
-def load_and_split_data(file_path):
-    """加载PDF文件并分割数据"""
+    参数:
+        file_path: PDF文件路径
+        chunking: get_chunking_settings返回的分块设置，默认使用全局默认值
+    """
+    chunking = chunking or get_chunking_settings()
+    text_splitter = get_text_splitter(chunking)
+    produced = False
+    extraction_seconds = 0.0
+    splitting_seconds = 0.0
     try:
-        # Try with PyPDF2 which can sometimes handle corrupted files better
-        from langchain_community.document_loaders import PyPDFLoader
-        print("Attempting to load with PyPDFLoader...")
-        try:
-            loader = PyPDFLoader(file_path=file_path)
-            data = loader.load()
-            
-            # Verify content was extracted
-            if not data or all(not doc.page_content.strip() for doc in data):
-                raise ValueError("No content extracted with PyPDFLoader")
-        except Exception as e:
-            print(f"PyPDFLoader failed: {str(e)}")
-            data = []
-        
-        # If no content, try UnstructuredPDFLoader with OCR
-        if not data or all(not doc.page_content.strip() for doc in data):
-            print("No content found with PyPDFLoader, trying UnstructuredPDFLoader...")
-            try:
-                from langchain_community.document_loaders import UnstructuredPDFLoader
-                loader = UnstructuredPDFLoader(
-                    file_path=file_path,
-                    mode="elements",
-                    strategy="fast",
-                    languages=["eng", "chi_sim"]
-                )
-                data = loader.load()
-                if not data or all(not doc.page_content.strip() for doc in data):
-                    raise ValueError("No content extracted with UnstructuredPDFLoader")
-            except Exception as e:
-                print(f"UnstructuredPDFLoader failed: {str(e)}")
-                data = []
-        
-        # If still no content, try with PDFMiner
-        if not data or all(not doc.page_content.strip() for doc in data):
-            print("No content found with UnstructuredPDFLoader, trying PDFMinerLoader...")
-            try:
-                from langchain_community.document_loaders import PDFMinerLoader
-                loader = PDFMinerLoader(file_path=file_path)
-                data = loader.load()
-                if not data or all(not doc.page_content.strip() for doc in data):
-                    raise ValueError("No content extracted with PDFMinerLoader")
-            except Exception as e:
-                print(f"PDFMinerLoader failed: {str(e)}")
-                data = []
-            
-        # If still no content, try pdfplumber as a last resort
-        if not data or all(not doc.page_content.strip() for doc in data):
-            print("No content found with PDFMinerLoader, trying PDF Plumber...")
-            import pdfplumber
-            from langchain_core.documents import Document
-            
-            data = []
-            try:
-                with pdfplumber.open(file_path) as pdf:
-                    for i, page in enumerate(pdf.pages):
-                        text = page.extract_text() or ""
-                        if text.strip():
-                            data.append(Document(
-                                page_content=text,
-                                metadata={"source": file_path, "page": i+1}
-                            ))
-                if not data:
-                    raise ValueError("No content extracted with pdfplumber")
-            except Exception as plumber_error:
-                print(f"PDF Plumber also failed: {str(plumber_error)}")
-        
-        # If still no content, try a direct approach with PyPDF2
-        if not data or all(not doc.page_content.strip() for doc in data):
-            print("All PDF loaders failed, trying direct PyPDF2 approach...")
-            import io
-            import PyPDF2
-            from langchain_core.documents import Document
-            
-            data = []
-            try:
-                # Create a PyPDF2 reader with error handling
-                reader = PyPDF2.PdfReader(file_path, strict=False)
-                
-                # Extract text from each page
-                for i in range(len(reader.pages)):
-                    try:
-                        page = reader.pages[i]
-                        text = page.extract_text() or ""
-                        if text.strip():
-                            data.append(Document(
-                                page_content=text,
-                                metadata={"source": file_path, "page": i+1}
-                            ))
-                    except Exception as page_error:
-                        print(f"Error extracting page {i}: {str(page_error)}")
-                
-                if not data:
-                    raise ValueError("No content extracted with direct PyPDF2")
-            except Exception as pdf2_error:
-                print(f"Direct PyPDF2 approach failed: {str(pdf2_error)}")
-        
-        # If still no content, try raw PDF parsing
-        if not data or all(not doc.page_content.strip() for doc in data):
-            print("Attempting raw PDF text extraction as last resort...")
-            try:
-                # Try to extract text from potentially corrupted PDF
-                with open(file_path, 'rb') as file:
-                    content = file.read()
-                    
-                # Look for text content in raw binary
-                import re
-                text_chunks = re.findall(b'[\x20-\x7E\n]{4,}', content)
-                
-                # Convert bytes to string and create documents
-                extracted_text = '\n'.join([chunk.decode('utf-8', errors='ignore') for chunk in text_chunks])
-                
-                if extracted_text.strip():
-                    data = [Document(
-                        page_content=extracted_text,
-                        metadata={"source": file_path, "page": 1}
-                    )]
-                    print("Successfully extracted some text using raw binary parsing")
-                else:
-                    raise ValueError("No text content found in raw binary")
-            except Exception as raw_error:
-                print(f"Raw text extraction failed: {str(raw_error)}")
-        
-        # If still no content, raise error
-        if not data or all(not doc.page_content.strip() for doc in data):
-            raise ValueError("No content could be extracted from the PDF after multiple attempts. The file is likely severely corrupted or password-protected.")
-        
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=7500, chunk_overlap=100)
-        chunks = text_splitter.split_documents(data)
-        return chunks
+        pages = iter(iter_pages(file_path))
+        while True:
+            stage_start = time.perf_counter()
+            page = next(pages, None)
+            extraction_seconds += time.perf_counter() - stage_start
+            if page is None:
+                break
+            if not page.page_content.strip():
+                continue
+            stage_start = time.perf_counter()
+            chunks = split_page(page, chunking, text_splitter)
+            splitting_seconds += time.perf_counter() - stage_start
+            for chunk in chunks:
+                produced = True
+                yield chunk
     except Exception as e:
         print(f"Error extracting content from PDF: {str(e)}")
         raise ValueError(f"Failed to process PDF: {str(e)}")
+    finally:
+        observe_stage('ingest', 'extraction', extraction_seconds)
+        observe_stage('ingest', 'splitting', splitting_seconds)
+    
+    # If still no content, raise error
+    if not produced:
+        raise ValueError("Failed to process PDF: No content could be extracted from the PDF after multiple attempts. The file is likely severely corrupted or password-protected.")
 
-def embed_document(file, kb_id=1):
-    """处理文档嵌入主函数"""
+def load_and_split_data(file_path, chunking=None):
+    """加载PDF文件并分割数据（逐页并行提取，每一页单独回退提取方式）"""
+    return list(iter_chunks(file_path, chunking))
+
+def save_upload(file, kb_id=1):
+    """
+    校验上传请求，将文件保存到临时目录并检查是否为重复文件
+
+    参数:
+        file: 上传的文件对象
+        kb_id: 知识库ID
+
+    返回:
+        tuple: (是否成功, 上传信息, 错误信息)
+        上传信息包含temp_file_path、stored_filename、original_filename、content_hash，
+        以及duplicate_of（同一知识库中已有的文档ID）或source_document（其他知识库中的相同文档）
+    """
     # 验证知识库是否存在
     if not check_knowledge_base_exists(DB_PATH, kb_id):
         print(f"知识库 {kb_id} 不存在")
@@ -177,59 +126,186 @@ def embed_document(file, kb_id=1):
         return False, None, "Unsupported file type or invalid filename"
     
     try:
-        print(f"开始处理文件: {file.filename} 到知识库 {kb_id}")
-        # 保存到临时目录
-        temp_file_path, stored_filename = save_file(file)
+        temp_file_path, stored_filename, content_hash = save_file(file)
         print(f"文件已保存到临时路径: {temp_file_path}")
+    except Exception as e:
+        print(f"保存上传文件时出错: {str(e)}")
+        return False, None, f"Error saving file: {str(e)}"
+    
+    upload = {
+        "temp_file_path": temp_file_path,
+        "stored_filename": stored_filename,
+        "original_filename": file.filename,
+        "content_hash": content_hash,
+        "duplicate_of": None,
+        "source_document": None
+    }
+    
+    # 按内容摘要查找已上传的相同文件
+    existing = find_documents_by_hash(DB_PATH, content_hash)
+    same_kb = [doc for doc in existing if doc['knowledge_base_id'] == kb_id]
+    if same_kb:
+        # 同一知识库中已存在：不再保存副本，直接指向已有文档
+        upload["duplicate_of"] = same_kb[0]['id']
+        os.remove(temp_file_path)
+        print(f"文件与知识库 {kb_id} 中的文档 {same_kb[0]['id']} 内容相同，跳过导入")
+    else:
+        # 只有分块设置相同的知识库之间才能直接复用向量
+        chunking = get_chunking_for_kb(kb_id)
+        reusable = [
+            doc for doc in existing
+            if not doc['extraction_failed'] and os.path.exists(doc['file_path'])
+            and get_chunking_for_kb(doc['knowledge_base_id']) == chunking
+        ]
+        if reusable:
+            upload["source_document"] = reusable[0]
+            print(f"文件与知识库 {reusable[0]['knowledge_base_id']} 中的文档 {reusable[0]['id']} 内容相同，将复用其向量")
+    
+    return True, upload, None
+
+def copy_document_vectors(source_document, doc_id, kb_id, original_filename=None):
+    """
+    将其他知识库中相同文档的块和向量复制到目标知识库，无需重新提取和嵌入
+
+    参数:
+        source_document: 源文档记录
+        doc_id: 新文档ID
+        kb_id: 目标知识库ID
+        original_filename: 新文档的原始文件名 (可选)，记录在块元数据中
+
+    返回:
+        int: 复制的块数量；源集合中没有该文档的块时返回0
+    """
+    source_db = get_vector_db(source_document['knowledge_base_id'])
+    existing = source_db._collection.get(
+        where={"document_id": source_document['id']},
+        include=["documents", "metadatas", "embeddings"]
+    )
+    if not existing["ids"]:
+        return 0
+    
+    metadatas = []
+    for metadata in existing["metadatas"]:
+        metadata = dict(metadata or {})
+        metadata["document_id"] = doc_id
+        if original_filename:
+            metadata["original_filename"] = original_filename
+        metadatas.append(metadata)
+    
+    target_db = get_vector_db(kb_id)
+    ids = [f"{doc_id}-{chunk_id}" for chunk_id in existing["ids"]]
+    target_db._collection.upsert(
+        ids=ids,
+        embeddings=existing["embeddings"],
+        documents=existing["documents"],
+        metadatas=metadatas
+    )
+    ensure_keyword_index(target_db)
+    index_chunks(target_db, ids, existing["documents"], metadatas)
+    return len(ids)
+
+def process_document(upload, kb_id=1, progress=None):
+    """
+    提取、分割并嵌入已保存到临时目录的文档，并保存元数据
+
+    参数:
+        upload: save_upload返回的上传信息
+        kb_id: 知识库ID
+        progress: 可选回调，在进入各处理阶段时以阶段名调用 ('extracting', 'embedding')，
+            嵌入完成后还会附带chunk_count和chunks_per_second关键字参数
+
+    返回:
+        tuple: (是否成功, 文档ID, 消息)
+    """
+    def report(stage, **details):
+        if progress:
+            progress(stage, **details)
+
+    temp_file_path = upload["temp_file_path"]
+    original_filename = upload["original_filename"]
+    source_document = upload.get("source_document")
+    doc_id = None
+    permanent_path = None
+    start = time.perf_counter()
+
+    try:
+        print(f"开始处理文件: {original_filename} 到知识库 {kb_id}")
         
-        # 处理文档并创建向量嵌入
-        extraction_failed = False
-        error_message = ""
-        try:
-            chunks = load_and_split_data(temp_file_path)
-            print(f"文档已分割为 {len(chunks)} 个块")
-            
-            # 获取向量数据库实例
-            db = get_vector_db(kb_id)
-            
-            # 添加文档到向量数据库
-            db.add_documents(chunks)
-            db.persist()
-            print(f"文档已成功添加到向量数据库")
-        except ValueError as process_error:
-            error_msg = str(process_error)
-            print(f"处理文档内容时出错: {error_msg}")
-            extraction_failed = True
-            error_message = error_msg
-            # Don't remove temp file yet, we'll still save metadata
-        except Exception as process_error:
-            print(f"处理文档内容时出错: {str(process_error)}")
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
-            return False, None, f"Error processing document: {str(process_error)}"
-        
-        # 将文件复制到永久存储目录
-        permanent_path = os.path.join(DOCS_STORAGE, stored_filename)
-        shutil.copy2(temp_file_path, permanent_path)
-        print(f"文件已保存到永久路径: {permanent_path}")
-        
-        # 保存文档元数据到数据库
         file_size = os.path.getsize(temp_file_path)
+        if source_document:
+            # 相同内容的文件已在永久存储中，直接共用
+            stored_filename = source_document['stored_filename']
+            permanent_path = source_document['file_path']
+            os.remove(temp_file_path)
+        else:
+            # 将文件移动到永久存储目录
+            stored_filename = upload["stored_filename"]
+            permanent_path = os.path.join(DOCS_STORAGE, stored_filename)
+            shutil.move(temp_file_path, permanent_path)
+            print(f"文件已保存到永久路径: {permanent_path}")
         
-        # Even if extraction failed, we still save metadata but mark it as extraction_failed
+        # 先保存文档元数据，使每个块都能记录所属的文档ID
         doc_id = save_document_metadata(
             DB_PATH,
-            original_filename=file.filename,
+            original_filename=original_filename,
             stored_filename=stored_filename,
             file_path=permanent_path,
             file_size=file_size,
             kb_id=kb_id,
-            extraction_failed=extraction_failed
+            content_hash=upload["content_hash"]
         )
         print(f"文档元数据已保存，ID: {doc_id}")
         
-        # 删除临时文件
-        os.remove(temp_file_path)
+        # 处理文档并创建向量嵌入
+        extraction_failed = False
+        error_message = ""
+        try:
+            copied = 0
+            if source_document:
+                report('embedding')
+                stage_start = time.perf_counter()
+                copied = copy_document_vectors(source_document, doc_id, kb_id, original_filename)
+                observe_stage('ingest', 'copy_vectors', time.perf_counter() - stage_start)
+                print(f"已从文档 {source_document['id']} 复制 {copied} 个块")
+            
+            # 没有可复用的向量时（例如旧版本导入的文档）正常提取
+            if not copied:
+                report('extracting')
+                chunking = get_chunking_for_kb(kb_id)
+                print(f"分块设置: {chunking}")
+                # 获取向量数据库实例，并确保旧集合已建立关键词索引
+                db = get_vector_db(kb_id)
+                ensure_keyword_index(db)
+                
+                def tagged_chunks():
+                    # 提取、分割和嵌入以流水线方式进行，第一个块产生后即进入嵌入阶段
+                    for index, chunk in enumerate(iter_chunks(permanent_path, chunking)):
+                        if index == 0:
+                            report('embedding')
+                        # 记录文档ID和原始文件名，格式化来源时无需查询数据库
+                        chunk.metadata["document_id"] = doc_id
+                        chunk.metadata["original_filename"] = original_filename
+                        yield chunk
+                
+                # 批量嵌入并写入向量数据库，同时增量更新关键词索引
+                stats = upsert_chunks(
+                    db, tagged_chunks(),
+                    on_upsert=lambda ids, texts, metadatas: index_chunks(db, ids, texts, metadatas)
+                )
+                report('embedding', chunk_count=stats["chunk_count"], chunks_per_second=stats["chunks_per_second"])
+                print(f"文档已成功添加到向量数据库")
+            else:
+                report('embedding', chunk_count=copied)
+        except ValueError as process_error:
+            error_msg = str(process_error)
+            print(f"处理文档内容时出错: {error_msg}")
+            extraction_failed = True
+            error_message = error_msg
+            # 提取中途失败时移除已写入的部分向量和索引
+            delete_document_vectors(kb_id, doc_id)
+            remove_document_keywords(get_vector_db(kb_id), doc_id)
+            # Even if extraction failed, we still keep the file and metadata but mark it as extraction_failed
+            update_document_extraction_status(DB_PATH, doc_id, True)
         
         # If extraction failed but we saved the file, return partial success
         if extraction_failed:
@@ -240,10 +316,31 @@ def embed_document(file, kb_id=1):
         print(f"嵌入文档时发生错误: {str(e)}")
         import traceback
         traceback.print_exc()
-        # 确保清理临时文件
+        # 清理未完成的文档记录和文件
         try:
-            if 'temp_file_path' in locals() and os.path.exists(temp_file_path):
+            if doc_id is not None:
+                delete_document_vectors(kb_id, doc_id)
+                remove_document_keywords(get_vector_db(kb_id), doc_id)
+                delete_document_record(DB_PATH, doc_id)
+            if os.path.exists(temp_file_path):
                 os.remove(temp_file_path)
+            if permanent_path and not source_document and os.path.exists(permanent_path):
+                os.remove(permanent_path)
         except:
             pass
-        return False, None, f"Error embedding document: {str(e)}"
\ No newline at end of file
+        return False, None, f"Error processing document: {str(e)}"
+    finally:
+        # 知识库的向量可能已经变化，之前缓存的回答不再可靠
+        invalidate_answer_cache(kb_id)
+        observe_request('ingest', time.perf_counter() - start)
+
+def embed_document(file, kb_id=1):
+    """处理文档嵌入主函数（在当前线程中同步完成）"""
+    success, upload, error = save_upload(file, kb_id)
+    if not success:
+        return False, None, error
+    
+    if upload["duplicate_of"]:
+        return True, upload["duplicate_of"], "Document already exists in this knowledge base"
+    
+    return process_document(upload, kb_id)
@@ -0,0 +1,157 @@
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Callable
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from embedding_cache import get_cached_embeddings, store_embeddings, get_cache_stats
+from metrics import observe_stage
+from ollama_client import OLLAMA_BASE_URL, embed
+
+# 使用环境变量配置
+# 每个嵌入请求包含的文本块数量
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '32'))
+# 同时发送给嵌入服务的批次数量
+EMBED_PARALLELISM = int(os.getenv('EMBED_PARALLELISM', '4'))
+# 每次写入Chroma集合的记录数量
+CHROMA_UPSERT_BATCH_SIZE = int(os.getenv('CHROMA_UPSERT_BATCH_SIZE', '500'))
+EMBED_TIMEOUT = float(os.getenv('EMBED_TIMEOUT', '300'))
+
+class BatchedOllamaEmbeddings(Embeddings):
+    """
+    通过Ollama的/api/embed接口批量计算嵌入向量
+
+    一次请求嵌入多个文本块，并同时发送多个批次，
+    使导入速度不再受单个文本逐一往返的延迟限制。
+    """
+
+    def __init__(self, model: str, base_url: str = OLLAMA_BASE_URL,
+                 batch_size: int = EMBED_BATCH_SIZE, parallelism: int = EMBED_PARALLELISM):
+        self.model = model
+        self.base_url = base_url.rstrip('/')
+        self.batch_size = max(batch_size, 1)
+        self.parallelism = max(parallelism, 1)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """通过共享的Ollama客户端发送一个批次的嵌入请求"""
+        return embed(self.model, texts, self.base_url, EMBED_TIMEOUT)
+
+    def _embed_uncached(self, texts: List[str]) -> List[List[float]]:
+        """并发地分批嵌入文本，返回顺序与输入一致"""
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            return self._embed_batch(batches[0])
+
+        with ThreadPoolExecutor(max_workers=min(self.parallelism, len(batches))) as executor:
+            results = executor.map(self._embed_batch, batches)
+            return [vector for batch in results for vector in batch]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """先查询嵌入缓存，只把未命中且不重复的文本发送给模型"""
+        if not texts:
+            return []
+
+        vectors = get_cached_embeddings(self.model, texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+
+        if missing:
+            computed = dict(zip(missing, self._embed_uncached(missing)))
+            store_embeddings(self.model, missing, [computed[text] for text in missing])
+            vectors = [vector if vector is not None else computed[text] for text, vector in zip(texts, vectors)]
+
+        return vectors
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        嵌入查询文本
+
+        查询很少重复，不读写持久化的块嵌入缓存，避免每次查询都访问缓存数据库，
+        也避免查询向量挤掉缓存中的块向量。
+        """
+        if not texts:
+            return []
+        unique = list(dict.fromkeys(texts))
+        computed = dict(zip(unique, self._embed_uncached(unique)))
+        return [computed[text] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+def _clean_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """Chroma只接受标量元数据，丢弃列表、字典和空值"""
+    return {k: v for k, v in (metadata or {}).items() if isinstance(v, (str, int, float, bool))}
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    """把可迭代对象按固定大小分组"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def upsert_chunks(db, chunks: Iterable[Document], on_upsert: Optional[Callable] = None) -> Dict[str, Any]:
+    """
+    批量嵌入文本块并以批量upsert的方式写入Chroma集合
+
+    chunks可以是生成器：每次只取出EMBED_BATCH_SIZE * EMBED_PARALLELISM个块，
+    嵌入并写入后再读取下一组，内存占用与文档大小无关。
+
+    参数:
+        db: Chroma向量数据库实例
+        chunks: 待写入的文本块
+        on_upsert: 可选回调，每组写入后以(ids, texts, metadatas)调用
+
+    返回:
+        Dict[str, Any]: {"chunk_count", "seconds", "chunks_per_second", "cache_hits",
+                         "embedding_seconds", "persist_seconds"}
+    """
+    start = time.perf_counter()
+    cache_before = get_cache_stats()
+    chunk_count = 0
+    embedding_seconds = 0.0
+    persist_seconds = 0.0
+    group_size = max(EMBED_BATCH_SIZE, 1) * max(EMBED_PARALLELISM, 1)
+
+    for group in _batched(chunks, group_size):
+        texts = [chunk.page_content for chunk in group]
+        stage_start = time.perf_counter()
+        embeddings = db._embedding_function.embed_documents(texts)
+        embedding_seconds += time.perf_counter() - stage_start
+        metadatas = [_clean_metadata(chunk.metadata) or None for chunk in group]
+        ids = [str(uuid.uuid4()) for _ in group]
+
+        stage_start = time.perf_counter()
+        for i in range(0, len(group), max(CHROMA_UPSERT_BATCH_SIZE, 1)):
+            end = i + CHROMA_UPSERT_BATCH_SIZE
+            db._collection.upsert(
+                ids=ids[i:end],
+                embeddings=embeddings[i:end],
+                documents=texts[i:end],
+                metadatas=metadatas[i:end]
+            )
+        if on_upsert:
+            on_upsert(ids, texts, metadatas)
+        persist_seconds += time.perf_counter() - stage_start
+        chunk_count += len(group)
+
+    seconds = time.perf_counter() - start
+    chunks_per_second = chunk_count / seconds if seconds > 0 else 0.0
+    cache_after = get_cache_stats()
+    cache_hits = cache_after["hits"] - cache_before["hits"]
+    observe_stage('ingest', 'embedding', embedding_seconds)
+    observe_stage('ingest', 'persist', persist_seconds)
+    print(f"已嵌入并写入 {chunk_count} 个块，用时 {seconds:.2f} 秒 ({chunks_per_second:.1f} 块/秒)，嵌入缓存命中约 {cache_hits} 个")
+    return {
+        "chunk_count": chunk_count,
+        "seconds": seconds,
+        "chunks_per_second": chunks_per_second,
+        "cache_hits": cache_hits,
+        "embedding_seconds": embedding_seconds,
+        "persist_seconds": persist_seconds
+    }
@@ -0,0 +1,62 @@
+import os
+from typing import List, Optional, Dict
+
+import numpy as np
+
+from sqlite_cache import SqliteLRUCache, text_hash
+
+# 使用环境变量配置
+DB_PATH = os.getenv('DB_PATH', './documents.db')
+# 嵌入缓存默认与documents.db放在同一目录
+EMBEDDING_CACHE_PATH = os.getenv(
+    'EMBEDDING_CACHE_PATH',
+    os.path.join(os.path.dirname(DB_PATH) or '.', 'embedding_cache.db')
+)
+EMBEDDING_CACHE_ENABLED = os.getenv('EMBEDDING_CACHE_ENABLED', '1') not in ('0', 'false', 'False')
+# 缓存条目上限，超出后淘汰最久未使用的条目
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '200000'))
+
+_cache = SqliteLRUCache(
+    EMBEDDING_CACHE_PATH,
+    table='embeddings',
+    key_column='text_hash',
+    value_columns=[('dim', 'INTEGER NOT NULL'), ('vector', 'BLOB NOT NULL')],
+    max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+    enabled=EMBEDDING_CACHE_ENABLED
+)
+
+def get_cached_embeddings(model: str, texts: List[str]) -> List[Optional[List[float]]]:
+    """
+    查询文本的缓存嵌入向量
+
+    参数:
+        model: 嵌入模型名称
+        texts: 文本列表
+
+    返回:
+        List[Optional[List[float]]]: 与输入顺序一致，未命中的位置为None
+    """
+    hashes = [text_hash(text) for text in texts]
+    found = _cache.get_many(model, hashes)
+    vectors = {h: np.frombuffer(values[1], dtype=np.float32).tolist() for h, values in found.items()}
+    return [vectors.get(h) for h in hashes]
+
+def store_embeddings(model: str, texts: List[str], vectors: List[List[float]]):
+    """
+    将新计算的嵌入向量写入缓存，并在超出容量时淘汰旧条目
+
+    参数:
+        model: 嵌入模型名称
+        texts: 文本列表
+        vectors: 与texts一一对应的嵌入向量
+    """
+    items = []
+    for text, vector in zip(texts, vectors):
+        array = np.asarray(vector, dtype=np.float32)
+        items.append((text_hash(text), (int(array.shape[0]), array.tobytes())))
+    # 同一模型和文本的向量相同，已存在的条目（并发写入的结果）保持不变
+    _cache.put_many(model, items)
+
+def get_cache_stats() -> Dict[str, int]:
+    """返回进程启动以来的缓存命中、未命中和淘汰次数"""
+    return _cache.stats()
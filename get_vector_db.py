@@ -1,50 +1,165 @@
 import os
-from langchain_community.embeddings import OllamaEmbeddings
+import threading
+from collections import OrderedDict
 from langchain_community.vectorstores.chroma import Chroma
+from embedding import BatchedOllamaEmbeddings
 
 # 使用环境变量配置
 CHROMA_PATH = os.getenv('CHROMA_PATH', 'chroma')
 BASE_COLLECTION_NAME = os.getenv('COLLECTION_NAME', 'kb')
 TEXT_EMBEDDING_MODEL = os.getenv('TEXT_EMBEDDING_MODEL', 'nomic-embed-text')
+# 进程内缓存的集合句柄数量上限，超出后按LRU淘汰
+VECTOR_DB_CACHE_SIZE = int(os.getenv('VECTOR_DB_CACHE_SIZE', '16'))
+# 查找旧版块时每次从集合中读取的记录数量
+_LEGACY_SCAN_BATCH_SIZE = 1000
+
+# 进程级注册表：集合名称 -> Chroma实例
+_db_registry = OrderedDict()
+_registry_lock = threading.RLock()
+_embedding = None
+
+def get_collection_name(kb_id=None):
+    """根据知识库ID返回对应的向量集合名称"""
+    return f"{BASE_COLLECTION_NAME}-{kb_id}" if kb_id else BASE_COLLECTION_NAME
+
+def get_embedding_function():
+    """返回进程内共享的嵌入模型客户端"""
+    global _embedding
+    with _registry_lock:
+        if _embedding is None:
+            print(f"正在使用嵌入模型: {TEXT_EMBEDDING_MODEL}")
+            _embedding = BatchedOllamaEmbeddings(model=TEXT_EMBEDDING_MODEL)
+        return _embedding
 
 def get_vector_db(kb_id=None):
     """
     获取向量数据库实例
-    
+
+    同一进程内每个知识库只创建一次Chroma实例，之后从注册表中复用；
+    注册表按最近使用顺序淘汰，容量由VECTOR_DB_CACHE_SIZE控制。
+
     参数:
         kb_id: 知识库ID，用于区分不同知识库的向量存储
-        
+
     返回:
         Chroma向量数据库实例
     """
-    try:
-        # 确保向量数据库目录存在
-        os.makedirs(CHROMA_PATH, exist_ok=True)
-        
-        # 创建嵌入模型
-        print(f"正在使用嵌入模型: {TEXT_EMBEDDING_MODEL}")
-        embedding = OllamaEmbeddings(model=TEXT_EMBEDDING_MODEL, show_progress=True)
-        
-        # 如果提供了kb_id，将其作为集合名称的一部分
-        collection_name = f"{BASE_COLLECTION_NAME}-{kb_id}" if kb_id else BASE_COLLECTION_NAME
-        print(f"正在访问向量数据库集合: {collection_name}")
-        
-        # 创建并返回Chroma向量数据库
-        db = Chroma(
-            collection_name=collection_name,
-            persist_directory=CHROMA_PATH,
-            embedding_function=embedding
-        )
-        
-        # 检查数据库是否初始化成功
+    collection_name = get_collection_name(kb_id)
+
+    with _registry_lock:
+        db = _db_registry.get(collection_name)
+        if db is not None:
+            _db_registry.move_to_end(collection_name)
+            return db
+
         try:
-            # 尝试访问集合，确保它存在且可用
-            collection_count = db._collection.count()
-            print(f"向量数据库集合 {collection_name} 包含 {collection_count} 条记录")
-        except Exception as collection_error:
-            print(f"警告: 向量数据库访问异常: {str(collection_error)}")
-        
-        return db
-    except Exception as e:
-        print(f"创建向量数据库实例时出错: {str(e)}")
-        raise
\ No newline at end of file
+            # 确保向量数据库目录存在
+            os.makedirs(CHROMA_PATH, exist_ok=True)
+
+            print(f"正在打开向量数据库集合: {collection_name}")
+
+            # 创建Chroma向量数据库
+            db = Chroma(
+                collection_name=collection_name,
+                persist_directory=CHROMA_PATH,
+                embedding_function=get_embedding_function()
+            )
+
+            # 检查数据库是否初始化成功（仅在首次打开时检查）
+            try:
+                collection_count = db._collection.count()
+                print(f"向量数据库集合 {collection_name} 包含 {collection_count} 条记录")
+            except Exception as collection_error:
+                print(f"警告: 向量数据库访问异常: {str(collection_error)}")
+
+            _db_registry[collection_name] = db
+
+            # 超出容量时淘汰最久未使用的集合句柄
+            while len(_db_registry) > max(VECTOR_DB_CACHE_SIZE, 1):
+                evicted_name, _ = _db_registry.popitem(last=False)
+                print(f"向量数据库缓存已满，释放集合句柄: {evicted_name}")
+
+            return db
+        except Exception as e:
+            print(f"创建向量数据库实例时出错: {str(e)}")
+            raise
+
+def invalidate_vector_db(kb_id=None):
+    """
+    从注册表中移除指定知识库的集合句柄（例如知识库被删除后）
+
+    参数:
+        kb_id: 知识库ID
+
+    返回:
+        bool: 注册表中是否存在该句柄
+    """
+    with _registry_lock:
+        return _db_registry.pop(get_collection_name(kb_id), None) is not None
+
+def find_legacy_chunks(collection, stored_filename):
+    """
+    查找没有document_id元数据的旧版块中属于某个文件的块
+
+    旧版块的source元数据是导入时的文件路径，文件名部分即存储文件名。
+
+    参数:
+        collection: Chroma集合
+        stored_filename: 文档的存储文件名
+
+    返回:
+        List[str]: 块ID
+    """
+    chunk_ids = []
+    offset = 0
+    while True:
+        batch = collection.get(include=["metadatas"], limit=_LEGACY_SCAN_BATCH_SIZE, offset=offset)
+        ids = batch.get("ids") or []
+        if not ids:
+            break
+        for chunk_id, metadata in zip(ids, batch.get("metadatas") or [None] * len(ids)):
+            metadata = metadata or {}
+            source = metadata.get("source")
+            if metadata.get("document_id") is None and source and os.path.basename(source) == stored_filename:
+                chunk_ids.append(chunk_id)
+        offset += len(ids)
+    return chunk_ids
+
+def delete_document_vectors(kb_id, doc_id, stored_filename=None):
+    """
+    从知识库的向量集合中删除某个文档的所有块
+
+    按document_id没有找到任何块时（在记录document_id之前导入的文档），
+    按source元数据中的文件名删除旧版块。
+
+    参数:
+        kb_id: 知识库ID
+        doc_id: 文档ID（导入时记录在每个块的document_id元数据中）
+        stored_filename: 文档的存储文件名 (可选)，用于查找旧版块
+
+    返回:
+        List[str]: 按文件名删除的旧版块ID，调用方需要同样从关键词索引中移除；按document_id删除时为空列表
+    """
+    collection = get_vector_db(kb_id)._collection
+    if collection.get(where={"document_id": doc_id}, include=[], limit=1)["ids"] or not stored_filename:
+        collection.delete(where={"document_id": doc_id})
+        return []
+
+    legacy_ids = find_legacy_chunks(collection, stored_filename)
+    for start in range(0, len(legacy_ids), _LEGACY_SCAN_BATCH_SIZE):
+        collection.delete(ids=legacy_ids[start:start + _LEGACY_SCAN_BATCH_SIZE])
+    if legacy_ids:
+        print(f"按文件名删除了文档 {doc_id} 的 {len(legacy_ids)} 个旧版块")
+    return legacy_ids
+
+def drop_vector_collection(kb_id):
+    """
+    删除知识库的整个向量集合并释放缓存的句柄（例如知识库被删除后）
+
+    参数:
+        kb_id: 知识库ID
+    """
+    with _registry_lock:
+        db = get_vector_db(kb_id)
+        db.delete_collection()
+        invalidate_vector_db(kb_id)
@@ -0,0 +1,103 @@
+import os
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from embed import save_upload, process_document
+from db_utils import create_ingestion_job, update_ingestion_job, get_ingestion_job
+
+# 使用环境变量配置
+DB_PATH = os.getenv('DB_PATH', './documents.db')
+# 同时处理的文档数量
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '2'))
+# 等待处理的任务数量上限，超出后拒绝新的上传
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '32'))
+
+_executor = ThreadPoolExecutor(max_workers=max(INGEST_WORKERS, 1), thread_name_prefix='ingest')
+# 正在处理和排队中的任务共享的名额
+_slots = threading.BoundedSemaphore(max(INGEST_WORKERS, 1) + max(INGEST_QUEUE_SIZE, 0))
+
+def _run_job(job_id, upload, kb_id):
+    """在后台线程中处理导入任务并记录状态"""
+    try:
+        success, doc_id, message = process_document(
+            upload,
+            kb_id,
+            progress=lambda stage, **details: update_ingestion_job(DB_PATH, job_id, stage, **details)
+        )
+        update_ingestion_job(DB_PATH, job_id, 'done' if success else 'failed', message, doc_id)
+    except Exception as e:
+        print(f"导入任务 {job_id} 执行失败: {str(e)}")
+        update_ingestion_job(DB_PATH, job_id, 'failed', f"Error embedding document: {str(e)}")
+    finally:
+        _slots.release()
+
+def submit_ingestion(file, kb_id=1):
+    """
+    保存上传的文件并提交后台导入任务
+
+    参数:
+        file: 上传的文件对象
+        kb_id: 知识库ID
+
+    返回:
+        tuple: (响应内容, HTTP状态码)
+    """
+    if not _slots.acquire(blocking=False):
+        return {"error": "ingestion queue is full, please retry later"}, 503
+
+    upload = None
+    try:
+        success, upload, error = save_upload(file, kb_id)
+        if not success:
+            _slots.release()
+            return {"error": error}, 400
+
+        # 同一知识库中已有相同内容的文件，直接返回已有文档
+        if upload["duplicate_of"]:
+            _slots.release()
+            return {
+                "message": "document already exists in this knowledge base",
+                "document_id": upload["duplicate_of"],
+                "duplicate": True
+            }, 200
+
+        job_id = uuid.uuid4().hex
+        existing = create_ingestion_job(DB_PATH, job_id, kb_id, file.filename, upload["stored_filename"],
+                                        upload["content_hash"])
+        if existing:
+            # 保存上传期间相同的文件已被导入，或仍在排队/处理中
+            _slots.release()
+            os.remove(upload["temp_file_path"])
+            if "document_id" in existing:
+                return {
+                    "message": "document already exists in this knowledge base",
+                    "document_id": existing["document_id"],
+                    "duplicate": True
+                }, 200
+            return {
+                "message": "the same document is already being embedded",
+                "job_id": existing["job_id"],
+                "status": existing["status"],
+                "status_url": f"/jobs/{existing['job_id']}",
+                "duplicate": True
+            }, 202
+
+        _executor.submit(_run_job, job_id, upload, kb_id)
+        print(f"导入任务已提交: {job_id} ({file.filename} -> 知识库 {kb_id})")
+        return {
+            "message": "document queued for embedding",
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": f"/jobs/{job_id}"
+        }, 202
+    except Exception as e:
+        _slots.release()
+        print(f"提交导入任务时出错: {str(e)}")
+        if upload and os.path.exists(upload["temp_file_path"]):
+            os.remove(upload["temp_file_path"])
+        return {"error": f"Error submitting ingestion job: {str(e)}"}, 500
+
+def get_job_status(job_id):
+    """获取导入任务的当前状态"""
+    return get_ingestion_job(DB_PATH, job_id)
@@ -0,0 +1,320 @@
+import os
+import re
+import math
+import threading
+from collections import Counter
+from typing import List, Dict, Tuple, Iterable
+
+from db_utils import get_db_connection
+
+# 使用环境变量配置
+DB_PATH = os.getenv('DB_PATH', './documents.db')
+# 关键词索引默认与documents.db放在同一目录
+KEYWORD_INDEX_PATH = os.getenv(
+    'KEYWORD_INDEX_PATH',
+    os.path.join(os.path.dirname(DB_PATH) or '.', 'keyword_index.db')
+)
+# BM25参数
+BM25_K1 = float(os.getenv('BM25_K1', '1.2'))
+BM25_B = float(os.getenv('BM25_B', '0.75'))
+# 出现在超过该比例的块中的查询词不参与检索：区分度很低，倒排列表却很长
+KEYWORD_MAX_DF_RATIO = float(os.getenv('KEYWORD_MAX_DF_RATIO', '0.5'))
+# 从集合中回填旧知识库索引时每次读取的记录数量
+_BACKFILL_BATCH_SIZE = 1000
+# SQLite单条语句的参数数量有限，按批次查询
+_LOOKUP_BATCH_SIZE = 500
+
+# 中日韩字符逐字索引；字母数字词按整体索引，
+# 带连接符的编号（如 "AB-1234"、"v2.1"）同时索引整体和各个部分
+_TERM_PATTERN = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯]|[^\W_]+(?:[-_./][^\W_]+)*')
+_PART_PATTERN = re.compile(r'[^\W_]+')
+
+# 检索时忽略的常见虚词；中日韩文字逐字索引，所以这里是单字
+_STOPWORDS = frozenset('''
+a an and are as at be but by for from has have how i in is it its of on or that the this to
+was were what when where which who why will with you your
+的 了 是 在 和 与 及 或 也 就 都 而 有 我 你 他 她 它 这 那 个 之 吗 呢 吧
+'''.split())
+
+# 写入索引的线程锁；检索只读，依靠WAL与写入并发进行
+_lock = threading.Lock()
+_initialized = False
+# 当前进程已确认建立了关键词索引的集合，避免每次查询都访问数据库
+_indexed_collections = set()
+# 集合名称 -> 回填锁，同一集合只回填一次，不同集合互不阻塞
+_backfill_locks = {}
+_backfill_locks_lock = threading.Lock()
+
+def _connect():
+    global _initialized
+    conn = get_db_connection(KEYWORD_INDEX_PATH)
+    if not _initialized:
+        conn.executescript('''
+        CREATE TABLE IF NOT EXISTS collections (
+            collection TEXT PRIMARY KEY,
+            chunk_count INTEGER NOT NULL DEFAULT 0,
+            total_length INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS chunks (
+            collection TEXT NOT NULL,
+            chunk_id TEXT NOT NULL,
+            document_id INTEGER,
+            length INTEGER NOT NULL,
+            PRIMARY KEY (collection, chunk_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_chunks_document ON chunks(collection, document_id);
+        CREATE TABLE IF NOT EXISTS postings (
+            collection TEXT NOT NULL,
+            term TEXT NOT NULL,
+            chunk_id TEXT NOT NULL,
+            tf INTEGER NOT NULL,
+            PRIMARY KEY (collection, term, chunk_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings(collection, chunk_id);
+        CREATE TABLE IF NOT EXISTS pending_backfills (
+            collection TEXT PRIMARY KEY
+        );
+        ''')
+        conn.commit()
+        _initialized = True
+    return conn
+
+def tokenize(text: str) -> List[str]:
+    """把文本切分为小写的索引词"""
+    terms = []
+    for match in _TERM_PATTERN.findall((text or '').lower()):
+        terms.append(match)
+        parts = _PART_PATTERN.findall(match)
+        if len(parts) > 1:
+            terms.extend(parts)
+    return terms
+
+def count_terms(text: str) -> int:
+    """统计文本中的词数（带连字符的词算一个，中日韩文字每个字算一个）"""
+    return len(_TERM_PATTERN.findall((text or '').lower()))
+
+def _add_chunks(conn, collection: str, chunks: Iterable[Tuple[str, str, dict]]) -> int:
+    chunk_rows = []
+    posting_rows = []
+    total_length = 0
+    for chunk_id, text, metadata in chunks:
+        counts = Counter(tokenize(text))
+        length = sum(counts.values())
+        total_length += length
+        chunk_rows.append((collection, chunk_id, (metadata or {}).get("document_id"), length))
+        posting_rows.extend((collection, term, chunk_id, tf) for term, tf in counts.items())
+
+    if not chunk_rows:
+        return 0
+
+    # 重复写入同一块时先移除旧的词项，保持统计一致
+    _remove_chunks(conn, collection, [row[1] for row in chunk_rows])
+    conn.executemany("INSERT INTO chunks (collection, chunk_id, document_id, length) VALUES (?, ?, ?, ?)", chunk_rows)
+    conn.executemany("INSERT INTO postings (collection, term, chunk_id, tf) VALUES (?, ?, ?, ?)", posting_rows)
+    conn.execute(
+        "UPDATE collections SET chunk_count = chunk_count + ?, total_length = total_length + ? WHERE collection = ?",
+        (len(chunk_rows), total_length, collection)
+    )
+    return len(chunk_rows)
+
+def _remove_chunks(conn, collection: str, chunk_ids: List[str]):
+    for i in range(0, len(chunk_ids), _LOOKUP_BATCH_SIZE):
+        batch = chunk_ids[i:i + _LOOKUP_BATCH_SIZE]
+        placeholders = ','.join('?' * len(batch))
+        count, total_length = conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks WHERE collection = ? AND chunk_id IN ({placeholders})",
+            [collection] + batch
+        ).fetchone()
+        if not count:
+            continue
+        conn.execute(f"DELETE FROM postings WHERE collection = ? AND chunk_id IN ({placeholders})", [collection] + batch)
+        conn.execute(f"DELETE FROM chunks WHERE collection = ? AND chunk_id IN ({placeholders})", [collection] + batch)
+        conn.execute(
+            "UPDATE collections SET chunk_count = chunk_count - ?, total_length = total_length - ? WHERE collection = ?",
+            (count, total_length, collection)
+        )
+
+def _backfill_lock(collection: str) -> threading.Lock:
+    with _backfill_locks_lock:
+        lock = _backfill_locks.get(collection)
+        if lock is None:
+            lock = _backfill_locks[collection] = threading.Lock()
+        return lock
+
+def _is_indexed(conn, collection: str) -> bool:
+    if not conn.execute("SELECT 1 FROM collections WHERE collection = ?", (collection,)).fetchone():
+        return False
+    # 回填中断（例如进程退出）的集合需要重新回填
+    return not conn.execute("SELECT 1 FROM pending_backfills WHERE collection = ?", (collection,)).fetchone()
+
+def ensure_keyword_index(db):
+    """
+    确保集合已有关键词索引；在引入索引之前创建的集合会从Chroma中读取全部块回填一次
+
+    已确认的集合记录在内存中，之后的调用不访问数据库。回填按批次写入，
+    只在写入每一批时持有全局写锁，其他集合的检索和写入不必等待回填完成。
+
+    参数:
+        db: Chroma向量数据库实例
+    """
+    collection = db._collection.name
+    if collection in _indexed_collections:
+        return
+
+    with _backfill_lock(collection):
+        if collection in _indexed_collections:
+            return
+
+        conn = _connect()
+        try:
+            if not _is_indexed(conn, collection):
+                with _lock:
+                    conn.execute("INSERT OR IGNORE INTO collections (collection) VALUES (?)", (collection,))
+                    conn.execute("INSERT OR IGNORE INTO pending_backfills (collection) VALUES (?)", (collection,))
+                    conn.commit()
+
+                total = db._collection.count()
+                if total:
+                    print(f"正在为集合 {collection} 建立关键词索引 ({total} 个块)...")
+                for offset in range(0, total, _BACKFILL_BATCH_SIZE):
+                    # 从Chroma读取时不持有写锁
+                    existing = db._collection.get(
+                        include=["documents", "metadatas"],
+                        limit=_BACKFILL_BATCH_SIZE,
+                        offset=offset
+                    )
+                    with _lock:
+                        _add_chunks(conn, collection, zip(existing["ids"], existing["documents"], existing["metadatas"]))
+                        conn.commit()
+
+                with _lock:
+                    conn.execute("DELETE FROM pending_backfills WHERE collection = ?", (collection,))
+                    conn.commit()
+        finally:
+            conn.close()
+
+        _indexed_collections.add(collection)
+
+def index_chunks(db, ids: List[str], texts: List[str], metadatas: List[dict]) -> int:
+    """
+    把新写入集合的块加入关键词索引
+
+    参数:
+        db: Chroma向量数据库实例
+        ids: 块ID
+        texts: 块文本
+        metadatas: 块元数据，document_id用于之后按文档删除
+
+    返回:
+        int: 加入索引的块数量
+    """
+    collection = db._collection.name
+    with _lock:
+        conn = _connect()
+        try:
+            conn.execute("INSERT OR IGNORE INTO collections (collection) VALUES (?)", (collection,))
+            added = _add_chunks(conn, collection, zip(ids, texts, metadatas))
+            conn.commit()
+            return added
+        finally:
+            conn.close()
+
+def remove_document_keywords(db, document_id: int):
+    """从关键词索引中移除某个文档的所有块"""
+    collection = db._collection.name
+    with _lock:
+        conn = _connect()
+        try:
+            rows = conn.execute(
+                "SELECT chunk_id FROM chunks WHERE collection = ? AND document_id = ?",
+                (collection, document_id)
+            ).fetchall()
+            _remove_chunks(conn, collection, [row[0] for row in rows])
+            conn.commit()
+        finally:
+            conn.close()
+
+def remove_chunk_keywords(db, chunk_ids: List[str]):
+    """从关键词索引中移除指定的块"""
+    collection = db._collection.name
+    with _lock:
+        conn = _connect()
+        try:
+            _remove_chunks(conn, collection, list(chunk_ids))
+            conn.commit()
+        finally:
+            conn.close()
+
+def drop_keyword_index(collection: str):
+    """删除整个集合的关键词索引（例如知识库被删除后）"""
+    _indexed_collections.discard(collection)
+    with _lock:
+        conn = _connect()
+        try:
+            conn.execute("DELETE FROM postings WHERE collection = ?", (collection,))
+            conn.execute("DELETE FROM chunks WHERE collection = ?", (collection,))
+            conn.execute("DELETE FROM collections WHERE collection = ?", (collection,))
+            conn.execute("DELETE FROM pending_backfills WHERE collection = ?", (collection,))
+            conn.commit()
+        finally:
+            conn.close()
+
+def keyword_search(db, query: str, k: int = 8) -> List[Tuple[str, float]]:
+    """
+    使用BM25在集合的倒排索引中检索
+
+    只读取查询词的倒排列表，不需要在请求时对文档重新分词。停用词和出现在
+    超过KEYWORD_MAX_DF_RATIO比例的块中的词不参与检索，避免读取很长的倒排列表。
+
+    参数:
+        db: Chroma向量数据库实例
+        query: 查询文本
+        k: 返回的块数量
+
+    返回:
+        List[Tuple[str, float]]: (块ID, BM25得分)，按得分降序排列
+    """
+    terms = [term for term in dict.fromkeys(tokenize(query)) if term not in _STOPWORDS]
+    if not terms:
+        return []
+
+    collection = db._collection.name
+    conn = _connect()
+    try:
+        stats = conn.execute(
+            "SELECT chunk_count, total_length FROM collections WHERE collection = ?",
+            (collection,)
+        ).fetchone()
+        if not stats or not stats[0]:
+            return []
+        chunk_count, total_length = stats
+
+        # 先统计文档频率（只扫描主键索引），去掉过于常见的词后再读取倒排列表
+        placeholders = ','.join('?' * len(terms))
+        document_frequency = dict(conn.execute(
+            f"SELECT term, COUNT(*) FROM postings WHERE collection = ? AND term IN ({placeholders}) GROUP BY term",
+            [collection] + terms
+        ).fetchall())
+        max_df = max(KEYWORD_MAX_DF_RATIO * chunk_count, 1)
+        terms = [term for term, df in document_frequency.items() if df <= max_df]
+        if not terms:
+            return []
+
+        placeholders = ','.join('?' * len(terms))
+        rows = conn.execute(f'''
+            SELECT p.term, p.chunk_id, p.tf, c.length
+            FROM postings p JOIN chunks c ON c.collection = p.collection AND c.chunk_id = p.chunk_id
+            WHERE p.collection = ? AND p.term IN ({placeholders})
+        ''', [collection] + terms).fetchall()
+    finally:
+        conn.close()
+
+    average_length = total_length / chunk_count if chunk_count else 1.0
+    scores: Dict[str, float] = {}
+    for term, chunk_id, tf, length in rows:
+        df = document_frequency[term]
+        idf = math.log(1 + (chunk_count - df + 0.5) / (df + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (average_length or 1.0))
+        scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
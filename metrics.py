@@ -0,0 +1,140 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+# 使用环境变量配置
+# 直方图的桶上限（秒），以逗号分隔
+METRICS_BUCKETS = tuple(
+    float(bucket) for bucket in
+    os.getenv('METRICS_BUCKETS', '0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120').split(',')
+)
+
+_HISTOGRAMS = {
+    "rag_stage_duration_seconds": "Duration of each query and ingestion stage",
+    "rag_request_duration_seconds": "End-to-end duration of query and ingestion requests",
+}
+
+class _Histogram:
+    """单个标签组合的累积直方图"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+_series: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], _Histogram] = {}
+_lock = threading.Lock()
+# 当前请求的各阶段耗时（秒）；未开始记录时为None
+_current_trace: ContextVar[Optional[Dict[str, float]]] = ContextVar('rag_trace', default=None)
+
+def _observe(name: str, value: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _series.get(key)
+        if histogram is None:
+            histogram = _series[key] = _Histogram(METRICS_BUCKETS)
+        histogram.observe(value)
+
+def start_trace(trace: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    """
+    开始记录当前请求（当前线程或协程上下文）的阶段耗时，返回之后会被填充的字典
+
+    传入已有的字典时继续记录到其中，例如流式响应的生成器在视图函数返回后才执行。
+    """
+    trace = {} if trace is None else trace
+    _current_trace.set(trace)
+    return trace
+
+def observe_stage(operation: str, stage: str, seconds: float):
+    """
+    记录一个阶段的耗时
+
+    参数:
+        operation: 所属操作 ('query' 或 'ingest')
+        stage: 阶段名称
+        seconds: 耗时（秒）
+    """
+    _observe("rag_stage_duration_seconds", seconds, operation=operation, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        # 同一阶段在一个请求中多次出现时累加
+        trace[stage] = round(trace.get(stage, 0.0) + seconds, 6)
+
+def observe_request(operation: str, seconds: float):
+    """记录一个完整请求的耗时"""
+    _observe("rag_request_duration_seconds", seconds, operation=operation)
+
+@contextmanager
+def span(stage: str, operation: str = 'query'):
+    """计时一个阶段；阶段抛出异常时同样记录耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(operation, stage, time.perf_counter() - start)
+
+def _format_labels(labels) -> str:
+    return ','.join(f'{key}="{value}"' for key, value in labels)
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+def render_metrics() -> str:
+    """以Prometheus文本格式导出所有直方图"""
+    with _lock:
+        snapshot = {
+            key: (list(histogram.counts), histogram.sum, histogram.count)
+            for key, histogram in _series.items()
+        }
+
+    lines = []
+    for name, description in _HISTOGRAMS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for (series_name, labels), (counts, total, count) in sorted(snapshot.items()):
+            if series_name != name:
+                continue
+            for bound, bucket_count in zip(METRICS_BUCKETS, counts):
+                bucket_labels = _format_labels(labels + (("le", _format_bound(bound)),))
+                lines.append(f"{name}_bucket{{{bucket_labels}}} {bucket_count}")
+            inf_labels = _format_labels(labels + (("le", "+Inf"),))
+            lines.append(f"{name}_bucket{{{inf_labels}}} {count}")
+            lines.append(f"{name}_sum{{{_format_labels(labels)}}} {total}")
+            lines.append(f"{name}_count{{{_format_labels(labels)}}} {count}")
+    return "\n".join(lines) + "\n"
+
+def render_cache_metrics(caches: Dict[str, Dict[str, int]]) -> str:
+    """
+    以Prometheus文本格式导出缓存统计
+
+    参数:
+        caches: 缓存名称 -> 统计字典；entries为当前条目数，其余键为进程启动以来的事件次数
+
+    返回:
+        str: rag_cache_events_total计数器和rag_cache_entries仪表
+    """
+    lines = [
+        "# HELP rag_cache_events_total Cache hits, misses, evictions and invalidations since process start",
+        "# TYPE rag_cache_events_total counter"
+    ]
+    for cache, stats in sorted(caches.items()):
+        for event, value in sorted(stats.items()):
+            if event != 'entries':
+                lines.append(f'rag_cache_events_total{{{_format_labels((("cache", cache), ("event", event)))}}} {value}')
+    lines.append("# HELP rag_cache_entries Entries currently held by each cache")
+    lines.append("# TYPE rag_cache_entries gauge")
+    for cache, stats in sorted(caches.items()):
+        if 'entries' in stats:
+            lines.append(f'rag_cache_entries{{{_format_labels((("cache", cache),))}}} {stats["entries"]}')
+    return "\n".join(lines) + "\n"
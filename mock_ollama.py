@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+结果确定的Ollama HTTP接口模拟服务，供benchmark.py使用
+
+提供/api/embed、/api/embeddings、/api/chat、/api/generate和/api/tags。
+嵌入向量是按词哈希的词袋向量，相似的文本得到相似的向量，检索结果仍然合理；
+回答由提示的哈希生成，相同的提示总是得到相同的回答。每个接口都会等待可配置的延迟，
+同时最多处理--parallel个请求，与设置了OLLAMA_NUM_PARALLEL的Ollama服务相同。
+"""
+import re
+import sys
+import json
+import time
+import math
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORD_PATTERN = re.compile(r'\w+')
+ANSWER_WORDS = (
+    "the document describes a method that reconstructs scenes from images using "
+    "gaussian primitives optimized with differentiable rendering and evaluated on "
+    "standard benchmarks with competitive quality and speed"
+).split()
+
+class MockOllamaConfig:
+    def __init__(self, dim=256, embed_latency=0.02, embed_latency_per_input=0.001,
+                 chat_latency=0.2, token_latency=0.01, answer_tokens=40, parallel=4):
+        self.dim = dim
+        self.embed_latency = embed_latency
+        self.embed_latency_per_input = embed_latency_per_input
+        self.chat_latency = chat_latency
+        self.token_latency = token_latency
+        self.answer_tokens = answer_tokens
+        self.parallel = max(parallel, 1)
+
+def embed_text(text, dim):
+    """把每个词哈希到dim个桶之一，返回归一化后的计数向量"""
+    vector = [0.0] * dim
+    for word in WORD_PATTERN.findall((text or "").lower()):
+        digest = hashlib.md5(word.encode("utf-8")).digest()
+        bucket = int.from_bytes(digest[:4], "little") % dim
+        vector[bucket] += 1.0 if digest[4] % 2 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector))
+    if not norm:
+        vector[0] = 1.0
+        return vector
+    return [value / norm for value in vector]
+
+def answer_tokens(prompt, count):
+    """为提示生成确定的回答token列表"""
+    # 查询改写提示要求每行输出一个改写后的问题
+    if "different versions" in prompt:
+        question = prompt.rsplit("Original question:", 1)[-1].strip()
+        lines = [f"{prefix} {question}" for prefix in ("What is", "Explain", "Describe", "Summarize", "Details on")]
+        return ["\n".join(lines)]
+
+    seed = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+    tokens = []
+    for i in range(count):
+        tokens.append(ANSWER_WORDS[(seed + i * 7) % len(ANSWER_WORDS)] + " ")
+    return tokens
+
+def _timestamp():
+    return datetime.now(timezone.utc).isoformat()
+
+def make_handler(config):
+    slots = threading.BoundedSemaphore(config.parallel)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_stream(self, events):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for event in events:
+                    line = (json.dumps(event) + "\n").encode("utf-8")
+                    self.wfile.write(f"{len(line):x}\r\n".encode("ascii") + line + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端中止了生成（例如查询改写超时），与Ollama一样停止生成
+                self.close_connection = True
+
+        def do_GET(self):
+            if self.path == "/":
+                body = b"Ollama is running"
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            elif self.path == "/api/tags":
+                self._send_json({"models": [{"name": "mock", "model": "mock"}]})
+            else:
+                self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            try:
+                payload = self._read_json()
+            except ValueError:
+                self._send_json({"error": "invalid JSON"}, 400)
+                return
+
+            with slots:
+                if self.path == "/api/embed":
+                    inputs = payload.get("input")
+                    inputs = [inputs] if isinstance(inputs, str) else list(inputs or [])
+                    time.sleep(config.embed_latency + config.embed_latency_per_input * len(inputs))
+                    self._send_json({
+                        "model": payload.get("model"),
+                        "embeddings": [embed_text(text, config.dim) for text in inputs]
+                    })
+                elif self.path == "/api/embeddings":
+                    time.sleep(config.embed_latency + config.embed_latency_per_input)
+                    self._send_json({"embedding": embed_text(payload.get("prompt", ""), config.dim)})
+                elif self.path in ("/api/chat", "/api/generate"):
+                    self._generate(payload, chat=self.path == "/api/chat")
+                else:
+                    self._send_json({"error": "not found"}, 404)
+
+        def _generate(self, payload, chat):
+            if chat:
+                prompt = "\n".join(str(message.get("content", "")) for message in payload.get("messages", []))
+            else:
+                prompt = payload.get("prompt", "")
+            model = payload.get("model")
+            tokens = answer_tokens(prompt, config.answer_tokens)
+
+            def message(content, done):
+                event = {"model": model, "created_at": _timestamp(), "done": done}
+                if chat:
+                    event["message"] = {"role": "assistant", "content": content}
+                else:
+                    event["response"] = content
+                if done:
+                    event.update({
+                        "done_reason": "stop",
+                        "prompt_eval_count": len(WORD_PATTERN.findall(prompt)),
+                        "eval_count": len(tokens)
+                    })
+                return event
+
+            def events():
+                time.sleep(config.chat_latency)
+                for token in tokens:
+                    yield message(token, False)
+                    time.sleep(config.token_latency)
+                yield message("", True)
+
+            if payload.get("stream", True):
+                self._send_stream(events())
+            else:
+                time.sleep(config.chat_latency + config.token_latency * len(tokens))
+                self._send_json(message("".join(tokens), True))
+
+    return Handler
+
+def start_server(host="127.0.0.1", port=0, config=None):
+    """在后台线程中启动模拟服务并返回它，端口可从server.server_address读取"""
+    server = ThreadingHTTPServer((host, port), make_handler(config or MockOllamaConfig()))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def add_latency_arguments(parser):
+    parser.add_argument("--dim", type=int, default=256, help="嵌入向量维度")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="每个嵌入请求的延迟（秒）")
+    parser.add_argument("--embed-latency-per-input", type=float, default=0.001, help="每段嵌入文本额外增加的延迟（秒）")
+    parser.add_argument("--chat-latency", type=float, default=0.2, help="生成第一个token之前的延迟（秒）")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="相邻token之间的延迟（秒）")
+    parser.add_argument("--answer-tokens", type=int, default=40, help="每个回答的token数量")
+    parser.add_argument("--parallel", type=int, default=4, help="同时处理的请求数量")
+
+def config_from_args(args):
+    return MockOllamaConfig(
+        dim=args.dim,
+        embed_latency=args.embed_latency,
+        embed_latency_per_input=args.embed_latency_per_input,
+        chat_latency=args.chat_latency,
+        token_latency=args.token_latency,
+        answer_tokens=args.answer_tokens,
+        parallel=args.parallel
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="结果确定的Ollama模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_server(args.host, args.port, config_from_args(args))
+    print(f"Ollama模拟服务正在监听 http://{args.host}:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
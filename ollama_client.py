@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager, asynccontextmanager
+from typing import List, Dict, Iterator, AsyncIterator, Optional
+
+import aiohttp
+import requests
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+# 使用环境变量配置
+OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
+# 与Ollama之间保持的最大连接数（同步客户端的连接池大小；异步客户端按事件循环计算）
+OLLAMA_MAX_CONNECTIONS = int(os.getenv('OLLAMA_MAX_CONNECTIONS', '32'))
+# 空闲连接的保持时间（秒）
+OLLAMA_KEEPALIVE_TIMEOUT = float(os.getenv('OLLAMA_KEEPALIVE_TIMEOUT', '60'))
+# 单次生成请求的超时（秒）
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '300'))
+# 每个模型同时发送给Ollama的请求数量，超出的请求在客户端排队
+OLLAMA_MODEL_CONCURRENCY = int(os.getenv('OLLAMA_MODEL_CONCURRENCY', '4'))
+# 按模型覆盖并发上限，格式为 "model=n,model=n"，例如 "nomic-embed-text=8,deepseek-r1:14b=1"
+OLLAMA_MODEL_CONCURRENCY_LIMITS = os.getenv('OLLAMA_MODEL_CONCURRENCY_LIMITS', '')
+# 已安装模型列表的缓存时间（秒）
+OLLAMA_MODELS_CACHE_TTL = float(os.getenv('OLLAMA_MODELS_CACHE_TTL', '60'))
+
+def _parse_limits(value: str) -> Dict[str, int]:
+    limits = {}
+    for item in value.split(','):
+        model, _, limit = item.partition('=')
+        try:
+            limits[model.strip()] = max(int(limit), 1)
+        except ValueError:
+            continue
+    return limits
+
+_model_limits = _parse_limits(OLLAMA_MODEL_CONCURRENCY_LIMITS)
+
+def get_model_concurrency(model: str) -> int:
+    """返回模型的并发上限，未单独配置的模型使用OLLAMA_MODEL_CONCURRENCY"""
+    return _model_limits.get(model, max(OLLAMA_MODEL_CONCURRENCY, 1))
+
+# ================ 同步客户端 ================
+
+# 进程内共享的HTTP会话，所有嵌入和生成请求复用保持连接
+_session = requests.Session()
+_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=max(OLLAMA_MAX_CONNECTIONS, 1)))
+_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max(OLLAMA_MAX_CONNECTIONS, 1)))
+
+# 模型名称 -> 信号量，限制每个模型同时进行的请求
+_model_slots = {}
+# (base_url, 模型, 文本) -> 正在进行的嵌入请求
+_inflight_embeddings = {}
+_lock = threading.Lock()
+
+@contextmanager
+def _model_slot(model: str):
+    with _lock:
+        slot = _model_slots.get(model)
+        if slot is None:
+            slot = _model_slots[model] = threading.BoundedSemaphore(get_model_concurrency(model))
+    with slot:
+        yield
+
+def _chat_payload(model: str, prompt: str, stream: bool) -> dict:
+    return {"model": model, "messages": [{"role": "user", "content": prompt}], "stream": stream}
+
+def _post_embed(model: str, texts: List[str], base_url: str, timeout: float) -> List[List[float]]:
+    with _model_slot(model):
+        response = _session.post(
+            f"{base_url.rstrip('/')}/api/embed",
+            json={"model": model, "input": texts},
+            timeout=timeout
+        )
+    response.raise_for_status()
+    embeddings = response.json().get("embeddings")
+    if not embeddings or len(embeddings) != len(texts):
+        raise ValueError(f"嵌入服务返回了 {len(embeddings or [])} 个向量，期望 {len(texts)} 个")
+    return embeddings
+
+def embed(model: str, texts: List[str], base_url: str = OLLAMA_BASE_URL,
+          timeout: float = LLM_TIMEOUT) -> List[List[float]]:
+    """
+    调用Ollama的/api/embed接口计算一组文本的嵌入向量
+
+    与正在进行的请求完全相同（同一模型、同一组文本）时不重复发送，
+    而是等待并共享那个请求的结果，例如多个用户同时提出相同的问题。
+
+    参数:
+        model: 嵌入模型名称
+        texts: 待嵌入的文本
+        base_url: Ollama服务地址
+        timeout: 请求超时（秒）
+
+    返回:
+        List[List[float]]: 与输入顺序一致的嵌入向量
+    """
+    key = (base_url, model, tuple(texts))
+    with _lock:
+        future = _inflight_embeddings.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight_embeddings[key] = Future()
+
+    if not owner:
+        return future.result()
+
+    try:
+        embeddings = _post_embed(model, texts, base_url, timeout)
+        future.set_result(embeddings)
+        return embeddings
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            _inflight_embeddings.pop(key, None)
+
+def chat(model: str, prompt: str) -> str:
+    """
+    调用Ollama的/api/chat接口并返回完整回答
+
+    参数:
+        model: 模型名称
+        prompt: 提示文本（作为一条用户消息发送）
+
+    返回:
+        str: 模型生成的文本
+    """
+    with _model_slot(model):
+        response = _session.post(f"{OLLAMA_BASE_URL}/api/chat", json=_chat_payload(model, prompt, False),
+                                 timeout=LLM_TIMEOUT)
+    response.raise_for_status()
+    result = response.json()
+    if result.get("error"):
+        raise ValueError(result["error"])
+    return (result.get("message") or {}).get("content", "")
+
+def chat_stream(model: str, prompt: str, stop_event: Optional[threading.Event] = None) -> Iterator[str]:
+    """
+    流式调用Ollama的/api/chat接口，逐块产生生成的文本
+
+    参数与chat相同。生成期间一直占用该模型的一个并发名额。
+    设置stop_event后在下一个片段到达时关闭连接，Ollama随即停止生成并释放名额。
+    """
+    with _model_slot(model):
+        # 排队等待名额期间已被取消时不再发送请求
+        if stop_event is not None and stop_event.is_set():
+            return
+        with _session.post(f"{OLLAMA_BASE_URL}/api/chat", json=_chat_payload(model, prompt, True),
+                           timeout=LLM_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            # Ollama以NDJSON逐行返回生成的片段
+            for line in response.iter_lines():
+                if stop_event is not None and stop_event.is_set():
+                    break
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event.get("error"):
+                    raise ValueError(event["error"])
+                content = (event.get("message") or {}).get("content")
+                if content:
+                    yield content
+                if event.get("done"):
+                    break
+
+_models = None
+_models_fetched_at = 0.0
+_models_lock = threading.Lock()
+
+def list_models(refresh: bool = False) -> List[str]:
+    """
+    返回Ollama中已安装的模型名称，结果缓存OLLAMA_MODELS_CACHE_TTL秒
+
+    参数:
+        refresh: 是否忽略缓存重新查询
+
+    返回:
+        List[str]: 模型名称，例如 ["mistral:latest", "nomic-embed-text:latest"]
+    """
+    global _models, _models_fetched_at
+    with _models_lock:
+        if not refresh and _models is not None and time.monotonic() - _models_fetched_at < OLLAMA_MODELS_CACHE_TTL:
+            return _models
+        response = _session.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=10)
+        response.raise_for_status()
+        _models = [model.get("name") or model.get("model") for model in response.json().get("models", [])]
+        _models_fetched_at = time.monotonic()
+        return _models
+
+def _same_model(requested: str, installed: str) -> bool:
+    requested, installed = requested.lower(), installed.lower()
+    return installed == requested or installed == f"{requested}:latest"
+
+def resolve_model(model: str) -> Optional[str]:
+    """
+    确认模型已安装；未安装时返回第一个已安装的模型，没有任何模型时返回None
+
+    无法获取模型列表时（例如Ollama暂时不可达）直接使用请求的模型，错误在生成时报告。
+    """
+    try:
+        models = list_models()
+    except Exception as e:
+        print(f"获取模型列表失败: {str(e)}")
+        return model
+
+    if any(_same_model(model, installed) for installed in models):
+        return model
+    if models:
+        print(f"模型 {model} 未安装，使用可用模型: {models[0]}")
+        return models[0]
+    return None
+
+class OllamaChat:
+    """
+    共享连接池上的聊天模型，接口与ChatOllama的invoke/stream一致
+
+    实例不保存连接，可以在所有请求之间共享。
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+
+    def invoke(self, prompt: str) -> AIMessage:
+        return AIMessage(content=chat(self.model, prompt))
+
+    def stream(self, prompt: str, stop_event: Optional[threading.Event] = None) -> Iterator[AIMessageChunk]:
+        for content in chat_stream(self.model, prompt, stop_event):
+            yield AIMessageChunk(content=content)
+
+_chat_models = {}
+
+def get_chat_model(model: str) -> OllamaChat:
+    """返回进程内共享的聊天模型实例"""
+    with _lock:
+        llm = _chat_models.get(model)
+        if llm is None:
+            llm = _chat_models[model] = OllamaChat(model)
+        return llm
+
+# ================ 异步客户端 ================
+
+# 事件循环 -> 共享的aiohttp会话；会话和信号量不能跨事件循环使用
+_async_sessions = {}
+_async_model_slots = {}
+
+def get_async_session() -> aiohttp.ClientSession:
+    """返回当前事件循环共享的HTTP会话，连接在请求之间保持复用"""
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=OLLAMA_MAX_CONNECTIONS, keepalive_timeout=OLLAMA_KEEPALIVE_TIMEOUT)
+        session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=LLM_TIMEOUT))
+        _async_sessions[loop] = session
+    return session
+
+async def close_async_session():
+    """关闭当前事件循环的共享会话（例如服务关闭时）"""
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _async_model_slots if key[0] is loop]:
+        del _async_model_slots[key]
+    session = _async_sessions.pop(loop, None)
+    if session is not None:
+        await session.close()
+
+@asynccontextmanager
+async def _async_model_slot(model: str):
+    key = (asyncio.get_running_loop(), model)
+    slot = _async_model_slots.get(key)
+    if slot is None:
+        slot = _async_model_slots[key] = asyncio.Semaphore(get_model_concurrency(model))
+    async with slot:
+        yield
+
+async def _raise_for_status(response: aiohttp.ClientResponse):
+    if response.status != 200:
+        detail = await response.text()
+        raise ValueError(f"Ollama返回状态码 {response.status}: {detail.strip()}")
+
+async def achat(model: str, prompt: str) -> str:
+    """
+    chat的异步版本
+
+    参数:
+        model: 模型名称
+        prompt: 提示文本（作为一条用户消息发送）
+
+    返回:
+        str: 模型生成的文本
+    """
+    session = get_async_session()
+    async with _async_model_slot(model):
+        async with session.post(f"{OLLAMA_BASE_URL}/api/chat", json=_chat_payload(model, prompt, False)) as response:
+            await _raise_for_status(response)
+            result = await response.json(content_type=None)
+    if result.get("error"):
+        raise ValueError(result["error"])
+    return (result.get("message") or {}).get("content", "")
+
+async def achat_stream(model: str, prompt: str) -> AsyncIterator[str]:
+    """
+    chat_stream的异步版本，参数与achat相同
+    """
+    session = get_async_session()
+    async with _async_model_slot(model):
+        async with session.post(f"{OLLAMA_BASE_URL}/api/chat", json=_chat_payload(model, prompt, True)) as response:
+            await _raise_for_status(response)
+            # Ollama以NDJSON逐行返回生成的片段
+            async for line in response.content:
+                line = line.strip()
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event.get("error"):
+                    raise ValueError(event["error"])
+                content = (event.get("message") or {}).get("content")
+                if content:
+                    yield content
+                if event.get("done"):
+                    break
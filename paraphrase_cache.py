@@ -0,0 +1,69 @@
+import os
+import re
+import json
+from typing import List, Optional, Dict
+
+from sqlite_cache import SqliteLRUCache, text_hash
+
+# 使用环境变量配置
+DB_PATH = os.getenv('DB_PATH', './documents.db')
+# 查询改写缓存默认与documents.db放在同一目录
+PARAPHRASE_CACHE_PATH = os.getenv(
+    'PARAPHRASE_CACHE_PATH',
+    os.path.join(os.path.dirname(DB_PATH) or '.', 'paraphrase_cache.db')
+)
+PARAPHRASE_CACHE_ENABLED = os.getenv('PARAPHRASE_CACHE_ENABLED', '1') not in ('0', 'false', 'False')
+# 缓存条目上限，超出后淘汰最久未使用的条目
+PARAPHRASE_CACHE_MAX_ENTRIES = int(os.getenv('PARAPHRASE_CACHE_MAX_ENTRIES', '50000'))
+# 缓存条目的有效期（秒），默认30天
+PARAPHRASE_CACHE_TTL = float(os.getenv('PARAPHRASE_CACHE_TTL', str(30 * 24 * 3600)))
+
+# 规范化查询时去掉的结尾标点
+_TRAILING_PUNCTUATION = re.compile(r'[\s?？!！.。,，;；:：]+$')
+
+_cache = SqliteLRUCache(
+    PARAPHRASE_CACHE_PATH,
+    table='paraphrases',
+    key_column='query_hash',
+    value_columns=[('variants', 'TEXT NOT NULL')],
+    max_entries=PARAPHRASE_CACHE_MAX_ENTRIES,
+    enabled=PARAPHRASE_CACHE_ENABLED,
+    ttl=PARAPHRASE_CACHE_TTL
+)
+
+def query_hash(query: str) -> str:
+    """对规范化后的查询计算哈希：忽略大小写、多余空白和结尾标点"""
+    return text_hash(_TRAILING_PUNCTUATION.sub('', (query or '').lower()))
+
+def get_cached_paraphrases(model: str, query: str) -> Optional[List[str]]:
+    """
+    查询缓存的查询改写
+
+    参数:
+        model: 生成改写的语言模型名称
+        query: 原始查询
+
+    返回:
+        Optional[List[str]]: 缓存的改写列表，未命中或已过期时为None
+    """
+    key = query_hash(query)
+    found = _cache.get_many(model or '', [key])
+    return json.loads(found[key][0]) if key in found else None
+
+def store_paraphrases(model: str, query: str, variants: List[str]):
+    """
+    将生成的查询改写写入缓存，并在超出容量时淘汰旧条目
+
+    参数:
+        model: 生成改写的语言模型名称
+        query: 原始查询
+        variants: 改写列表
+    """
+    if not variants:
+        return
+    # 覆盖过期的条目
+    _cache.put_many(model or '', [(query_hash(query), (json.dumps(variants, ensure_ascii=False),))], replace=True)
+
+def get_cache_stats() -> Dict[str, int]:
+    """返回进程启动以来的缓存命中、未命中和淘汰次数"""
+    return _cache.stats()
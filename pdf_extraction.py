@@ -0,0 +1,311 @@
+import io
+import os
+import re
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Iterator, Optional
+
+from langchain_core.documents import Document
+
+# 使用环境变量配置
+# 并行提取PDF页面的进程数量
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+# 每个进程任务处理的页数
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', '16'))
+# 原始字节回退时每次读取的字节数
+RAW_BLOCK_SIZE = 1024 * 1024
+# 原始字节回退时视为文本的字节：可打印ASCII字符和换行
+_PRINTABLE_BYTES = bytes(range(0x20, 0x7F)) + b'\n'
+
+# 按顺序尝试的提取方式，每一页单独回退
+PAGE_LOADERS = ('pypdf', 'unstructured', 'pdfminer', 'pdfplumber', 'pypdf2', 'raw')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    """
+    进程池在首次需要时创建，之后在所有导入任务之间共享
+
+    导入任务在多线程的服务进程中运行，子进程以spawn方式启动，不复制父进程中被其他线程持有的锁。
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=max(PDF_EXTRACT_WORKERS, 1),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+def _reset_executor(broken):
+    """丢弃已损坏的进程池（例如子进程因内存不足被终止），下次使用时重新创建"""
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def count_pages(file_path: str) -> Optional[int]:
+    """返回PDF的页数，文件结构无法解析时返回None"""
+    # 传入打开的文件而不是路径，阅读器按需读取对象，不会把整个文件读入内存
+    try:
+        import pypdf
+        with open(file_path, 'rb') as file:
+            return len(pypdf.PdfReader(file, strict=False).pages)
+    except Exception as e:
+        print(f"pypdf无法读取页数: {str(e)}")
+    try:
+        import PyPDF2
+        with open(file_path, 'rb') as file:
+            return len(PyPDF2.PdfReader(file, strict=False).pages)
+    except Exception as e:
+        print(f"PyPDF2无法读取页数: {str(e)}")
+    return None
+
+def _extract_printable_text(data: bytes) -> str:
+    """从原始字节中提取可打印的ASCII文本片段"""
+    text_chunks = re.findall(rb'[\x20-\x7E\n]{4,}', data)
+    return '\n'.join(chunk.decode('utf-8', errors='ignore') for chunk in text_chunks)
+
+class _PageExtractor:
+    """
+    在单个进程中提取一段连续页面的文本
+
+    每种提取方式的阅读器只在第一次需要时打开，并在该页面范围内复用；
+    后面的提取方式只处理前面的方式没有取得文本的页面。
+    阅读器基于打开的文件按需读取，每个进程不会把整个文件读入内存。
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._readers = {}
+        self._files = []
+
+    def _open(self):
+        file = open(self.file_path, 'rb')
+        self._files.append(file)
+        return file
+
+    def _reader(self, name):
+        if name not in self._readers:
+            if name == 'pypdf':
+                import pypdf
+                self._readers[name] = pypdf.PdfReader(self._open(), strict=False)
+            elif name == 'pdfplumber':
+                import pdfplumber
+                self._readers[name] = pdfplumber.open(self.file_path)
+            elif name == 'pypdf2':
+                import PyPDF2
+                self._readers[name] = PyPDF2.PdfReader(self._open(), strict=False)
+        return self._readers[name]
+
+    def _single_page_pdf(self, index: int) -> io.BytesIO:
+        """把一页单独写成PDF，供只接受整个文件的提取器使用"""
+        import pypdf
+        writer = pypdf.PdfWriter()
+        writer.add_page(self._reader('pypdf').pages[index])
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        buffer.seek(0)
+        return buffer
+
+    def _extract_page(self, loader: str, index: int) -> str:
+        if loader == 'pypdf':
+            return self._reader('pypdf').pages[index].extract_text() or ""
+        if loader == 'unstructured':
+            from unstructured.partition.pdf import partition_pdf
+            elements = partition_pdf(
+                file=self._single_page_pdf(index),
+                strategy="fast",
+                languages=["eng", "chi_sim"]
+            )
+            return "\n\n".join(str(element) for element in elements)
+        if loader == 'pdfplumber':
+            return self._reader('pdfplumber').pages[index].extract_text() or ""
+        if loader == 'pypdf2':
+            return self._reader('pypdf2').pages[index].extract_text() or ""
+        if loader == 'raw':
+            contents = self._reader('pypdf').pages[index].get_contents()
+            return _extract_printable_text(contents.get_data()) if contents is not None else ""
+        raise ValueError(f"未知的提取方式: {loader}")
+
+    def _extract_pdfminer(self, indexes: List[int]) -> Dict[int, str]:
+        """PDFMiner解析文档的代价较高，一次处理所有剩余页面"""
+        from pdfminer.high_level import extract_pages as pdfminer_extract_pages
+        from pdfminer.layout import LTTextContainer
+
+        texts = {}
+        layouts = pdfminer_extract_pages(self.file_path, page_numbers=indexes)
+        for index, layout in zip(sorted(indexes), layouts):
+            texts[index] = "".join(element.get_text() for element in layout if isinstance(element, LTTextContainer))
+        return texts
+
+    def extract(self, loader: str, indexes: List[int]) -> Dict[int, str]:
+        """
+        使用指定的提取方式提取多个页面
+
+        返回:
+            Dict[int, str]: 页码 -> 文本，单页失败时该页不出现在结果中
+        """
+        if loader == 'pdfminer':
+            return self._extract_pdfminer(indexes)
+
+        texts = {}
+        for index in indexes:
+            try:
+                texts[index] = self._extract_page(loader, index)
+            except Exception as e:
+                print(f"第 {index + 1} 页使用 {loader} 提取失败: {str(e)}")
+        return texts
+
+    def close(self):
+        plumber = self._readers.get('pdfplumber')
+        if plumber is not None:
+            plumber.close()
+        for file in self._files:
+            file.close()
+
+def extract_page_range(file_path: str, start: int, end: int, total_pages: int) -> List[Document]:
+    """
+    提取[start, end)范围内的页面；每一页按PAGE_LOADERS顺序回退，直到取得文本
+
+    返回:
+        List[Document]: 有内容的页面，按页码排序
+    """
+    extractor = _PageExtractor(file_path)
+    extracted = {}
+    missing = list(range(start, end))
+    try:
+        for loader in PAGE_LOADERS:
+            if not missing:
+                break
+            if loader != PAGE_LOADERS[0]:
+                print(f"第 {missing[0] + 1}-{missing[-1] + 1} 页中有 {len(missing)} 页没有内容，尝试 {loader}...")
+            try:
+                texts = extractor.extract(loader, missing)
+            except Exception as e:
+                print(f"{loader} 提取失败: {str(e)}")
+                continue
+            for index, text in texts.items():
+                if text and text.strip():
+                    extracted[index] = (text, loader)
+            missing = [index for index in missing if index not in extracted]
+    finally:
+        extractor.close()
+
+    return [
+        Document(
+            page_content=text,
+            metadata={
+                "source": file_path,
+                "page": index,
+                "total_pages": total_pages,
+                "extraction_method": loader
+            }
+        )
+        for index, (text, loader) in sorted(extracted.items())
+    ]
+
+def _printable_tail_start(data: bytes) -> int:
+    """返回末尾连续可打印字节的起始位置（线性扫描，没有可打印结尾时为len(data)）"""
+    return len(data.rstrip(_PRINTABLE_BYTES))
+
+def _iter_raw_file(file_path: str) -> Iterator[Document]:
+    """文件结构无法解析时，分块读取原始字节并提取文本，不把整个文件读入内存"""
+    print("Attempting raw PDF text extraction as last resort...")
+    part = 0
+    carry = b''
+    with open(file_path, 'rb') as file:
+        while True:
+            block = file.read(RAW_BLOCK_SIZE)
+            data = carry + block
+            carry = b''
+            if block:
+                # 末尾的可打印片段可能延续到下一块，留到下一轮处理
+                tail_start = _printable_tail_start(data)
+                if len(data) - tail_start <= RAW_BLOCK_SIZE:
+                    carry = data[tail_start:]
+                    data = data[:tail_start]
+
+            extracted_text = _extract_printable_text(data)
+            if extracted_text.strip():
+                yield Document(
+                    page_content=extracted_text,
+                    metadata={"source": file_path, "page": part, "extraction_method": "raw"}
+                )
+                part += 1
+
+            if not block:
+                break
+
+    if part:
+        print("Successfully extracted some text using raw binary parsing")
+
+def iter_pages(file_path: str) -> Iterator[Document]:
+    """
+    将PDF按页码范围拆分，在进程池中并行提取文本，并按页码顺序逐页产出
+
+    同时提交的页码范围数量有上限，因此内存占用只取决于正在处理的页面，
+    与文档的总页数无关。
+
+    参数:
+        file_path: PDF文件路径
+
+    返回:
+        Iterator[Document]: 每页一个Document，按页码顺序排列
+    """
+    total_pages = count_pages(file_path)
+    if not total_pages:
+        yield from _iter_raw_file(file_path)
+        return
+
+    per_task = max(PDF_PAGES_PER_TASK, 1)
+    page_ranges = [(start, min(start + per_task, total_pages)) for start in range(0, total_pages, per_task)]
+    ranges = iter(page_ranges)
+    yielded = False
+
+    # 页数较少时直接在当前进程提取，省去进程间传输的开销
+    if total_pages <= per_task or PDF_EXTRACT_WORKERS <= 1:
+        for start, end in ranges:
+            for page in extract_page_range(file_path, start, end, total_pages):
+                yielded = True
+                yield page
+    else:
+        print(f"使用 {PDF_EXTRACT_WORKERS} 个进程并行提取 {total_pages} 页")
+        # 进程池可能已被其他任务中崩溃的子进程损坏；尚未产出页面时换用新的进程池重试一次
+        for attempt in range(2):
+            executor = _get_executor()
+            pending = deque()
+
+            def submit_next():
+                next_range = next(ranges, None)
+                if next_range:
+                    pending.append(executor.submit(extract_page_range, file_path, next_range[0], next_range[1], total_pages))
+
+            try:
+                for _ in range(max(PDF_EXTRACT_WORKERS, 1) * 2):
+                    submit_next()
+                while pending:
+                    result = pending.popleft().result()
+                    submit_next()
+                    for page in result:
+                        yielded = True
+                        yield page
+                break
+            except BrokenProcessPool:
+                _reset_executor(executor)
+                if yielded or attempt:
+                    raise ValueError("PDF提取进程意外退出（可能是内存不足或解析器崩溃）")
+                print("PDF提取进程池已损坏，重新创建后重试")
+                ranges = iter(page_ranges)
+            finally:
+                # 调用方提前停止时取消尚未开始的任务
+                for future in pending:
+                    future.cancel()
+
+    if not yielded:
+        yield from _iter_raw_file(file_path)
@@ -1,19 +1,40 @@
 import os
+import abc
+import re
 import json
-from typing import List, Dict, Any, Optional
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator
 import numpy as np
 
-from langchain_community.chat_models import ChatOllama
 from langchain.prompts import ChatPromptTemplate, PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.documents import Document
-from langchain.retrievers.multi_query import MultiQueryRetriever
 from get_vector_db import get_vector_db
-from db_utils import get_db_connection
+from ollama_client import achat, achat_stream, resolve_model, get_chat_model
+from retrieval import generate_query_variants_within, retrieve_documents
+from answer_cache import lookup_answer, store_answer
+from embedding_cache import text_hash
+from context_packing import build_context
+from db_utils import get_original_filenames
+from metrics import span, observe_stage
 
 # 使用环境变量配置
 LLM_MODEL = os.getenv('LLM_MODEL', 'mistral')
 DB_PATH = os.getenv('DB_PATH', './documents.db')
+# 重排器：'keyword'（默认，关键词计数）或 'cross-encoder'（需要安装sentence-transformers）
+RERANKER = os.getenv('RERANKER', 'keyword')
+RERANKER_MODEL = os.getenv('RERANKER_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+# 交叉编码器每批打分的候选数量
+RERANK_BATCH_SIZE = int(os.getenv('RERANK_BATCH_SIZE', '16'))
+# 只对检索排名靠前的候选打分
+RERANK_TOP_N = int(os.getenv('RERANK_TOP_N', '20'))
+# 交叉编码器打分的时间预算（秒），超时后剩余候选保持检索顺序
+RERANK_TIMEOUT = float(os.getenv('RERANK_TIMEOUT', '2'))
+# 缓存的(查询, 块)得分数量
+RERANK_CACHE_SIZE = int(os.getenv('RERANK_CACHE_SIZE', '4096'))
 
 def get_prompt() -> tuple:
     """
@@ -49,7 +70,7 @@ def get_prompt() -> tuple:
 
 def get_document_metadata(doc_source: str) -> Optional[str]:
     """
-    从数据库中获取文档的原始文件名
+    获取文档的原始文件名
     
     参数:
         doc_source: 文档源路径
@@ -61,23 +82,38 @@ def get_document_metadata(doc_source: str) -> Optional[str]:
         return None
         
     source_file = os.path.basename(doc_source)
-    conn = get_db_connection(DB_PATH)
-    cursor = conn.cursor()
-    
+    return get_document_names([source_file]).get(source_file, source_file)
+
+def get_document_names(stored_filenames: List[str]) -> Dict[str, str]:
+    """批量获取存储文件名对应的原始文件名，出错时返回空字典"""
     try:
-        cursor.execute(
-            "SELECT original_filename FROM documents WHERE stored_filename = ?", 
-            (source_file,)
-        )
-        result = cursor.fetchone()
-        if result:
-            return result[0]
-        return source_file
+        return get_original_filenames(DB_PATH, stored_filenames)
     except Exception as e:
         print(f"获取文档元数据时出错: {str(e)}")
-        return source_file
-    finally:
-        conn.close()
+        return {}
+
+def calculate_relevance_scores(query_embedding, doc_embeddings) -> np.ndarray:
+    """
+    一次性计算查询与多个文档嵌入之间的相似度分数
+
+    参数:
+        query_embedding: 查询的嵌入向量
+        doc_embeddings: 文档嵌入向量矩阵 (每行一个文档)
+
+    返回:
+        np.ndarray: 每个文档的相似度分数 (0-100)
+    """
+    query_vector = np.asarray(query_embedding, dtype=np.float32)
+    doc_matrix = np.atleast_2d(np.asarray(doc_embeddings, dtype=np.float32))
+
+    # 使用余弦相似度计算相关性
+    norms = np.linalg.norm(doc_matrix, axis=1) * np.linalg.norm(query_vector)
+    dot_products = doc_matrix @ query_vector
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosine_similarity = np.where(norms > 0, dot_products / norms, -1.0)
+
+    # 将相似度转换为百分比分数；零向量得分为0
+    return np.clip((cosine_similarity + 1) * 50, 0, 100)
 
 def calculate_relevance_score(query_embedding, doc_embedding):
     """
@@ -90,17 +126,7 @@ def calculate_relevance_score(query_embedding, doc_embedding):
     返回:
         float: 相似度分数 (0-100)
     """
-    # 使用余弦相似度计算相关性
-    dot_product = np.dot(query_embedding, doc_embedding)
-    query_norm = np.linalg.norm(query_embedding)
-    doc_norm = np.linalg.norm(doc_embedding)
-    
-    if query_norm == 0 or doc_norm == 0:
-        return 0
-    
-    cosine_similarity = dot_product / (query_norm * doc_norm)
-    # 将相似度转换为百分比分数
-    return float(max(0, min(100, (cosine_similarity + 1) * 50)))
+    return float(calculate_relevance_scores(query_embedding, [doc_embedding])[0])
 
 def format_sources(retrieved_docs: List[Document], query_embedding=None, doc_embeddings=None) -> List[Dict[str, Any]]:
     """
@@ -116,6 +142,23 @@ def format_sources(retrieved_docs: List[Document], query_embedding=None, doc_emb
     """
     sources = []
     
+    # 新导入的块在元数据中记录了原始文件名；旧块按存储文件名一次性批量查询
+    legacy_files = [
+        os.path.basename(doc.metadata['source'])
+        for doc in retrieved_docs
+        if doc.metadata and not doc.metadata.get('original_filename') and doc.metadata.get('source')
+    ]
+    document_names = get_document_names(legacy_files) if legacy_files else {}
+    
+    # 对所有带向量的文档一次性计算相关度分数
+    relevance_scores = [None] * len(retrieved_docs)
+    if query_embedding is not None and doc_embeddings is not None:
+        scored = [i for i in range(min(len(retrieved_docs), len(doc_embeddings))) if doc_embeddings[i] is not None]
+        if scored:
+            scores = calculate_relevance_scores(query_embedding, [doc_embeddings[i] for i in scored])
+            for i, score in zip(scored, scores):
+                relevance_scores[i] = float(score)
+    
     for i, doc in enumerate(retrieved_docs):
         # 提取文档内容
         content = doc.page_content
@@ -123,12 +166,14 @@ def format_sources(retrieved_docs: List[Document], query_embedding=None, doc_emb
         # 获取文档元数据
         metadata = doc.metadata
         source_path = metadata.get('source') if metadata else None
-        document_name = get_document_metadata(source_path) or "未知文档"
+        source_file = os.path.basename(source_path) if source_path else None
+        document_name = (
+            (metadata.get('original_filename') if metadata else None)
+            or document_names.get(source_file, source_file)
+            or "未知文档"
+        )
         
-        # 计算相关度分数 (如果提供了嵌入向量)
-        relevance_score = None
-        if query_embedding is not None and doc_embeddings is not None and i < len(doc_embeddings):
-            relevance_score = calculate_relevance_score(query_embedding, doc_embeddings[i])
+        relevance_score = relevance_scores[i]
         
         # 创建源信息对象
         source_info = {
@@ -142,7 +187,7 @@ def format_sources(retrieved_docs: List[Document], query_embedding=None, doc_emb
         if metadata:
             # 过滤掉不需要的大型元数据 (如嵌入向量)
             filtered_metadata = {k: v for k, v in metadata.items() 
-                                if k not in ['source'] and not isinstance(v, (list, np.ndarray)) 
+                                if k not in ['source', 'original_filename'] and not isinstance(v, (list, np.ndarray)) 
                                 or (isinstance(v, list) and len(v) < 20)}
             source_info["metadata"] = filtered_metadata
         
@@ -150,7 +195,7 @@ def format_sources(retrieved_docs: List[Document], query_embedding=None, doc_emb
     
     # 按相关度分数排序 (如果有)
     if sources and sources[0].get("relevance_score") is not None:
-        sources.sort(key=lambda x: x.get("relevance_score", 0), reverse=True)
+        sources.sort(key=lambda x: x.get("relevance_score") or 0, reverse=True)
     
     return sources
 
@@ -158,42 +203,155 @@ def clean_llm_response(response: str) -> str:
     """
     清理LLM响应中的内部思考和特殊标记
     
+    与流式输出使用同一个StreamingResponseCleaner，因此流式返回的片段拼接起来
+    与最终回答完全一致。
+    
     参数:
         response: LLM原始响应
         
     返回:
         str: 清理后的响应
     """
-    if not response:
-        return "抱歉，无法生成回答。"
-    
-    # 移除<think>...</think>块
-    import re
-    response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
-    
-    # 移除其他可能的思考标记
-    response = re.sub(r'\*\*思考：.*?\*\*', '', response, flags=re.DOTALL)
-    response = re.sub(r'\*\*thinking:.*?\*\*', '', response, flags=re.DOTALL)
-    response = re.sub(r'<thinking>.*?</thinking>', '', response, flags=re.DOTALL)
-    
-    # 移除常见的思考引导词
-    response = re.sub(r'(^|\n)让我思考一下[.：:][^\n]*\n', '\n', response)
-    response = re.sub(r'(^|\n)Let me think[.：:][^\n]*\n', '\n', response)
-    
-    # 移除XML和Markdown中常见的特殊标记
-    response = re.sub(r'</?[a-zA-Z][^>]*>', '', response)  # XML标签
-    
-    # 处理可能的引用格式保持一致
-    response = re.sub(r'```[a-zA-Z]*\n', '', response)  # 代码块开始标记
-    response = re.sub(r'```\n?', '', response)  # 代码块结束标记
-    
-    # 处理换行，保证段落之间有适当的空白
-    response = re.sub(r'\n{3,}', '\n\n', response)  # 多个换行替换为两个
-    
-    # 确保文本有适当的首尾格式
-    response = response.strip()
-    
-    return response
+    cleaner = StreamingResponseCleaner()
+    return cleaner.feed(response) + cleaner.flush()
+
+class StreamingResponseCleaner:
+    """
+    逐块清理LLM响应，规则:
+    - 移除<think>/<thinking>思考块，以及**思考：...**、**thinking:...**
+    - 移除以"让我思考一下"或"Let me think"加标点开头的整行
+    - 移除XML标签（保留标签之间的文本）和代码块标记
+    - 连续三个以上的换行合并为两个，去掉首尾空白
+
+    标签、代码块标记和思考引导词可能跨越多个token到达，因此无法确定的前缀会暂存
+    在缓冲区，直到能判断它是否需要移除为止；末尾的空白也会暂存，直到后面出现可见文本。
+    """
+
+    # 开始标记 -> 结束标记，两者之间的内容全部丢弃
+    SKIP_BLOCKS = {
+        '<think>': '</think>',
+        '<thinking>': '</thinking>',
+        '**思考：': '**',
+        '**thinking:': '**',
+    }
+    # 出现在行首时整行丢弃的思考引导词
+    LINE_PREFIXES = tuple(prefix + mark for prefix in ('让我思考一下', 'Let me think') for mark in '.：:')
+    # 超过该长度仍未闭合的"标签"按普通文本输出
+    MAX_TAG_LENGTH = 256
+    EMPTY_ANSWER = "抱歉，无法生成回答。"
+
+    _TAG = re.compile(r'</?[a-zA-Z][^<>\n]*>')
+    _PARTIAL_TAG = re.compile(r'<(/?|/?[a-zA-Z][^<>\n]*)$')
+    _FENCE = re.compile(r'```([a-zA-Z]*)(\n?)')
+
+    def __init__(self):
+        self._buffer = ""
+        # 正在丢弃的块的结束标记；为"\n"时丢弃到行尾
+        self._close = None
+        self._line_start = True
+        self._started = False
+        self._pending_space = ""
+
+    def feed(self, text: str) -> str:
+        """
+        输入一段新生成的文本，返回可以立即发送给客户端的部分
+
+        参数:
+            text: 模型新生成的文本片段
+
+        返回:
+            str: 过滤后的文本（可能为空字符串）
+        """
+        self._buffer += text or ""
+        return self._emit(self._process(final=False))
+
+    def flush(self) -> str:
+        """生成结束时调用，返回缓冲区中剩余的可见文本；整个回答为空时返回提示语"""
+        text = self._emit(self._process(final=True))
+        self._buffer = ""
+        self._close = None
+        self._pending_space = ""
+        if not self._started:
+            self._started = True
+            return self.EMPTY_ANSWER
+        return text
+
+    def _process(self, final: bool) -> str:
+        output = []
+        buffer = self._buffer
+        i = 0
+        while i < len(buffer):
+            # 处于需要丢弃的块中：丢弃内容直到遇到结束标记
+            if self._close:
+                end = buffer.find(self._close, i)
+                if end == -1:
+                    # 保留可能被截断的结束标记前缀
+                    i = max(i, len(buffer) - len(self._close) + 1)
+                    break
+                i = end + len(self._close)
+                self._line_start = self._close == '\n'
+                self._close = None
+                continue
+
+            rest = buffer[i:]
+            if self._line_start:
+                prefix = next((p for p in self.LINE_PREFIXES if rest.startswith(p)), None)
+                if prefix:
+                    self._close = '\n'
+                    i += len(prefix)
+                    continue
+                if not final and any(p.startswith(rest) for p in self.LINE_PREFIXES):
+                    break
+
+            char = buffer[i]
+            if char in '<*':
+                opening = next((tag for tag in self.SKIP_BLOCKS if rest.startswith(tag)), None)
+                if opening:
+                    self._close = self.SKIP_BLOCKS[opening]
+                    i += len(opening)
+                    continue
+                if not final and any(tag.startswith(rest) for tag in self.SKIP_BLOCKS):
+                    break
+                if char == '<':
+                    tag = self._TAG.match(rest)
+                    if tag:
+                        i += tag.end()
+                        continue
+                    if not final and len(rest) <= self.MAX_TAG_LENGTH and self._PARTIAL_TAG.match(rest):
+                        break
+            elif char == '`':
+                fence = self._FENCE.match(rest)
+                if fence:
+                    # 语言名之后还可能有换行，等待更多文本
+                    if not final and fence.end() == len(rest) and not fence.group(2):
+                        break
+                    # 语言名只有后面紧跟换行时才一起移除
+                    i += fence.end() if fence.group(2) else 3
+                    continue
+                if not final and '```'.startswith(rest):
+                    break
+
+            output.append(char)
+            self._line_start = char == '\n'
+            i += 1
+
+        self._buffer = buffer[i:] if not final else ""
+        return ''.join(output)
+
+    def _emit(self, text: str) -> str:
+        output = []
+        for char in text:
+            if char.isspace():
+                # 去掉回答开头的空白；其他空白等后面出现可见文本时再输出
+                if self._started:
+                    self._pending_space += char
+                continue
+            if self._pending_space:
+                output.append(re.sub(r'\n{3,}', '\n\n', self._pending_space))
+                self._pending_space = ""
+            output.append(char)
+            self._started = True
+        return ''.join(output)
 
 def rerank_documents(query: str, docs: List[Document]) -> List[Document]:
     """
@@ -234,108 +392,232 @@ def rerank_documents(query: str, docs: List[Document]) -> List[Document]:
         print(f"重新排序文档时出错: {str(e)}")
         return docs  # 出错时返回原始文档顺序
 
-def perform_query(input_query: str, kb_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+class Reranker(abc.ABC):
+    """重排器接口：接收查询和按检索得分排序的候选文档，返回重新排序后的文档列表"""
+
+    name = "base"
+
+    @abc.abstractmethod
+    def rerank(self, query: str, docs: List[Document]) -> List[Document]:
+        ...
+
+class KeywordReranker(Reranker):
+    """默认重排器：按查询关键词在文档中出现的次数排序"""
+
+    name = "keyword"
+
+    def rerank(self, query: str, docs: List[Document]) -> List[Document]:
+        return rerank_documents(query, docs)
+
+class CrossEncoderReranker(Reranker):
     """
-    执行查询并返回回答与来源
-    
+    使用本地交叉编码器（sentence-transformers的CrossEncoder）对(查询, 块)成对打分
+
+    只对检索排名前top_n的候选打分，并按batch_size分批计算；超过时间预算后
+    停止打分，未打分的候选保持检索顺序排在已打分候选之后。
+    (查询, 块)得分按LRU缓存，重复的问题不再经过模型。
+    """
+
+    name = "cross-encoder"
+
+    def __init__(self, model_name: str = RERANKER_MODEL, batch_size: int = RERANK_BATCH_SIZE,
+                 top_n: int = RERANK_TOP_N, timeout: float = RERANK_TIMEOUT,
+                 cache_size: int = RERANK_CACHE_SIZE):
+        # 可选依赖，只有启用交叉编码器时才需要安装
+        from sentence_transformers import CrossEncoder
+
+        self.model_name = model_name
+        self.model = CrossEncoder(model_name)
+        self.batch_size = max(batch_size, 1)
+        self.top_n = max(top_n, 1)
+        self.timeout = timeout
+        self.cache_size = max(cache_size, 0)
+        self._cache = OrderedDict()  # (查询, 块文本哈希) -> 得分
+        self._cache_lock = threading.Lock()
+        self._model_lock = threading.Lock()
+
+    def _cache_key(self, query: str, doc: Document):
+        return query, text_hash(doc.page_content)
+
+    def _cached_score(self, key) -> Optional[float]:
+        with self._cache_lock:
+            score = self._cache.get(key)
+            if score is not None:
+                self._cache.move_to_end(key)
+            return score
+
+    def _store_scores(self, keys, scores):
+        if not self.cache_size:
+            return
+        with self._cache_lock:
+            for key, score in zip(keys, scores):
+                self._cache[key] = score
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def rerank(self, query: str, docs: List[Document]) -> List[Document]:
+        start = time.perf_counter()
+        candidates = docs[:self.top_n]
+        keys = [self._cache_key(query, doc) for doc in candidates]
+        scores = [self._cached_score(key) for key in keys]
+        pending = [i for i, score in enumerate(scores) if score is None]
+
+        for offset in range(0, len(pending), self.batch_size):
+            if self.timeout is not None and time.perf_counter() - start > self.timeout:
+                print(f"交叉编码器重排超过 {self.timeout} 秒，{len(pending) - offset} 个候选未打分")
+                break
+            batch = pending[offset:offset + self.batch_size]
+            pairs = [(query, candidates[i].page_content) for i in batch]
+            # 模型不保证线程安全，同一进程内的请求依次使用
+            with self._model_lock:
+                batch_scores = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+            batch_scores = [float(score) for score in batch_scores]
+            for i, score in zip(batch, batch_scores):
+                scores[i] = score
+            self._store_scores([keys[i] for i in batch], batch_scores)
+
+        # 已打分的候选按得分降序；未打分的候选和top_n之外的文档保持检索顺序
+        scored = sorted((i for i, score in enumerate(scores) if score is not None),
+                        key=lambda i: scores[i], reverse=True)
+        unscored = [i for i, score in enumerate(scores) if score is None]
+        return [candidates[i] for i in scored + unscored] + docs[self.top_n:]
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+def get_reranker() -> Reranker:
+    """
+    返回进程内共享的重排器，由RERANKER环境变量选择 ('keyword' 或 'cross-encoder')
+
+    交叉编码器依赖未安装或模型加载失败时回退到关键词重排器。
+    """
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            if RERANKER == CrossEncoderReranker.name:
+                try:
+                    print(f"正在加载重排模型: {RERANKER_MODEL}")
+                    _reranker = CrossEncoderReranker()
+                except Exception as reranker_error:
+                    print(f"加载交叉编码器失败，使用关键词重排: {str(reranker_error)}")
+                    _reranker = KeywordReranker()
+            else:
+                if RERANKER != KeywordReranker.name:
+                    print(f"未知的重排器 {RERANKER}，使用关键词重排")
+                _reranker = KeywordReranker()
+        return _reranker
+
+def _prepare_query(input_query: str, kb_id: Optional[int] = None, paraphrase: bool = True,
+                   paraphrase_timeout: Optional[float] = None,
+                   query_embedding: Optional[List[float]] = None) -> Dict[str, Any]:
+    """
+    执行回答生成之前的所有步骤：校验、检索、重排和构造提示
+
     参数:
         input_query: 用户输入的查询
         kb_id: 知识库ID (可选)
-        
+        paraphrase: 是否使用语言模型生成查询改写
+        paraphrase_timeout: 生成查询改写的时间预算（秒），默认使用PARAPHRASE_TIMEOUT
+        query_embedding: 已经计算好的查询向量 (可选)，例如异步模式中与校验同时计算
+
     返回:
-        Dict[str, Any]: 包含回答和源信息的响应对象，失败时返回带有错误信息的字典
+        Dict[str, Any]: 失败时包含"error"；没有检索结果时包含"response"；
+        否则包含llm、formatted_prompt、top_docs、context_stats（上下文token统计）、retrieval（检索时的向量）和cache_generation
     """
     if not input_query:
         return {"error": "查询内容不能为空", "detail": "请提供一个有效的查询"}
-    
+
+    # 从环境变量获取模型名称，并尝试匹配已安装的模型
+    model_name = os.getenv('LLM_MODEL', 'deepseek-r1:14b')
+    embedding_model_name = os.getenv('TEXT_EMBEDDING_MODEL', 'nomic-embed-text')
+
+    print(f"使用语言模型: {model_name}")
+    print(f"使用嵌入模型: {embedding_model_name}")
+
+    # 验证知识库ID (如果提供)
+    if kb_id is not None:
+        from db_utils import check_knowledge_base_exists
+        with span('kb_validation'):
+            kb_exists = check_knowledge_base_exists(DB_PATH, kb_id)
+        if not kb_exists:
+            return {
+                "error": "知识库不存在",
+                "detail": f"ID为{kb_id}的知识库不存在"
+            }
+
+    # 获取向量数据库实例
     try:
-        # 从环境变量获取模型名称，并尝试匹配已安装的模型
-        import subprocess
-        model_name = os.getenv('LLM_MODEL', 'deepseek-r1:14b')
-        embedding_model_name = os.getenv('TEXT_EMBEDDING_MODEL', 'nomic-embed-text')
-        
-        print(f"使用语言模型: {model_name}")
-        print(f"使用嵌入模型: {embedding_model_name}")
-        
-        # 验证知识库ID (如果提供)
-        if kb_id is not None:
-            from db_utils import check_knowledge_base_exists
-            if not check_knowledge_base_exists(DB_PATH, kb_id):
-                return {
-                    "error": "知识库不存在",
-                    "detail": f"ID为{kb_id}的知识库不存在"
-                }
-        
-        # 初始化语言模型
-        try:
-            llm = ChatOllama(model=model_name)
-        except Exception as model_error:
-            print(f"初始化语言模型时出错: {str(model_error)}")
-            # 尝试使用已安装的任意可用模型
-            try:
-                process = subprocess.run(['ollama', 'list'], capture_output=True, text=True)
-                models = process.stdout.strip().split('\n')[1:]  # 跳过标题行
-                if models:
-                    # 提取第一个可用模型的名称
-                    available_model = models[0].split()[0]
-                    print(f"尝试使用可用模型: {available_model}")
-                    llm = ChatOllama(model=available_model)
-                else:
-                    return {
-                        "error": "无法初始化语言模型",
-                        "detail": f"指定的模型 {model_name} 不可用，且没有其他可用模型"
-                    }
-            except Exception as fallback_error:
-                return {
-                    "error": "无法初始化语言模型",
-                    "detail": f"原始错误: {str(model_error)}, 回退错误: {str(fallback_error)}"
-                }
-        
-        # 获取向量数据库实例
-        try:
+        with span('get_vector_db'):
             db = get_vector_db(kb_id)
             # 检查向量数据库是否为空
-            if hasattr(db, '_collection') and db._collection.count() == 0:
-                return {
-                    "error": "知识库为空",
-                    "detail": f"知识库 {kb_id if kb_id else '默认'} 中没有文档，请先上传文档"
-                }
-        except Exception as db_error:
-            print(f"获取向量数据库时出错: {str(db_error)}")
+            is_empty = hasattr(db, '_collection') and db._collection.count() == 0
+        if is_empty:
             return {
-                "error": "无法访问向量数据库",
-                "detail": str(db_error)
+                "error": "知识库为空",
+                "detail": f"知识库 {kb_id if kb_id else '默认'} 中没有文档，请先上传文档"
             }
-        
-        # 获取提示模板
-        query_prompt, answer_prompt = get_prompt()
+    except Exception as db_error:
+        print(f"获取向量数据库时出错: {str(db_error)}")
+        return {
+            "error": "无法访问向量数据库",
+            "detail": str(db_error)
+        }
 
-        # 设置多重查询检索器
+    # 先查询回答缓存，与之前的问题足够相似时直接返回缓存的回答
+    if query_embedding is None:
         try:
-            retriever = MultiQueryRetriever.from_llm(
-                retriever=db.as_retriever(search_kwargs={"k": 8}),
-                llm=llm,
-                prompt=query_prompt
-            )
-        except Exception as retriever_error:
-            print(f"创建检索器时出错: {str(retriever_error)}")
-            return {
-                "error": "无法创建文档检索器",
-                "detail": str(retriever_error)
-            }
-        
-        # 执行检索以获取相关文档
-        try:
-            retrieved_docs = retriever.get_relevant_documents(input_query)
-        except Exception as retrieve_error:
-            print(f"检索文档时出错: {str(retrieve_error)}")
+            with span('query_embedding'):
+                query_embedding = db._embedding_function.embed_query(input_query)
+        except Exception as embed_error:
+            print(f"嵌入查询时出错: {str(embed_error)}")
             return {
                 "error": "文档检索失败",
-                "detail": str(retrieve_error)
+                "detail": str(embed_error)
             }
-        
-        if not retrieved_docs:
-            return {
+    with span('answer_cache'):
+        cached_response, cache_generation = lookup_answer(kb_id, query_embedding)
+    if cached_response is not None:
+        cached_response["query"] = {"original": input_query, "kb_id": kb_id}
+        cached_response["cached"] = True
+        return {"response": cached_response}
+
+    # 获取共享的语言模型客户端；模型未安装时使用任意已安装的模型（已安装模型列表有缓存）
+    llm_init_start = time.perf_counter()
+    available_model = resolve_model(model_name)
+    if available_model is None:
+        return {
+            "error": "无法初始化语言模型",
+            "detail": f"指定的模型 {model_name} 不可用，且没有其他可用模型"
+        }
+    llm = get_chat_model(available_model)
+
+    observe_stage('query', 'llm_init', time.perf_counter() - llm_init_start)
+
+    # 获取提示模板
+    query_prompt, answer_prompt = get_prompt()
+
+    # 在时间预算内生成多个查询改写；关闭、超时或失败时仅使用原始查询
+    query_variants = []
+    if paraphrase:
+        with span('paraphrase'):
+            query_variants = generate_query_variants_within(llm, query_prompt, input_query, paraphrase_timeout)
+
+    # 一次检索所有查询并融合结果，同时取回存储的块向量用于计算相关度
+    try:
+        with span('retrieval'):
+            retrieval = retrieve_documents(db, [input_query] + query_variants, query_embedding=query_embedding)
+        retrieved_docs = retrieval["documents"]
+    except Exception as retrieve_error:
+        print(f"检索文档时出错: {str(retrieve_error)}")
+        return {
+            "error": "文档检索失败",
+            "detail": str(retrieve_error)
+        }
+
+    if not retrieved_docs:
+        return {
+            "response": {
                 "answer": "抱歉，没有找到相关的信息来回答您的问题。",
                 "sources": [],
                 "query": {
@@ -343,59 +625,245 @@ def perform_query(input_query: str, kb_id: Optional[int] = None) -> Optional[Dic
                     "kb_id": kb_id
                 }
             }
+        }
+
+    # 重新排序文档以提高相关性
+    try:
+        with span('rerank'):
+            reranked_docs = get_reranker().rerank(input_query, retrieved_docs)
+    except Exception as rerank_error:
+        print(f"重新排序文档时出错: {str(rerank_error)}")
+        reranked_docs = retrieved_docs
+
+    # 在模型的token预算内打包上下文：去除近似重复的块，过长的块只保留相关句子
+    with span('context_packing'):
+        packed = build_context(input_query, reranked_docs, getattr(llm, 'model', model_name))
+    print(f"上下文使用 {packed['token_count']}/{packed['token_budget']} 个token，"
+          f"{len(packed['documents'])} 个块，跳过 {packed['duplicates']} 个重复块")
+
+    return {
+        "llm": llm,
+        "formatted_prompt": answer_prompt.format(context=packed["context"], question=input_query),
+        "top_docs": packed["documents"],
+        "context_stats": {
+            "token_count": packed["token_count"],
+            "token_budget": packed["token_budget"],
+            "chunk_count": len(packed["documents"])
+        },
+        "retrieval": retrieval,
+        "cache_generation": cache_generation
+    }
+
+def _build_sources(top_docs: List[Document], retrieval: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """使用检索时已取得的查询向量和块向量格式化源信息 (包含相关度分数)"""
+    with span('scoring'):
+        try:
+            doc_embeddings = [retrieval["embeddings"].get(doc.id) for doc in top_docs]
+            return format_sources(top_docs, retrieval["query_embedding"], doc_embeddings)
+        except Exception as score_error:
+            print(f"计算相关度分数时出错: {str(score_error)}")
+            # 继续而不计算相关度分数
+            return format_sources(top_docs)
+
+def _finish_response(input_query: str, kb_id: Optional[int], prepared: Dict[str, Any],
+                     raw_answer: str, sources: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """组装最终响应并写入回答缓存"""
+    response = {
+        "answer": clean_llm_response(raw_answer),
+        "sources": sources,
+        "query": {
+            "original": input_query,
+            "kb_id": kb_id
+        },
+        "context": prepared["context_stats"]
+    }
+    store_answer(kb_id, prepared["retrieval"]["query_embedding"], response, prepared["cache_generation"])
+    return response
+
+def _early_response(prepared: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """_prepare_query提前结束时（出错或命中回答缓存）返回最终响应，否则返回None"""
+    if "error" in prepared:
+        return prepared
+    return prepared.get("response")
+
+def _early_events(prepared: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """_early_response的流式版本：返回需要依次发送的事件，否则返回None"""
+    if "error" in prepared:
+        return [{"type": "error", **prepared}]
+    response = prepared.get("response")
+    if response is None:
+        return None
+    return [
+        {"type": "sources", "sources": response["sources"]},
+        {"type": "token", "content": response["answer"]},
+        {"type": "done", **response}
+    ]
+
+def _generation_failed(llm_error: Exception) -> Dict[str, Any]:
+    print(f"生成回答时出错: {str(llm_error)}")
+    return {"error": "无法生成回答", "detail": str(llm_error)}
+
+def _query_failed(e: Exception, description: str = "执行查询时发生错误") -> Dict[str, Any]:
+    print(f"{description}: {str(e)}")
+    import traceback
+    traceback.print_exc()
+    return {"error": "查询执行失败", "detail": str(e)}
+
+class _AnswerStream:
+    """流式生成回答时的公共状态：增量清理、拼接原始输出并记录首个token和生成耗时"""
+
+    def __init__(self):
+        self.cleaner = StreamingResponseCleaner()
+        self.raw_parts = []
+        self.start = time.perf_counter()
+
+    def feed(self, content: str) -> Optional[Dict[str, Any]]:
+        """记录模型新生成的片段，返回需要发送的token事件（没有可见文本时为None）"""
+        if not self.raw_parts:
+            observe_stage('query', 'llm_first_token', time.perf_counter() - self.start)
+        self.raw_parts.append(content)
+        visible = self.cleaner.feed(content)
+        return {"type": "token", "content": visible} if visible else None
+
+    def finish(self, input_query: str, kb_id: Optional[int], prepared: Dict[str, Any],
+               sources: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """生成结束后返回剩余的token事件和done事件，并写入回答缓存"""
+        observe_stage('query', 'llm_generation', time.perf_counter() - self.start)
+        events = []
+        visible = self.cleaner.flush()
+        if visible:
+            events.append({"type": "token", "content": visible})
+        response = _finish_response(input_query, kb_id, prepared, ''.join(self.raw_parts), sources)
+        events.append({"type": "done", **response})
+        return events
+
+def perform_query(input_query: str, kb_id: Optional[int] = None, paraphrase: bool = True,
+                  paraphrase_timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """
+    执行查询并返回回答与来源
+    
+    参数:
+        input_query: 用户输入的查询
+        kb_id: 知识库ID (可选)
+        paraphrase: 是否生成查询改写，对延迟敏感的客户端可以关闭
+        paraphrase_timeout: 生成查询改写的时间预算（秒）
         
-        # 重新排序文档以提高相关性
-        reranked_docs = rerank_documents(input_query, retrieved_docs)
-        
-        # 只使用前4个最相关的文档
-        top_docs = reranked_docs[:4]
-        
-        # 格式化文档内容作为上下文
-        context = "\n\n".join([doc.page_content for doc in top_docs])
-        
-        # 生成回答
+    返回:
+        Dict[str, Any]: 包含回答和源信息的响应对象，失败时返回带有错误信息的字典
+    """
+    try:
+        prepared = _prepare_query(input_query, kb_id, paraphrase, paraphrase_timeout)
+        early = _early_response(prepared)
+        if early is not None:
+            return early
+
         try:
-            formatted_prompt = answer_prompt.format(context=context, question=input_query)
-            raw_answer = llm.invoke(formatted_prompt).content
+            with span('llm_generation'):
+                raw_answer = prepared["llm"].invoke(prepared["formatted_prompt"]).content
         except Exception as llm_error:
-            print(f"生成回答时出错: {str(llm_error)}")
-            return {
-                "error": "无法生成回答",
-                "detail": str(llm_error)
-            }
-        
-        # 清理响应
-        clean_answer = clean_llm_response(raw_answer)
-        
-        # 获取并格式化源信息 (包含相关度分数)
+            return _generation_failed(llm_error)
+
+        sources = _build_sources(prepared["top_docs"], prepared["retrieval"])
+        return _finish_response(input_query, kb_id, prepared, raw_answer, sources)
+    except Exception as e:
+        return _query_failed(e)
+
+def stream_query(input_query: str, kb_id: Optional[int] = None, paraphrase: bool = True,
+                 paraphrase_timeout: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+    """
+    流式执行查询：先返回检索到的来源，再逐块返回模型生成的回答
+
+    参数与perform_query相同。
+
+    产生的事件:
+        {"type": "sources", "sources": [...]}
+        {"type": "token", "content": "..."}  (与clean_llm_response相同的规则逐块清理，拼接后等于answer)
+        {"type": "done", "answer": "...", "sources": [...], "query": {...}}
+        {"type": "error", "error": "...", "detail": "..."}
+    """
+    try:
+        prepared = _prepare_query(input_query, kb_id, paraphrase, paraphrase_timeout)
+        early = _early_events(prepared)
+        if early is not None:
+            yield from early
+            return
+
+        sources = _build_sources(prepared["top_docs"], prepared["retrieval"])
+        yield {"type": "sources", "sources": sources}
+
+        answer = _AnswerStream()
         try:
-            # 尝试获取嵌入向量以计算相关度
-            from langchain_community.embeddings import OllamaEmbeddings
-            embedding_model = OllamaEmbeddings(model=embedding_model_name)
-            query_embedding = embedding_model.embed_query(input_query)
-            doc_embeddings = [embedding_model.embed_query(doc.page_content) for doc in top_docs]
-            sources = format_sources(top_docs, query_embedding, doc_embeddings)
-        except Exception as embed_error:
-            print(f"计算相关度分数时出错: {str(embed_error)}")
-            # 继续而不计算相关度分数
-            sources = format_sources(top_docs)
-        
-        # 组装最终响应
-        response = {
-            "answer": clean_answer,
-            "sources": sources,
-            "query": {
-                "original": input_query,
-                "kb_id": kb_id
-            }
-        }
-        
-        return response
+            for chunk in prepared["llm"].stream(prepared["formatted_prompt"]):
+                event = answer.feed(chunk.content)
+                if event:
+                    yield event
+        except Exception as llm_error:
+            yield {"type": "error", **_generation_failed(llm_error)}
+            return
+
+        yield from answer.finish(input_query, kb_id, prepared, sources)
     except Exception as e:
-        print(f"执行查询时发生错误: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return {
-            "error": "查询执行失败",
-            "detail": str(e)
-        }
\ No newline at end of file
+        yield {"type": "error", **_query_failed(e, "执行流式查询时发生错误")}
+
+# ================ 异步查询 (ASGI模式) ================
+# 检索、重排等同步步骤在线程池中执行，回答生成通过共享连接池异步调用Ollama，
+# 等待模型时不占用线程，其他请求可以继续处理。
+
+async def aperform_query(input_query: str, kb_id: Optional[int] = None, paraphrase: bool = True,
+                         paraphrase_timeout: Optional[float] = None,
+                         query_embedding: Optional[List[float]] = None) -> Dict[str, Any]:
+    """
+    perform_query的异步版本
+
+    参数与_prepare_query相同，返回值与perform_query相同。
+    """
+    try:
+        prepared = await asyncio.to_thread(_prepare_query, input_query, kb_id, paraphrase,
+                                           paraphrase_timeout, query_embedding)
+        early = _early_response(prepared)
+        if early is not None:
+            return early
+
+        try:
+            with span('llm_generation'):
+                raw_answer = await achat(prepared["llm"].model, prepared["formatted_prompt"])
+        except Exception as llm_error:
+            return _generation_failed(llm_error)
+
+        sources = await asyncio.to_thread(_build_sources, prepared["top_docs"], prepared["retrieval"])
+        return _finish_response(input_query, kb_id, prepared, raw_answer, sources)
+    except Exception as e:
+        return _query_failed(e)
+
+async def astream_query(input_query: str, kb_id: Optional[int] = None, paraphrase: bool = True,
+                        paraphrase_timeout: Optional[float] = None,
+                        query_embedding: Optional[List[float]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    stream_query的异步版本，产生的事件与stream_query相同
+    """
+    try:
+        prepared = await asyncio.to_thread(_prepare_query, input_query, kb_id, paraphrase,
+                                           paraphrase_timeout, query_embedding)
+        early = _early_events(prepared)
+        if early is not None:
+            for event in early:
+                yield event
+            return
+
+        sources = await asyncio.to_thread(_build_sources, prepared["top_docs"], prepared["retrieval"])
+        yield {"type": "sources", "sources": sources}
+
+        answer = _AnswerStream()
+        try:
+            async for content in achat_stream(prepared["llm"].model, prepared["formatted_prompt"]):
+                event = answer.feed(content)
+                if event:
+                    yield event
+        except Exception as llm_error:
+            yield {"type": "error", **_generation_failed(llm_error)}
+            return
+
+        for event in answer.finish(input_query, kb_id, prepared, sources):
+            yield event
+    except Exception as e:
+        yield {"type": "error", **_query_failed(e, "执行流式查询时发生错误")}
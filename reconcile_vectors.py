@@ -0,0 +1,156 @@
+import os
+import argparse
+
+import chromadb
+
+from db_utils import get_db_connection
+from get_vector_db import CHROMA_PATH, BASE_COLLECTION_NAME, get_vector_db, invalidate_vector_db
+from keyword_index import remove_chunk_keywords, drop_keyword_index
+
+# 使用环境变量配置
+DB_PATH = os.getenv('DB_PATH', 'documents.db')
+# 每次从集合中读取的块数量
+RECONCILE_BATCH_SIZE = int(os.getenv('RECONCILE_BATCH_SIZE', '1000'))
+
+def _collection_kb_id(name):
+    """
+    根据集合名称解析知识库ID
+
+    返回:
+        int: 知识库ID；基础集合返回None；无法识别的集合返回False
+    """
+    if name == BASE_COLLECTION_NAME:
+        return None
+    prefix = f"{BASE_COLLECTION_NAME}-"
+    if name.startswith(prefix) and name[len(prefix):].isdigit():
+        return int(name[len(prefix):])
+    return False
+
+def _load_documents():
+    """返回 {知识库ID: (文档ID集合, 存储文件名集合)}"""
+    conn = get_db_connection(DB_PATH)
+    try:
+        kb_ids = [row[0] for row in conn.execute("SELECT id FROM knowledge_bases").fetchall()]
+        documents = {kb_id: (set(), set()) for kb_id in kb_ids}
+        for doc_id, kb_id, stored_filename in conn.execute(
+            "SELECT id, knowledge_base_id, stored_filename FROM documents"
+        ).fetchall():
+            if kb_id in documents:
+                documents[kb_id][0].add(doc_id)
+                documents[kb_id][1].add(stored_filename)
+        return documents
+    finally:
+        conn.close()
+
+def _is_orphan(metadata, doc_ids, filenames):
+    """块的文档已不存在时返回True；旧版块没有document_id，按source文件名判断"""
+    metadata = metadata or {}
+    doc_id = metadata.get("document_id")
+    if doc_id is not None:
+        return doc_id not in doc_ids
+    source = metadata.get("source")
+    if not source:
+        # 无法判断归属的块保留不动
+        return False
+    return os.path.basename(source) not in filenames
+
+def find_orphan_chunks(collection, doc_ids, filenames):
+    """
+    找出集合中所属文档已被删除的块
+
+    参数:
+        collection: Chroma集合
+        doc_ids: 该知识库现有的文档ID集合
+        filenames: 该知识库现有的存储文件名集合
+
+    返回:
+        List[str]: 孤立块的ID
+    """
+    orphans = []
+    offset = 0
+    while True:
+        batch = collection.get(include=["metadatas"], limit=RECONCILE_BATCH_SIZE, offset=offset)
+        ids = batch.get("ids") or []
+        if not ids:
+            break
+        for chunk_id, metadata in zip(ids, batch.get("metadatas") or [None] * len(ids)):
+            if _is_orphan(metadata, doc_ids, filenames):
+                orphans.append(chunk_id)
+        offset += len(ids)
+    return orphans
+
+def reconcile(apply=False):
+    """
+    对比向量库与documents.db，找出（并可选删除）孤立的集合和块
+
+    参数:
+        apply: 为True时删除找到的孤立数据，否则只报告
+
+    返回:
+        Dict: {"orphan_collections": [...], "orphan_chunks": {集合名称: 块数量}, "skipped_collections": [...]}
+    """
+    documents = _load_documents()
+    all_doc_ids = set().union(*(ids for ids, _ in documents.values())) if documents else set()
+    all_filenames = set().union(*(names for _, names in documents.values())) if documents else set()
+
+    client = chromadb.PersistentClient(path=CHROMA_PATH)
+    # 旧版chromadb返回集合对象，新版只返回名称
+    names = [c if isinstance(c, str) else c.name for c in client.list_collections()]
+
+    report = {"orphan_collections": [], "orphan_chunks": {}, "skipped_collections": []}
+    for name in sorted(names):
+        kb_id = _collection_kb_id(name)
+        if kb_id is False:
+            report["skipped_collections"].append(name)
+            continue
+
+        if kb_id is not None and kb_id not in documents:
+            # 知识库已被删除，整个集合都是孤立的
+            report["orphan_collections"].append(name)
+            if apply:
+                invalidate_vector_db(kb_id)
+                client.delete_collection(name)
+                drop_keyword_index(name)
+            continue
+
+        if kb_id is None:
+            # 基础集合不属于某个知识库，只检查文档是否仍存在
+            doc_ids, filenames = all_doc_ids, all_filenames
+        else:
+            doc_ids, filenames = documents[kb_id]
+
+        db = get_vector_db(kb_id)
+        orphans = find_orphan_chunks(db._collection, doc_ids, filenames)
+        if not orphans:
+            continue
+        report["orphan_chunks"][name] = len(orphans)
+        if apply:
+            for start in range(0, len(orphans), RECONCILE_BATCH_SIZE):
+                batch = orphans[start:start + RECONCILE_BATCH_SIZE]
+                db._collection.delete(ids=batch)
+                remove_chunk_keywords(db, batch)
+
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="查找并删除documents.db中已不存在的文档和知识库留下的向量")
+    parser.add_argument("--apply", action="store_true", help="删除找到的孤立数据（默认只报告）")
+    args = parser.parse_args()
+
+    report = reconcile(apply=args.apply)
+    action = "已删除" if args.apply else "发现"
+
+    for name in report["orphan_collections"]:
+        print(f"{action}孤立集合: {name}")
+    for name, count in report["orphan_chunks"].items():
+        print(f"{action}集合 {name} 中的 {count} 个孤立块")
+    for name in report["skipped_collections"]:
+        print(f"跳过无法识别的集合: {name}")
+
+    if not report["orphan_collections"] and not report["orphan_chunks"]:
+        print("向量库与数据库一致，没有孤立数据")
+    elif not args.apply:
+        print("使用 --apply 删除以上孤立数据")
+
+if __name__ == "__main__":
+    main()
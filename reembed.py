@@ -0,0 +1,60 @@
+import os
+import argparse
+
+import chromadb
+
+from get_vector_db import CHROMA_PATH, get_embedding_function
+
+# 使用环境变量配置
+# 每次从集合中读取并重新嵌入的块数量
+REEMBED_BATCH_SIZE = int(os.getenv('REEMBED_BATCH_SIZE', '256'))
+
+def reembed_collection(collection, embeddings):
+    """
+    用当前的嵌入模型重新计算集合中所有块的向量，块ID、文本和元数据保持不变
+
+    参数:
+        collection: Chroma集合
+        embeddings: 嵌入函数
+
+    返回:
+        int: 重新嵌入的块数量
+    """
+    total = collection.count()
+    updated = 0
+    for offset in range(0, total, REEMBED_BATCH_SIZE):
+        batch = collection.get(include=["documents"], limit=REEMBED_BATCH_SIZE, offset=offset)
+        ids = batch.get("ids") or []
+        if not ids:
+            break
+        texts = [text or "" for text in batch.get("documents") or [""] * len(ids)]
+        collection.update(ids=ids, embeddings=embeddings.embed_documents(texts))
+        updated += len(ids)
+        print(f"  {collection.name}: {updated}/{total}")
+    return updated
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="用当前的嵌入接口重新计算已有知识库的向量，无需删除并重新上传文档"
+    )
+    parser.add_argument("--collection", action="append",
+                        help="只处理指定的集合（例如 kb-3），可重复；默认处理全部集合")
+    args = parser.parse_args()
+
+    client = chromadb.PersistentClient(path=CHROMA_PATH)
+    # 旧版chromadb返回集合对象，新版只返回名称
+    names = sorted(c if isinstance(c, str) else c.name for c in client.list_collections())
+    if args.collection:
+        missing = set(args.collection) - set(names)
+        for name in sorted(missing):
+            print(f"集合不存在: {name}")
+        names = [name for name in names if name in args.collection]
+
+    embeddings = get_embedding_function()
+    for name in names:
+        print(f"正在重新嵌入集合 {name}...")
+        count = reembed_collection(client.get_collection(name), embeddings)
+        print(f"集合 {name} 已重新嵌入 {count} 个块")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+from keyword_index import ensure_keyword_index, keyword_search, count_terms
+from paraphrase_cache import get_cached_paraphrases, store_paraphrases
+
+# 从Chroma集合中读取的字段，包含已存储的块向量和距离，避免之后重新嵌入
+QUERY_INCLUDE = ["documents", "metadatas", "embeddings", "distances"]
+
+# 使用环境变量配置
+# 每个查询向量返回的文档数量
+RETRIEVAL_K = int(os.getenv('RETRIEVAL_K', '8'))
+# 倒数排名融合的平滑常数
+RRF_K = int(os.getenv('RRF_K', '60'))
+# 是否把BM25关键词检索结果与向量检索结果融合
+HYBRID_SEARCH_ENABLED = os.getenv('HYBRID_SEARCH_ENABLED', '1') not in ('0', 'false', 'False')
+# 关键词检索返回的文档数量
+KEYWORD_SEARCH_K = int(os.getenv('KEYWORD_SEARCH_K', '8'))
+# 关键词结果在融合中的权重，相对于所有向量结果列表的权重之和
+HYBRID_KEYWORD_WEIGHT = float(os.getenv('HYBRID_KEYWORD_WEIGHT', '0.5'))
+# 生成查询改写的时间预算（秒），超时后只使用原始查询
+PARAPHRASE_TIMEOUT = float(os.getenv('PARAPHRASE_TIMEOUT', '10'))
+# 查询词少于该数量时视为关键词查询，不生成改写（中日韩文字每个字算一个词）
+QUERY_EXPANSION_MIN_TERMS = int(os.getenv('QUERY_EXPANSION_MIN_TERMS', '4'))
+
+# 查询改写在后台线程中执行，超时后请求不再等待它，并中止仍在进行的模型调用
+_paraphrase_executor = ThreadPoolExecutor(max_workers=int(os.getenv('PARAPHRASE_WORKERS', '4')))
+
+def generate_query_variants(llm, query_prompt, question: str,
+                            stop_event: Optional[threading.Event] = None) -> List[str]:
+    """
+    使用语言模型生成查询的多个改写版本
+
+    参数:
+        llm: 语言模型实例
+        query_prompt: 多重查询提示模板
+        question: 原始查询
+        stop_event: 取消信号 (可选)，提供时以流式调用模型，设置后中止生成
+
+    返回:
+        List[str]: 改写后的查询列表（不含原始查询）
+    """
+    prompt = query_prompt.format(question=question)
+    if stop_event is None:
+        raw_output = llm.invoke(prompt).content
+    else:
+        raw_output = ''.join(chunk.content for chunk in llm.stream(prompt, stop_event=stop_event))
+    # 推理模型可能输出思考块，不能把它们当作查询
+    raw_output = re.sub(r'<think(ing)?>.*?</think(ing)?>', '', raw_output, flags=re.DOTALL)
+    return [line.strip() for line in raw_output.strip().split("\n") if line.strip()]
+
+def _generate_and_cache(llm, query_prompt, question: str, stop_event: threading.Event) -> List[str]:
+    """生成查询改写并写入缓存；超时取消后中止模型调用，不与回答生成争用模型"""
+    variants = generate_query_variants(llm, query_prompt, question, stop_event)
+    if stop_event.is_set():
+        # 被中止的输出不完整，不写入缓存
+        return []
+    try:
+        store_paraphrases(getattr(llm, 'model', None), question, variants)
+    except Exception as e:
+        print(f"写入查询改写缓存出错: {str(e)}")
+    return variants
+
+def should_expand_query(question: str) -> bool:
+    """简短的关键词查询直接检索效果已经足够，不值得等待语言模型生成改写"""
+    return count_terms(question) >= QUERY_EXPANSION_MIN_TERMS
+
+def generate_query_variants_within(llm, query_prompt, question: str,
+                                   timeout: Optional[float] = None) -> List[str]:
+    """
+    按自适应策略获取查询改写；跳过、超时或出错时返回空列表，只使用原始查询
+
+    简短的关键词查询不生成改写；规范化后相同的查询直接使用缓存的改写；
+    其余查询在时间预算内调用语言模型生成。
+
+    参数:
+        llm: 语言模型实例
+        query_prompt: 多重查询提示模板
+        question: 原始查询
+        timeout: 时间预算（秒），默认为PARAPHRASE_TIMEOUT
+
+    返回:
+        List[str]: 改写后的查询列表（不含原始查询）
+    """
+    if not should_expand_query(question):
+        print(f"查询少于 {QUERY_EXPANSION_MIN_TERMS} 个词，不生成查询改写")
+        return []
+
+    try:
+        cached = get_cached_paraphrases(getattr(llm, 'model', None), question)
+    except Exception as e:
+        print(f"读取查询改写缓存出错: {str(e)}")
+        cached = None
+    if cached is not None:
+        return cached
+
+    timeout = PARAPHRASE_TIMEOUT if timeout is None else timeout
+    stop_event = threading.Event()
+    future = _paraphrase_executor.submit(_generate_and_cache, llm, query_prompt, question, stop_event)
+    try:
+        return future.result(timeout=max(timeout, 0))
+    except FutureTimeoutError:
+        print(f"生成查询改写超过 {timeout} 秒，仅使用原始查询")
+        # 尚未开始的任务直接取消；正在进行的模型调用由stop_event中止
+        stop_event.set()
+        future.cancel()
+    except Exception as e:
+        print(f"生成查询改写时出错，仅使用原始查询: {str(e)}")
+    return []
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K,
+                           weights: Optional[List[float]] = None) -> Dict[str, float]:
+    """
+    倒数排名融合：每个结果列表中排名为r的块得分为w/(k+r)，多个列表的得分相加
+
+    参数:
+        rankings: 多个按相关度排序的块ID列表
+        k: 平滑常数
+        weights: 每个列表的权重 (可选)，默认均为1
+
+    返回:
+        Dict[str, float]: 块ID -> 融合得分，按得分降序排列
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + weight / (k + rank)
+    return dict(sorted(scores.items(), key=lambda item: item[1], reverse=True))
+
+def retrieve_documents(db, queries: List[str], k: int = RETRIEVAL_K,
+                       query_embedding: Optional[List[float]] = None) -> Dict[str, Any]:
+    """
+    一次批量嵌入所有查询，用一次多向量查询检索Chroma，再与原始查询的BM25关键词检索结果
+    一起用倒数排名融合合并
+
+    参数:
+        db: Chroma向量数据库实例
+        queries: 查询列表，第一个元素为原始查询
+        k: 每个查询返回的文档数量
+        query_embedding: 已计算好的原始查询向量 (可选)，提供时不再重复嵌入原始查询
+
+    返回:
+        Dict[str, Any]: {
+            "documents": 按融合得分排序的去重文档列表 (Document.id为块ID),
+            "query_embedding": 原始查询的嵌入向量,
+            "embeddings": {块ID: 存储的块向量},
+            "distances": {块ID: 与任一查询的最小距离（只由关键词检索到的块没有距离）},
+            "scores": {块ID: 融合得分}
+        }
+    """
+    queries = list(dict.fromkeys(query for query in queries if query and query.strip()))
+    if not queries:
+        return {"documents": [], "query_embedding": None, "embeddings": {}, "distances": {}, "scores": {}}
+
+    if query_embedding is not None:
+        vectors = [query_embedding] + (db._embedding_function.embed_queries(queries[1:]) if len(queries) > 1 else [])
+    else:
+        vectors = db._embedding_function.embed_queries(queries)
+    result = db._collection.query(
+        query_embeddings=vectors,
+        n_results=k,
+        include=QUERY_INCLUDE
+    )
+
+    documents = {}
+    embeddings = {}
+    distances = {}
+    result_embeddings = result.get("embeddings")
+
+    for q, ids in enumerate(result["ids"]):
+        for i, chunk_id in enumerate(ids):
+            distance = result["distances"][q][i]
+            if chunk_id in distances:
+                distances[chunk_id] = min(distances[chunk_id], distance)
+                continue
+
+            documents[chunk_id] = Document(
+                page_content=result["documents"][q][i],
+                metadata=result["metadatas"][q][i] or {},
+                id=chunk_id
+            )
+            distances[chunk_id] = distance
+            if result_embeddings is not None:
+                embeddings[chunk_id] = np.asarray(result_embeddings[q][i], dtype=np.float32)
+
+    rankings = list(result["ids"])
+    weights = [1.0] * len(rankings)
+
+    # 关键词检索能找到向量检索遗漏的精确匹配（编号、名称等）
+    if HYBRID_SEARCH_ENABLED:
+        try:
+            ensure_keyword_index(db)
+            keyword_ids = [chunk_id for chunk_id, _ in keyword_search(db, queries[0], KEYWORD_SEARCH_K)]
+        except Exception as keyword_error:
+            print(f"关键词检索出错，仅使用向量检索结果: {str(keyword_error)}")
+            keyword_ids = []
+
+        if keyword_ids:
+            rankings.append(keyword_ids)
+            weights.append(HYBRID_KEYWORD_WEIGHT * len(result["ids"]))
+
+            # 只由关键词检索到的块需要从集合中读取内容和向量
+            missing = [chunk_id for chunk_id in keyword_ids if chunk_id not in documents]
+            if missing:
+                fetched = db._collection.get(ids=missing, include=["documents", "metadatas", "embeddings"])
+                fetched_embeddings = fetched.get("embeddings")
+                for i, chunk_id in enumerate(fetched["ids"]):
+                    documents[chunk_id] = Document(
+                        page_content=fetched["documents"][i],
+                        metadata=fetched["metadatas"][i] or {},
+                        id=chunk_id
+                    )
+                    if fetched_embeddings is not None:
+                        embeddings[chunk_id] = np.asarray(fetched_embeddings[i], dtype=np.float32)
+
+    scores = {
+        chunk_id: score
+        for chunk_id, score in reciprocal_rank_fusion(rankings, weights=weights).items()
+        if chunk_id in documents
+    }
+
+    return {
+        "documents": [documents[chunk_id] for chunk_id in scores],
+        "query_embedding": vectors[0],
+        "embeddings": embeddings,
+        "distances": distances,
+        "scores": scores
+    }
@@ -0,0 +1,185 @@
+import re
+import time
+import hashlib
+import threading
+import unicodedata
+from typing import List, Tuple, Dict, Optional
+
+from db_utils import get_db_connection
+
+# SQLite单条语句的参数数量有限，按批次查询
+_LOOKUP_BATCH_SIZE = 500
+
+def text_hash(text: str) -> str:
+    """对规范化后的文本计算哈希：统一Unicode形式并合并空白字符"""
+    normalized = unicodedata.normalize('NFKC', text or '')
+    normalized = re.sub(r'\s+', ' ', normalized).strip()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+class SqliteLRUCache:
+    """
+    保存在SQLite中的LRU缓存，按(model, 键)存储若干值列
+
+    条目数量在首次连接时统计一次，之后随写入和淘汰在内存中更新，写入时不需要统计整张表；
+    超出max_entries时淘汰最久未使用的条目。提供ttl时按写入时间判断条目是否过期。
+    """
+
+    def __init__(self, path: str, table: str, key_column: str, value_columns: List[Tuple[str, str]],
+                 max_entries: int, enabled: bool = True, ttl: Optional[float] = None):
+        """
+        参数:
+            path: 缓存数据库文件路径
+            table: 表名
+            key_column: 键列名
+            value_columns: 值列的 (列名, 类型定义) 列表
+            max_entries: 条目上限
+            enabled: 为False时不读写缓存
+            ttl: 条目有效期（秒），为None时不过期
+        """
+        self.path = path
+        self.table = table
+        self.key_column = key_column
+        self.value_names = [name for name, _ in value_columns]
+        self.value_columns = value_columns
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._entry_count = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _connect(self):
+        conn = get_db_connection(self.path)
+        if not self._initialized:
+            columns = [f"{name} {definition}" for name, definition in self.value_columns]
+            if self.ttl is not None:
+                columns.append("created_at REAL NOT NULL")
+            conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                model TEXT NOT NULL,
+                {self.key_column} TEXT NOT NULL,
+                {', '.join(columns)},
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, {self.key_column})
+            )
+            ''')
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_last_used ON {self.table}(last_used)")
+            conn.commit()
+            self._entry_count = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            self._initialized = True
+        return conn
+
+    def get_many(self, model: str, keys: List[str]) -> Dict[str, tuple]:
+        """
+        查询一组键的缓存值，并更新命中条目的最近使用时间
+
+        参数:
+            model: 模型名称
+            keys: 键列表
+
+        返回:
+            Dict[str, tuple]: 键 -> 值列组成的元组，只包含命中且未过期的键
+        """
+        if not self.enabled or not keys:
+            return {}
+
+        unique_keys = list(dict.fromkeys(keys))
+        selected = ', '.join([self.key_column] + self.value_names + (["created_at"] if self.ttl is not None else []))
+        found = {}
+        now = time.time()
+
+        with self._lock:
+            conn = self._connect()
+            try:
+                for i in range(0, len(unique_keys), _LOOKUP_BATCH_SIZE):
+                    batch = unique_keys[i:i + _LOOKUP_BATCH_SIZE]
+                    placeholders = ','.join('?' * len(batch))
+                    rows = conn.execute(
+                        f"SELECT {selected} FROM {self.table} WHERE model = ? AND {self.key_column} IN ({placeholders})",
+                        [model] + batch
+                    ).fetchall()
+                    for row in rows:
+                        values = tuple(row[1:1 + len(self.value_names)])
+                        if self.ttl is not None and now - row[-1] > self.ttl:
+                            continue
+                        found[row[0]] = values
+
+                # 更新命中条目的最近使用时间，供LRU淘汰使用
+                if found:
+                    conn.executemany(
+                        f"UPDATE {self.table} SET last_used = ? WHERE model = ? AND {self.key_column} = ?",
+                        [(now, model, key) for key in found]
+                    )
+                    conn.commit()
+            finally:
+                conn.close()
+
+            hits = sum(1 for key in keys if key in found)
+            self._stats["hits"] += hits
+            self._stats["misses"] += len(keys) - hits
+
+        return found
+
+    def put_many(self, model: str, items: List[Tuple[str, tuple]], replace: bool = False):
+        """
+        写入一组条目，并在超出容量时淘汰最久未使用的条目
+
+        参数:
+            model: 模型名称
+            items: (键, 值列组成的元组) 列表
+            replace: 是否覆盖已有条目；为False时已有条目保持不变
+        """
+        if not self.enabled or not items:
+            return
+
+        now = time.time()
+        items = list(dict(items).items())
+        columns = ['model', self.key_column] + self.value_names + (["created_at"] if self.ttl is not None else [])
+        columns.append('last_used')
+        rows = [
+            (model, key) + tuple(values) + ((now,) if self.ttl is not None else ()) + (now,)
+            for key, values in items
+        ]
+        insert = f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO {self.table} ({', '.join(columns)}) " \
+                 f"VALUES ({', '.join('?' * len(columns))})"
+
+        with self._lock:
+            conn = self._connect()
+            try:
+                if replace:
+                    # 覆盖已有条目时条目数量不变
+                    keys = [key for key, _ in items]
+                    existing = 0
+                    for i in range(0, len(keys), _LOOKUP_BATCH_SIZE):
+                        batch = keys[i:i + _LOOKUP_BATCH_SIZE]
+                        placeholders = ','.join('?' * len(batch))
+                        existing += conn.execute(
+                            f"SELECT COUNT(*) FROM {self.table} WHERE model = ? AND {self.key_column} IN ({placeholders})",
+                            [model] + batch
+                        ).fetchone()[0]
+                    conn.executemany(insert, rows)
+                    added = len(rows) - existing
+                else:
+                    added = max(conn.executemany(insert, rows).rowcount, 0)
+
+                # 超出容量时淘汰最久未使用的条目
+                overflow = self._entry_count + added - max(self.max_entries, 0)
+                evicted = 0
+                if overflow > 0:
+                    evicted = conn.execute(
+                        f"DELETE FROM {self.table} WHERE rowid IN (SELECT rowid FROM {self.table} ORDER BY last_used ASC LIMIT ?)",
+                        (overflow,)
+                    ).rowcount
+                conn.commit()
+                self._entry_count += added - evicted
+                self._stats["evictions"] += evicted
+            finally:
+                conn.close()
+
+    def stats(self) -> Dict[str, int]:
+        """返回进程启动以来的命中、未命中和淘汰次数；缓存已打开时还包含当前条目数entries"""
+        with self._lock:
+            if self._initialized:
+                return dict(self._stats, entries=self._entry_count)
+            return dict(self._stats)
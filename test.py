@@ -182,25 +182,34 @@ def test_document_processing(kb_id):
         files = {'file': f}
         response = make_request('POST', f"upload/{kb_id}", files=files)
     
-    if response.status_code in [200, 201]:
-        doc_data = response.json()
-        # Try different possible field names for document ID
-        doc_id = doc_data.get("id") or doc_data.get("document_id") or doc_data.get("doc_id")
-        if not doc_id and isinstance(doc_data, dict):
-            # If we can't find the ID through direct fields, try to find first integer value
-            for key, value in doc_data.items():
-                if isinstance(value, int):
-                    doc_id = value
-                    print_info(f"Using {key}: {value} as document ID")
-                    break
-        print_success(f"Uploaded document with ID: {doc_id}")
+    if response.status_code == 202:
+        job_id = response.json().get("job_id")
+        print_success(f"Upload accepted as ingestion job: {job_id}")
     else:
         print_error(f"Failed to upload document: {response.status_code} - {response.text}")
         return None
     
-    # Give some time for processing
+    # Poll the ingestion job until it finishes
     print_info("Waiting for document processing...")
-    time.sleep(3)
+    doc_id = None
+    deadline = time.time() + 600
+    while time.time() < deadline:
+        response = make_request('GET', f"jobs/{job_id}")
+        if response.status_code != 200:
+            print_error(f"Failed to get job status: {response.status_code} - {response.text}")
+            return None
+        job = response.json()
+        if job.get("status") == "done":
+            doc_id = job.get("document_id")
+            print_success(f"Uploaded document with ID: {doc_id}")
+            break
+        if job.get("status") == "failed":
+            print_error(f"Ingestion job failed: {job.get('message')}")
+            return None
+        time.sleep(2)
+    else:
+        print_error(f"Ingestion job {job_id} did not finish in time")
+        return None
     
     # List all documents
     print_info("Listing all documents...")
@@ -0,0 +1,62 @@
+import unittest
+
+from langchain_core.documents import Document
+
+from chunking import count_tokens
+from context_packing import build_context, trim_to_relevant_sentences
+
+def doc(text, chunk_id):
+    return Document(page_content=text, metadata={"chunk_id": chunk_id})
+
+class TrimToRelevantSentencesTest(unittest.TestCase):
+    def test_short_text_unchanged(self):
+        text = "Lidar scans are merged. The mesh is refined."
+        self.assertEqual(trim_to_relevant_sentences(text, {"lidar"}, 100), text)
+
+    def test_keeps_matching_sentences_in_original_order(self):
+        text = "Intro words here. Lidar scans are merged. More filler text. The lidar mesh is refined."
+        trimmed = trim_to_relevant_sentences(text, {"lidar", "mesh"}, 12)
+        self.assertEqual(trimmed, "Lidar scans are merged. The lidar mesh is refined.")
+
+    def test_falls_back_to_prefix(self):
+        # 没有句子能整句放入时截取开头部分
+        text = "one two three four five six seven eight nine ten"
+        self.assertEqual(trim_to_relevant_sentences(text, {"ten"}, 3), "one two three")
+
+class BuildContextTest(unittest.TestCase):
+    def test_stays_within_budget(self):
+        docs = [doc(f"Chunk {i} describes lidar scan number {i} in detail.", i) for i in range(20)]
+        packed = build_context("lidar scan", docs, token_budget=30)
+        self.assertLessEqual(packed["token_count"], 30)
+        self.assertEqual(packed["token_budget"], 30)
+        self.assertEqual(packed["token_count"], count_tokens(packed["context"]))
+        self.assertGreater(len(packed["documents"]), 0)
+        self.assertLess(len(packed["documents"]), len(docs))
+
+    def test_keeps_ranking_order(self):
+        docs = [doc("First chunk about lidar.", 1), doc("Second chunk about meshes.", 2)]
+        packed = build_context("lidar", docs, token_budget=100)
+        self.assertEqual([d.metadata["chunk_id"] for d in packed["documents"]], [1, 2])
+        self.assertEqual(packed["context"], "First chunk about lidar.\n\nSecond chunk about meshes.")
+
+    def test_near_duplicates_skipped(self):
+        docs = [
+            doc("The lidar scans are merged into a single mesh.", 1),
+            doc("The lidar scans are merged into a single mesh!", 2),
+            doc("Textures are baked afterwards.", 3),
+        ]
+        packed = build_context("lidar mesh", docs, token_budget=100)
+        self.assertEqual([d.metadata["chunk_id"] for d in packed["documents"]], [1, 3])
+        self.assertEqual(packed["duplicates"], 1)
+
+    def test_long_chunk_trimmed_to_remaining_budget(self):
+        docs = [doc("Filler sentence one. Filler sentence two. The lidar result. Filler sentence three.", 1)]
+        packed = build_context("lidar", docs, token_budget=4)
+        self.assertEqual(packed["context"], "The lidar result.")
+
+    def test_empty_input(self):
+        packed = build_context("lidar", [], token_budget=100)
+        self.assertEqual((packed["context"], packed["documents"], packed["token_count"]), ("", [], 0))
+
+if __name__ == "__main__":
+    unittest.main()
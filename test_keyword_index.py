@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import keyword_index
+from keyword_index import tokenize, index_chunks, keyword_search, remove_chunk_keywords
+
+def fake_db(name):
+    """关键词索引只用到集合名称，不需要真正的Chroma实例"""
+    return SimpleNamespace(_collection=SimpleNamespace(name=name))
+
+class TokenizeTest(unittest.TestCase):
+    def test_words_are_lowercased(self):
+        self.assertEqual(tokenize("Neural Radiance Fields"), ["neural", "radiance", "fields"])
+
+    def test_joined_identifiers_keep_whole_and_parts(self):
+        self.assertEqual(tokenize("AB-1234"), ["ab-1234", "ab", "1234"])
+        self.assertEqual(tokenize("v2.1"), ["v2.1", "v2", "1"])
+
+    def test_cjk_characters_are_separate_terms(self):
+        self.assertEqual(tokenize("三维重建"), ["三", "维", "重", "建"])
+
+class KeywordSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.saved = keyword_index.KEYWORD_INDEX_PATH, keyword_index._initialized
+        keyword_index.KEYWORD_INDEX_PATH = os.path.join(self.workdir, "keyword_index.db")
+        keyword_index._initialized = False
+        self.db = fake_db("kb-test")
+        # "scene" 出现在全部4个块中，"lidar" 只出现在一个块中
+        index_chunks(
+            self.db,
+            ["c1", "c2", "c3", "c4"],
+            [
+                "The scene is reconstructed from lidar scans.",
+                "The scene is rendered with a neural field.",
+                "The scene graph links the objects.",
+                "The scene is lit by the sun and the scene is static.",
+            ],
+            [{"document_id": 1}, {"document_id": 1}, {"document_id": 2}, {"document_id": 2}]
+        )
+
+    def tearDown(self):
+        keyword_index.KEYWORD_INDEX_PATH, keyword_index._initialized = self.saved
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_rare_term_ranks_its_chunk_first(self):
+        results = keyword_search(self.db, "lidar scene", k=4)
+        self.assertEqual(results[0][0], "c1")
+
+    def test_stopwords_only_query_returns_nothing(self):
+        # "by" 和 "with" 各只出现在一个块中，不会被文档频率过滤，只能由停用词表去掉
+        self.assertEqual(keyword_search(self.db, "by with"), [])
+
+    def test_stopwords_do_not_change_scores(self):
+        self.assertEqual(keyword_search(self.db, "the lidar of the"), keyword_search(self.db, "lidar"))
+
+    def test_common_terms_are_skipped(self):
+        # "scene" 的文档频率超过 KEYWORD_MAX_DF_RATIO，只由 "neural" 决定结果
+        self.assertEqual(keyword_search(self.db, "scene"), [])
+        self.assertEqual([chunk_id for chunk_id, _ in keyword_search(self.db, "scene neural")], ["c2"])
+
+    def test_k_limits_results(self):
+        self.assertEqual(len(keyword_search(self.db, "lidar neural graph", k=2)), 2)
+
+    def test_removed_chunks_are_not_returned(self):
+        remove_chunk_keywords(self.db, ["c1"])
+        self.assertEqual(keyword_search(self.db, "lidar"), [])
+
+    def test_collections_are_separate(self):
+        self.assertEqual(keyword_search(fake_db("kb-other"), "lidar"), [])
+
+if __name__ == "__main__":
+    unittest.main()
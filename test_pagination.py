@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from db_utils import get_db_connection, encode_cursor, decode_cursor, fetch_page
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        row = {"id": 42, "created_at": "2024-01-02 03:04:05"}
+        self.assertEqual(decode_cursor(encode_cursor(row, "created_at")), ("2024-01-02 03:04:05", 42))
+
+    def test_round_trip_without_padding(self):
+        # 游标去掉了base64的填充字符，不同长度的值都要能解码
+        for name in ("a", "ab", "abc", "abcd", "名称"):
+            row = {"id": 7, "name": name}
+            cursor = encode_cursor(row, "name")
+            self.assertNotIn("=", cursor)
+            self.assertEqual(decode_cursor(cursor), (name, 7))
+
+    def test_invalid_cursor(self):
+        for cursor in ("", "not-a-cursor", "!!!", encode_cursor({"id": "1", "name": "x"}, "name")):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+class FetchPageTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.conn = get_db_connection(os.path.join(self.workdir, "pages.db"))
+        self.conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, created_at TEXT NOT NULL)")
+        # 多条记录的排序列相同，顺序由id决定
+        self.conn.executemany(
+            "INSERT INTO items (id, created_at) VALUES (?, ?)",
+            [(i, f"2024-01-0{1 + i // 3}") for i in range(1, 11)]
+        )
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def fetch_all(self, limit, descending=True, where=None, params=()):
+        ids = []
+        after = None
+        while True:
+            rows, next_cursor = fetch_page(
+                self.conn.cursor(), "SELECT id, created_at FROM items", params, limit, "created_at",
+                where=where, descending=descending, after=after
+            )
+            ids.extend(row["id"] for row in rows)
+            if next_cursor is None:
+                return ids
+            after = decode_cursor(next_cursor)
+
+    def test_pages_cover_all_rows_in_order(self):
+        expected = [row["id"] for row in self.conn.execute(
+            "SELECT id FROM items ORDER BY created_at DESC, id DESC"
+        )]
+        for limit in (1, 2, 3, 4, 10, 11):
+            self.assertEqual(self.fetch_all(limit), expected)
+
+    def test_ties_broken_by_id(self):
+        # id 3、4、5的排序列相同，跨页时不能重复或遗漏
+        self.assertEqual(self.fetch_all(2, descending=False), list(range(1, 11)))
+        self.assertEqual(self.fetch_all(2), [10, 9, 8, 7, 6, 5, 4, 3, 2, 1])
+
+    def test_last_page_has_no_cursor(self):
+        rows, next_cursor = fetch_page(self.conn.cursor(), "SELECT id, created_at FROM items", (), 10, "created_at")
+        self.assertEqual(len(rows), 10)
+        self.assertIsNone(next_cursor)
+
+    def test_where_condition(self):
+        self.assertEqual(self.fetch_all(3, where="id % 2 = ?", params=(0,)), [10, 8, 6, 4, 2])
+
+if __name__ == "__main__":
+    unittest.main()
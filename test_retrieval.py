@@ -0,0 +1,39 @@
+import unittest
+
+from retrieval import reciprocal_rank_fusion
+
+class ReciprocalRankFusionTest(unittest.TestCase):
+    def test_single_ranking_keeps_order(self):
+        self.assertEqual(list(reciprocal_rank_fusion([["a", "b", "c"]])), ["a", "b", "c"])
+
+    def test_scores_add_up_across_rankings(self):
+        scores = reciprocal_rank_fusion([["a", "b"], ["b", "c"]], k=60)
+        self.assertAlmostEqual(scores["a"], 1 / 61)
+        self.assertAlmostEqual(scores["b"], 1 / 62 + 1 / 61)
+        self.assertAlmostEqual(scores["c"], 1 / 62)
+        # 出现在两个列表中的块排在只出现一次的块之前
+        self.assertEqual(list(scores), ["b", "a", "c"])
+
+    def test_result_sorted_by_score(self):
+        scores = reciprocal_rank_fusion([["a", "b", "c", "d"], ["d", "c"], ["c"]])
+        values = list(scores.values())
+        self.assertEqual(values, sorted(values, reverse=True))
+        self.assertEqual(next(iter(scores)), "c")
+
+    def test_weights_scale_rankings(self):
+        rankings = [["a", "b"], ["b", "a"]]
+        self.assertEqual(list(reciprocal_rank_fusion(rankings, weights=[2.0, 1.0])), ["a", "b"])
+        self.assertEqual(list(reciprocal_rank_fusion(rankings, weights=[1.0, 2.0])), ["b", "a"])
+
+    def test_smaller_k_favours_top_ranks(self):
+        # 一个列表中排第一，另一个列表中排第二和第三时，k越小排名靠前的优势越大
+        rankings = [["a", "b", "c"], ["b", "c", "a"]]
+        self.assertEqual(next(iter(reciprocal_rank_fusion(rankings, k=1))), "b")
+        self.assertAlmostEqual(reciprocal_rank_fusion(rankings, k=1)["a"], 1 / 2 + 1 / 4)
+
+    def test_empty_rankings(self):
+        self.assertEqual(reciprocal_rank_fusion([]), {})
+        self.assertEqual(reciprocal_rank_fusion([[], []]), {})
+
+if __name__ == "__main__":
+    unittest.main()